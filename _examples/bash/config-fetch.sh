@@ -1,4 +1,3 @@
-
 ip="$1"
 username=$2
 password=$3
@@ -16,21 +15,12 @@ if [ $params -lt 3 ]; then
   exit 1
 fi
 
-cookie="./tachyon-$ip.cookie"
-
-echo "Logging into API for $ip"
+# Login helper, reuses the API token from previous runs (see tachyon-session.sh)
+. "$(dirname "$0")/tachyon-session.sh"
 
 # Get auth token 
-curl -c $cookie -H "Content-type: application/json" -X POST -d '{"username": "'$2'", "password": "'$3'"}' http://$ip/cgi.lua/apiv1/login
-
-echo ""
-
-# Fetch token from cookie
-
-token=$(cat $cookie | grep token | awk '{print $7}')
+api_login "$ip" "$username" "$password"
 
 echo "Fetching config for $ip and saving to ./$ip-config.json"
 
-curl -H "Cookie: api_token=$token" "http://$ip/cgi.lua/apiv1/config" -o "$ip-config.json"
-
-rm $cookie
+api_curl config > "$ip-config.json"
@@ -16,21 +16,14 @@ if [ $params -lt 4 ]; then
   exit 1
 fi
 
-cookie="./tachyon-$ip.cookie"
-
-echo "Logging into API for $ip"
+# Login helper, reuses the API token from previous runs (see tachyon-session.sh)
+. "$(dirname "$0")/tachyon-session.sh"
 
 # Get auth token 
-curl -c $cookie -H "Content-type: application/json" -X POST -d '{"username": "'$2'", "password": "'$3'"}' http://$ip/cgi.lua/apiv1/login
-
-echo ""
-
-# Parse out cookie token
-token=$(cat $cookie | grep token | awk '{print $7}')
+api_login "$ip" "$username" "$password"
 
 echo "Updating config $ip to $config_file"
 
 # Add  "dry_run": true if you want to do a dry run in your config file.  The resulting file will look like { "dry_run": true, "config": { .... } }
-curl -H "Cookie: api_token=$token" -H "Content-Type: application/json"  -X POST "http://$ip/cgi.lua/apiv1/config" -d "@$config_file"
-
-rm $cookie
+api_curl config -H "Content-Type: application/json" -X POST -d "@$config_file"
+echo ""
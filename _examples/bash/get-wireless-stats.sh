@@ -11,12 +11,14 @@ pass=$3
 [ -z "$username" ] && username="root"
 [ -z "$pass" ] && pass="admin"
 
+# Login helper, reuses the API token from previous runs (see tachyon-session.sh)
+. "$(dirname "$0")/tachyon-session.sh"
+
 echo "Logging in...."
-curl -c ./tachyon$ip.cookie -H "Content-type: application/json" -X POST -d "{\"username\": \"$username\", \"password\": \"$pass\"}" http://$ip/cgi.lua/apiv1/login
+api_login "$ip" "$username" "$pass"
 echo ""
-token=$(cat tachyon$1.cookie | grep token | awk '{print $7}')
 
 echo "Getting wireless stats:"
-curl -H "Cookie: api_token=$token" http://$ip/cgi.lua/apiv1/stats?type=wireless
+api_curl "stats?type=wireless"
 echo ""
 echo ""
@@ -0,0 +1,58 @@
+# Shared API session helper for the bash examples.
+#
+# The API token is kept in ./tachyon-<ip>.cookie and reused by later runs for up
+# to TOKEN_TTL seconds, so the device is only logged into again when the token
+# is missing, too old, or rejected with a 401.
+#
+# Usage:
+#   . "$(dirname "$0")/tachyon-session.sh"
+#   api_login <device_ip> <username> <password>
+#   api_curl <route> [extra curl args...]      # response body is written to stdout
+#   api_logout                                  # optional, ends the session on the device
+
+TOKEN_TTL=${TOKEN_TTL:-1800}
+
+api_login()
+{
+api_ip=$1
+api_username=$2
+api_password=$3
+cookie="./tachyon-$api_ip.cookie"
+
+# Reuse the token from a previous run if the cookie file is recent enough
+if [ -n "$(find "$cookie" -mmin -$((TOKEN_TTL / 60)) 2>/dev/null)" ]; then
+  token=$(grep token "$cookie" | awk '{print $7}')
+  [ -n "$token" ] && return 0
+fi
+
+echo "Logging into API for $api_ip" >&2
+curl -s -c "$cookie" -H "Content-type: application/json" -X POST -d '{"username": "'$api_username'", "password": "'$api_password'"}' "http://$api_ip/cgi.lua/apiv1/login" > /dev/null
+chmod 600 "$cookie" 2>/dev/null
+token=$(grep token "$cookie" 2>/dev/null | awk '{print $7}')
+[ -n "$token" ]
+}
+
+api_curl()
+{
+route=$1
+shift
+body=$(mktemp)
+status=$(curl -s -o "$body" -w "%{http_code}" -H "Cookie: api_token=$token" "$@" "http://$api_ip/cgi.lua/apiv1/$route")
+
+# Token expired or was invalidated (e.g. by a reboot): log in again and retry once
+if [ "$status" = "401" ]; then
+  rm -f "$cookie"
+  api_login "$api_ip" "$api_username" "$api_password"
+  status=$(curl -s -o "$body" -w "%{http_code}" -H "Cookie: api_token=$token" "$@" "http://$api_ip/cgi.lua/apiv1/$route")
+fi
+
+cat "$body"
+rm -f "$body"
+[ "$status" = "200" ]
+}
+
+api_logout()
+{
+curl -s -H "Cookie: api_token=$token" -X DELETE "http://$api_ip/cgi.lua/apiv1/login" > /dev/null
+rm -f "$cookie"
+}
@@ -11,6 +11,49 @@ USERNAME = "root"               # Device login username
 PASSWORD = "admin"              # Device login password
 HOSTNAME = "hostname-123"       # New hostname
 VERBOSE_DEBUG = False           # Whether or not to show the output of the response
+PROFILE = False                 # Whether or not to print how long the requests took when done
+
+# (method, path) -> [(connect or None, first byte, total) seconds of each request], printed when PROFILE is set
+timings = {}
+
+# One keep-alive connection is shared by all requests to the device (login, fetch, push and logout).
+# A request on a connection the device has closed while it was idle fails; it is sent once more on a new one.
+connection = http.client.HTTPConnection(DEVICE_IP, timeout=30)
+
+def timed_request(method, path, body=None, headers=None):
+    """connection.request and getresponse, timed into `timings`; returns the response and its body."""
+    headers = headers or {}
+    for attempt in range(2):
+        reused = connection.sock is not None
+        started = time.perf_counter()
+        connect = None
+        try:
+            if not reused:
+                connection.connect()
+                connect = time.perf_counter() - started
+            sent = time.perf_counter()
+            connection.request(method, path, body, headers=headers)
+            response = connection.getresponse()
+            ttfb = time.perf_counter() - sent
+            data = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            # RemoteDisconnected, BrokenPipeError or ConnectionResetError on a kept-alive connection
+            if reused and attempt == 0 and isinstance(e, ConnectionError):
+                continue
+            raise
+        timings.setdefault((method, path), []).append((connect, ttfb, time.perf_counter() - started))
+        return response, data
+
+def print_timings():
+    print(f"\n{'Request':<24}{'Count':>6}{'Connect ms':>12}{'First byte ms':>15}{'Total ms':>10}")
+    for (method, path), times in timings.items():
+        connects = [connect * 1000 for connect, _, _ in times if connect is not None]
+        connect = f"{sum(connects) / len(connects):.1f}" if connects else "-"
+        ttfb = sum(ttfb for _, ttfb, _ in times) / len(times) * 1000
+        total = sum(total for _, _, total in times) / len(times) * 1000
+        request = method + ' ' + path.replace('/cgi.lua/apiv1', '')
+        print(f"{request:<24}{len(times):>6}{connect:>12}{ttfb:>15.1f}{total:>10.1f}")
 
 def login():
     print(f"Attempting to login with username {USERNAME} and password {PASSWORD} to IP {DEVICE_IP}\n")
@@ -19,13 +62,9 @@ def login():
 
     login_data = json.dumps({ "username" : USERNAME, "password": PASSWORD })
 
-    connection = http.client.HTTPConnection(DEVICE_IP)
+    response, data = timed_request("POST", "/cgi.lua/apiv1/login", login_data, headers=headers)
 
-    connection.request("POST", "/cgi.lua/apiv1/login", login_data, headers=headers)
-
-    response = connection.getresponse() 
-
-    response_body = json.loads(response.read().decode())
+    response_body = json.loads(data.decode())
 
     if VERBOSE_DEBUG: 
         print("Response from login: ")
@@ -40,19 +79,13 @@ def login():
     if VERBOSE_DEBUG: 
         print(f"Token is {token}")
 
-    connection.close()
     return token
 
 
 def logout(token):
     headers = {  "Cookie" : f"api_token={token}" }
 
-    connection = http.client.HTTPConnection(DEVICE_IP)
-    connection.request("DELETE", "/cgi.lua/apiv1/login", headers=headers)
-
-    response = connection.getresponse().read()
-
-    connection.close()
+    timed_request("DELETE", "/cgi.lua/apiv1/login", headers=headers)
 
 def fetch_config(token):
     print(f"Fetching config from device with token {token}\n")
@@ -62,16 +95,13 @@ def fetch_config(token):
         "Cookie" : f"api_token={token}" 
     }
 
-    connection = http.client.HTTPConnection(DEVICE_IP)
-    connection.request("GET", "/cgi.lua/apiv1/config", headers=headers)
-    response = connection.getresponse()
-    response_body = json.loads(response.read().decode())
+    response, data = timed_request("GET", "/cgi.lua/apiv1/config", headers=headers)
+    response_body = json.loads(data.decode())
 
     if VERBOSE_DEBUG:
         print(response_body)
         print("")
 
-    connection.close()
     return response_body
 
 def set_hostname(config, hostname):
@@ -90,7 +120,12 @@ def change_hostname():
 
     config = response_body["config"]
 
-    connection = http.client.HTTPConnection(DEVICE_IP)
+    # Every config POST restarts the device's network services, so don't push a config that wouldn't change
+    if config["system"].get("hostname") == HOSTNAME:
+        print(f"Hostname is already {HOSTNAME}, nothing to push.")
+        logout(token)
+        connection.close()
+        return
 
     ## Set hostname in config, can also change other fields here
     config = set_hostname(config, HOSTNAME)
@@ -108,14 +143,12 @@ def change_hostname():
 
     print(f"Pushing new config now, dry run is set to {DRY_RUN}.\n")
 
-    connection.request("POST", "/cgi.lua/apiv1/config", str_data, headers=headers)
-
-    response = connection.getresponse()
+    response, data = timed_request("POST", "/cgi.lua/apiv1/config", str_data, headers=headers)
 
     if VERBOSE_DEBUG: 
         print(f"Response code is: {response.status}, reason: {response.reason}")
 
-    response_body = response.read().decode()
+    response_body = data.decode()
 
     if VERBOSE_DEBUG: 
         print(response_body)
@@ -143,7 +176,10 @@ def change_hostname():
         print(f"\tKeys removed: {json_response['response']['keys_removed']}")
         print(f"\tWarnings: {json_response['response']['warnings']}")
 
-    connection.close()
     logout(token)
+    connection.close()
+
+change_hostname()
 
-change_hostname()
\ No newline at end of file
+if PROFILE:
+    print_timings()
\ No newline at end of file
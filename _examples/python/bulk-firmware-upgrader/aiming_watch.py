@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Aiming Watch
+Streams the link quality of a device's wireless peers while it is in aiming
+mode, so an installer can follow RSSI and SNR while turning the radio instead
+of refreshing the UI.
+
+The watch starts an aiming session with POST /aiming, or attaches to the one
+already running, and then polls the peers[] of /stats?type=wireless as fast as
+the device allows, checking /aiming once a second. All requests go over one
+keep-alive connection, only the link fields of each peer are picked out of the
+response, and only the fields that changed since the previous sample are
+written, as lines for a terminal or as NDJSON.
+
+The poll rate is held to a CPU budget on the device: the time the device spends
+answering, counted as the whole round trip of each request (an upper bound), is
+kept to `budget` of the wall time. When the watch ends - the session ran out,
+or Ctrl-C - the session is stopped with DELETE /aiming.
+
+Usage: python3 aiming_watch.py -u root -p admin -i 192.168.1.1 --duration 600
+"""
+
+import argparse
+import asyncio
+import json
+import signal
+import sys
+import time
+from typing import Dict, TextIO
+
+from async_client import AsyncDeviceSession
+from tachyon_client import CAPABILITIES, ApiError, AsyncDeviceClient, Call
+from tachyon_session import AuthenticationError, TokenCache
+
+LINK_FIELDS = ('rssi', 'snr', 'remote_rssi', 'tx_mcs', 'rx_mcs', 'tx_sector', 'rx_sector')
+# /aiming fields that change on every poll
+AIMING_VOLATILE = ('last_updated', 'remaining')
+
+
+def link_fields(data: dict) -> Dict[str, dict]:
+    """The link fields of each peer of a /stats?type=wireless, by peer MAC."""
+    peers = (data.get('wireless') or {}).get('peers') or []
+    return {peer['mac']: {field: peer.get(field) for field in LINK_FIELDS} for peer in peers if peer.get('mac')}
+
+
+def changes(previous: dict, current: dict) -> dict:
+    return {key: value for key, value in current.items() if previous.get(key) != value}
+
+
+class AimingWatch:
+    """Poll the link quality of one device during an aiming session and write the changes.
+
+    Args:
+        client: Client of the device.
+        output: Stream the changes are written to.
+        ndjson: Write NDJSON objects instead of lines for a terminal.
+        duration: Seconds of the aiming session, if one has to be started.
+        budget: Share of the wall time the device may spend answering the watch.
+        max_rate: Maximum samples per second.
+        stop: Stop the session with DELETE /aiming when the watch ends.
+    """
+
+    def __init__(self, client: AsyncDeviceClient, output: TextIO = sys.stdout, ndjson: bool = False,
+                 duration: int = 300, budget: float = 0.1, max_rate: float = 10, stop: bool = True):
+        self.client = client
+        self.output = output
+        self.ndjson = ndjson
+        self.duration = duration
+        self.budget = budget
+        self.max_rate = max_rate
+        self.stop = stop
+        self.links: Dict[str, dict] = {}
+        self.aiming: dict = {}
+        self.started = time.monotonic()
+        self.samples = 0
+        self.busy = 0.0  # seconds spent waiting for responses
+        self.stopping = asyncio.Event()
+
+    async def request(self, call: Call):
+        started = time.monotonic()
+        try:
+            return await self.client.execute(call)
+        finally:
+            self.busy += time.monotonic() - started
+
+    def emit(self, record: dict):
+        if self.ndjson:
+            self.output.write(json.dumps(dict(record, ts=round(time.time(), 3)), separators=(',', ':')) + '\n')
+        elif 'aiming' in record:
+            aiming = record['aiming']
+            details = ', '.join(f"{key} {value}" for key, value in aiming.items() if key != 'status')
+            self.output.write(f"{time.monotonic() - self.started:>8.2f}s  aiming {aiming.get('status')}"
+                              f"{'  ' + details if details else ''}\n")
+        else:
+            fields = '  '.join(f"{key} {value}" for key, value in record.items() if key != 'peer')
+            self.output.write(f"{time.monotonic() - self.started:>8.2f}s  {record['peer']}  {fields}\n")
+        self.output.flush()
+
+    async def start(self):
+        """Start an aiming session, or attach to the running one."""
+        status = await self.request(Call('GET', 'aiming'))
+        if status.get('status') != 'running':
+            try:
+                await self.request(Call('POST', 'aiming', json={'duration': self.duration}))
+            except ApiError as e:
+                if e.status != 409:  # started by someone else meanwhile
+                    raise
+            status = await self.request(Call('GET', 'aiming'))
+        self.update_aiming(status)
+
+    def update_aiming(self, status: dict) -> bool:
+        """Record an /aiming response; returns whether aiming still runs."""
+        aiming = {key: value for key, value in status.items() if key not in AIMING_VOLATILE}
+        if aiming != self.aiming:
+            self.emit({'aiming': aiming})
+            self.aiming = aiming
+        return status.get('status') == 'running'
+
+    def update_links(self, links: Dict[str, dict]):
+        for peer, fields in links.items():
+            changed = changes(self.links.get(peer, {}), fields)
+            if changed:
+                self.emit(dict(peer=peer, **changed))
+        for peer in self.links.keys() - links.keys():
+            self.emit({'peer': peer, 'connected': False})
+        self.links = links
+        self.samples += 1
+
+    async def run(self):
+        """Watch until the aiming session ends or stop() is called."""
+        stats = Call('GET', 'stats', {'type': 'wireless'}, finish=link_fields)
+        try:
+            await self.start()
+            aiming_checked = time.monotonic()
+            while not self.stopping.is_set():
+                tick = time.monotonic()
+                busy = self.busy
+                self.update_links(await self.request(stats))
+                if time.monotonic() - aiming_checked >= 1:
+                    aiming_checked = time.monotonic()
+                    if not self.update_aiming(await self.request(Call('GET', 'aiming'))):
+                        break
+                # Idle long enough that answering stays within the budget
+                spent = self.busy - busy
+                delay = max(1 / self.max_rate - spent, spent * (1 / self.budget - 1))
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), max(0.0, tick + spent + delay - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.stop and self.aiming.get('status') == 'running':
+                try:
+                    await self.request(Call('DELETE', 'aiming'))
+                    self.emit({'aiming': {'status': 'stopped'}})
+                except ApiError:
+                    pass  # ended by itself meanwhile
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started
+        return (f"{self.samples} sample(s) in {elapsed:.1f}s ({self.samples / elapsed if elapsed else 0:.1f}/s), "
+                f"device busy {self.busy / elapsed if elapsed else 0:.1%} of the time")
+
+
+async def watch(watcher: AimingWatch):
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, watcher.stopping.set)
+    except (NotImplementedError, RuntimeError):
+        pass  # Ctrl-C then cancels the watch, which still stops the session
+    try:
+        await watcher.run()
+    finally:
+        await watcher.client.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream the link quality of a Tachyon device while aiming')
+    parser.add_argument('-u', '--username', type=str, required=True, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, required=True, help='Password for authentication')
+    parser.add_argument('-i', '--ip', type=str, required=True, help='IP address of the device being aimed')
+    parser.add_argument('--duration', type=int, default=300,
+                        help='Seconds of the aiming session, if one is started (default: 300)')
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='Share of the time the device may spend answering the watch (default: 0.1)')
+    parser.add_argument('--max-rate', type=float, default=10, help='Maximum samples per second (default: 10)')
+    parser.add_argument('--leave-running', action='store_true', help='Do not stop the aiming session at the end')
+    parser.add_argument('--ndjson', action='store_true', help='Write the changes as NDJSON')
+    parser.add_argument('-o', '--output', type=str, help='Append the changes to this file (default: stdout)')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds (default: 10)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    session = AsyncDeviceSession(args.ip, args.username, args.password, TokenCache(args.token_cache),
+                                 timeout=args.timeout)
+    watcher = AimingWatch(AsyncDeviceClient(session), output, ndjson=args.ndjson, duration=args.duration,
+                          budget=args.budget, max_rate=args.max_rate, stop=not args.leave_running)
+    try:
+        asyncio.run(watch(watcher))
+    except (ApiError, AuthenticationError, OSError, asyncio.TimeoutError) as e:
+        print(f"✗ {e or type(e).__name__}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        CAPABILITIES.save()
+        if args.output:
+            output.close()
+        print(watcher.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
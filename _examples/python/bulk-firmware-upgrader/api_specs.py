@@ -0,0 +1,123 @@
+"""
+API Spec Lookup
+Locates the versioned swagger.yaml specs in this repo (tna_30x/, tna_305/ and
+tns_10x/) and answers questions about them, such as which /stats types a
+product family supports. Specs are parsed lazily and cached.
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import yaml
+
+SPEC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+FAMILIES = ('tna_30x', 'tna_305', 'tns_10x')
+
+# A row of the spec tables in the repo README: version, date, firmware, link to the spec
+FIRMWARE_ROW_RE = re.compile(r'<tr>\s*<td>\s*([\d.]+)\s*</td>\s*<td>[^<]*</td>\s*<td>\s*v?([\d.]+)[^<]*</td>\s*'
+                             r'<td><a href="[^"]*/(\w+)/v[\d.]+/?"')
+
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+
+def family_for_model(model: str) -> Optional[str]:
+    """Map a device model from /stats?type=system (e.g. TNA-303X) to its spec family."""
+    model = (model or '').upper()
+    if model.startswith('TNS-'):
+        return 'tns_10x'
+    if model.startswith('TNA-305'):
+        return 'tna_305'
+    if model.startswith('TNA-30'):
+        return 'tna_30x'
+    return None
+
+
+def _version_key(version: str):
+    return tuple(int(part) for part in re.findall(r'\d+', version))
+
+
+@lru_cache(maxsize=None)
+def spec_versions(family: str, root: str = SPEC_ROOT) -> List[str]:
+    """All spec versions of a family, oldest first, e.g. ['v1.0.0', 'v1.0.1']."""
+    directory = os.path.join(root, family)
+    if not os.path.isdir(directory):
+        return []
+    versions = [name for name in os.listdir(directory)
+                if os.path.isfile(os.path.join(directory, name, 'swagger.yaml'))]
+    return sorted(versions, key=_version_key)
+
+
+def load_spec(family: str, version: Optional[str] = None, root: str = SPEC_ROOT) -> dict:
+    """Parse one swagger.yaml, defaulting to the newest version of the family."""
+    version = version or spec_versions(family, root)[-1]
+    return _parse_spec(os.path.join(root, family, version, 'swagger.yaml'))
+
+
+@lru_cache(maxsize=None)
+def _parse_spec(path: str) -> dict:
+    with open(path) as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+
+@lru_cache(maxsize=None)
+def stats_types(family: str, version: Optional[str] = None, root: str = SPEC_ROOT) -> List[str]:
+    """Stats types accepted by GET /stats?type=..., read from the spec.
+
+    e.g. ['system', 'wireless', 'ethernet', 'network'] for TNA-30x and
+    ['system', 'ethernet', 'interfaces', 'network'] for TNS-10x.
+    """
+    spec = load_spec(family, version, root)
+    for parameter in spec['paths']['/stats']['get'].get('parameters', []):
+        if parameter.get('name') == 'type':
+            description = parameter.get('description', '')
+            listing = description.split(':', 1)[-1].split('(')[0]
+            return [word for word in re.split(r'[\s,]+|and/or', listing) if word.isalpha()]
+    return ['system']
+
+
+@lru_cache(maxsize=None)
+def firmware_table(root: str = SPEC_ROOT) -> Dict[str, List[tuple]]:
+    """Oldest firmware of each spec version, from the tables in the repo README.
+
+    Returns: {'tna_30x': [((1, 11, 0), 'v1.0.0'), ((1, 11, 1), 'v1.0.1'), ...]}, oldest first
+    """
+    try:
+        with open(os.path.join(root, 'README.md')) as f:
+            readme = f.read()
+    except OSError:
+        return {}
+    table: Dict[str, List[tuple]] = {}
+    for version, firmware, family in FIRMWARE_ROW_RE.findall(readme):
+        table.setdefault(family, []).append((_version_key(firmware), f"v{version}"))
+    return {family: sorted(rows) for family, rows in table.items()}
+
+
+def spec_for_firmware(family: str, firmware: Optional[str], root: str = SPEC_ROOT) -> Optional[str]:
+    """Spec version that documents the API of a firmware version, e.g. 'v1.0.7' for tna_30x 1.14.2.
+
+    Firmware older than every spec maps to the oldest spec, unknown firmware to the newest.
+    """
+    versions = spec_versions(family, root)
+    if not versions:
+        return None
+    rows = [(oldest, version) for oldest, version in firmware_table(root).get(family, []) if version in versions]
+    match = re.search(r'\d+\.\d+\.\d+', firmware or '')
+    if not rows or not match:
+        return versions[-1]
+    key = _version_key(match.group(0))
+    eligible = [version for oldest, version in rows if oldest <= key]
+    return eligible[-1] if eligible else rows[0][1]
+
+
+def multi_stats_type(family: Optional[str]) -> str:
+    """Comma-separated type parameter that fetches all stats in one round trip."""
+    return ','.join(stats_types(family)) if family else 'system'
+
+
+def spec_summary() -> Dict[str, List[str]]:
+    return {family: spec_versions(family) for family in FAMILIES}
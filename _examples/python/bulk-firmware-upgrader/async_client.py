@@ -0,0 +1,234 @@
+"""
+Async Tachyon API Client
+Minimal asyncio HTTP/1.1 client for polling many devices from one event loop.
+Each AsyncDeviceSession keeps one keep-alive connection to its device and
+shares api_tokens with the threaded sessions through a TokenCache, and
+records its requests in the same RequestMetrics.
+"""
+
+import asyncio
+import json as jsonlib
+import time
+from http.cookies import SimpleCookie
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+from request_metrics import METRICS, RequestMetrics, endpoint_name
+from tachyon_session import API_PATH, AuthenticationError, TokenCache
+
+
+class AsyncResponse:
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return jsonlib.loads(self.body)
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(errors='replace')
+
+    def cookie(self, name: str) -> Optional[str]:
+        cookie = SimpleCookie()
+        for value in self.headers.get('set-cookie', '').split('\n'):
+            try:
+                cookie.load(value)
+            except Exception:
+                continue
+        return cookie[name].value if name in cookie else None
+
+
+class AsyncDeviceSession:
+    """Authenticated asyncio session with one device over one keep-alive connection.
+
+    Requests on the same session are serialized; use one session per device and
+    many sessions concurrently.
+    """
+
+    def __init__(self, ip: str, username: str, password: str, token_cache: Optional[TokenCache] = None,
+                 timeout: float = 10, port: int = 80, metrics: Optional[RequestMetrics] = METRICS):
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.password = password
+        self.token_cache = token_cache or TokenCache()
+        self.timeout = timeout
+        self.cache_key = f"{username}@{ip}"
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.lock = asyncio.Lock()
+        self.login_count = 0
+        self.metrics = metrics
+        # Timing of the request in flight
+        self.connect_time: Optional[float] = None
+        self.first_byte: Optional[float] = None
+
+    @property
+    def api_token(self) -> Optional[str]:
+        return self.token_cache.get(self.cache_key)
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+        self.connect_time = time.perf_counter() - started
+
+    def disconnect(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def send(self, method: str, path: str, body: Optional[bytes] = None,
+                   headers: Optional[Dict[str, str]] = None) -> AsyncResponse:
+        """Send one raw HTTP request over the keep-alive connection."""
+        lines = [f"{method.upper()} {path} HTTP/1.1", f"Host: {self.ip}", "Accept: application/json",
+                 "Connection: keep-alive", f"Content-Length: {len(body or b'')}"]
+        if body:
+            lines.append("Content-Type: application/json")
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode() + (body or b'')
+        if self.metrics is None:
+            return await self.exchange(request)
+
+        self.connect_time = self.first_byte = None
+        started = time.perf_counter()
+        try:
+            response = await self.exchange(request)
+        except BaseException:
+            # Timeouts cancel the request here too
+            self.metrics.observe(self.ip, endpoint_name(method, path), self.connect_time, None,
+                                 time.perf_counter() - started)
+            raise
+        ttfb = self.first_byte - started - (self.connect_time or 0)
+        self.metrics.observe(self.ip, endpoint_name(method, path), self.connect_time, ttfb,
+                             time.perf_counter() - started, len(response.body), response.status)
+        return response
+
+    async def exchange(self, request: bytes) -> AsyncResponse:
+        reused = self.writer is not None
+        try:
+            if not reused:
+                await self.connect()
+            self.writer.write(request)
+            return await self.read_response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.disconnect()
+            if not reused:
+                raise
+            # The device closed the idle keep-alive connection, retry on a fresh one
+            await self.connect()
+            self.writer.write(request)
+            return await self.read_response()
+
+    async def read_response(self) -> AsyncResponse:
+        status_line = await self.reader.readuntil(b'\r\n')
+        self.first_byte = time.perf_counter()
+        status = int(status_line.split()[1])
+        headers: Dict[str, str] = {}
+        while True:
+            line = (await self.reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            headers[name] = f"{headers[name]}\n{value.strip()}" if name in headers else value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readuntil(b'\r\n')
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            self.disconnect()
+
+        if headers.get('connection', '').lower() == 'close':
+            self.disconnect()
+        return AsyncResponse(status, headers, body)
+
+    async def login(self, stale_token: Optional[str] = None) -> str:
+        """Return a valid api_token, logging in only if needed."""
+        token = self.api_token
+        if token and token != stale_token:
+            return token
+        body = jsonlib.dumps({'username': self.username, 'password': self.password}).encode()
+        response = await self.send('POST', f"{API_PATH}/login", body)
+        self.login_count += 1
+        token = response.cookie('token')
+        if not token and response.status == 200:
+            try:
+                token = response.json().get('token')
+            except ValueError:
+                token = None
+        if response.status != 200 or not token:
+            raise AuthenticationError(f"Login to {self.ip} failed: {response.status} {response.text}")
+        self.token_cache.set(self.cache_key, token)
+        return token
+
+    def forget_token(self):
+        """Drop the cached token, e.g. after a reboot invalidated it."""
+        self.token_cache.discard(self.cache_key)
+
+    async def request(self, method: str, path: str, params: Optional[dict] = None, json=None,
+                      timeout: Optional[float] = None) -> AsyncResponse:
+        """Send an authenticated request, re-logging in once on 401.
+
+        Raises:
+            asyncio.TimeoutError: If the device does not answer within the timeout.
+        """
+        url = f"{API_PATH}/{path.lstrip('/')}"
+        if params:
+            url += '?' + urlencode(params, safe=',')
+        body = jsonlib.dumps(json).encode() if json is not None else None
+
+        async def send_authenticated():
+            token = await self.login()
+            response = await self.send(method, url, body, {'Cookie': f"api_token={token}"})
+            if response.status == 401:
+                token = await self.login(stale_token=token)
+                response = await self.send(method, url, body, {'Cookie': f"api_token={token}"})
+            return response
+
+        async with self.lock:
+            try:
+                return await asyncio.wait_for(send_authenticated(), timeout or self.timeout)
+            except BaseException:
+                self.disconnect()  # connection state is unknown after a timeout or error
+                raise
+
+    async def get(self, path: str, **kwargs) -> AsyncResponse:
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> AsyncResponse:
+        return await self.request('POST', path, **kwargs)
+
+    async def put(self, path: str, **kwargs) -> AsyncResponse:
+        return await self.request('PUT', path, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> AsyncResponse:
+        return await self.request('DELETE', path, **kwargs)
+
+    async def close(self, logout: Optional[bool] = None):
+        """Close the connection, logging out unless tokens are persisted to disk."""
+        if logout is None:
+            logout = not self.token_cache.persistent
+        token = self.api_token
+        if logout and token:
+            self.token_cache.discard(self.cache_key)
+            try:
+                async with self.lock:
+                    await asyncio.wait_for(self.send('DELETE', f"{API_PATH}/login",
+                                                     headers={'Cookie': f"api_token={token}"}), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                pass
+        self.disconnect()
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+Benchmark
+Measures the tools in this directory against device_simulator.py, next to a
+baseline of the sequential one-device-at-a-time scripts they replace
+(simple-firmware-upgrader and the basic/ examples), so every improvement can
+be put in numbers and regressions show up between versions.
+
+Scenarios:
+  upgrade       fleet firmware upgrade
+  stats         stats sweeps across all devices
+  config        config push, then the same push again (a no-op)
+  reboot        reboot all devices at once and wait until they are back
+  login         repeated short tool runs against every device (login churn)
+
+Every case runs in a fresh simulator process and a fresh worker process, and
+reports wall time, requests per device, the worker's peak memory and the
+p50/p95/p99 response time per endpoint as seen by the simulated devices.
+Results are written as JSON; --compare prints the change against an earlier run.
+
+Usage: python3 benchmark.py --devices 50 --latency 20 -o results.json --compare previous.json
+"""
+
+import argparse
+import http.client
+import importlib.util
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from api_specs import family_for_model, stats_types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIMPLE_UPGRADER = os.path.join(HERE, '..', 'simple-firmware-upgrader', 'firmware_upgrade.py')
+FIRMWARE_URL = 'http://127.0.0.1:8000/tna-30x-1.12.3-r55000-20260204-tn-110-prs-squashfs-sysupgrade.bin'
+USERNAME, PASSWORD = 'root', 'admin'
+
+
+class ScaledClock:
+    """Stand-in for the time module that runs `scale` times faster than real time.
+
+    Installed as the `time` of the measured modules, so their fixed sleeps and
+    poll intervals shrink by the same factor as the simulated device timers.
+    """
+
+    def __init__(self, scale: float):
+        self.scale = scale
+        self.origin = time.time()
+        self.origin_monotonic = time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds / self.scale)
+
+    def time(self) -> float:
+        return self.origin + (time.time() - self.origin) * self.scale
+
+    def monotonic(self) -> float:
+        return self.origin_monotonic + (time.monotonic() - self.origin_monotonic) * self.scale
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def load_simple_upgrader():
+    spec = importlib.util.spec_from_file_location('simple_firmware_upgrade', SIMPLE_UPGRADER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+# ----- baseline: the sequential scripts -----
+
+def baseline_upgrade(ips: List[str], options: dict) -> int:
+    """simple-firmware-upgrader, one device after the other."""
+    simple = load_simple_upgrader()
+    simple.time = options['clock']
+    return sum(simple.FirmwareUpgrader(ip, USERNAME, PASSWORD, FIRMWARE_URL).upgrade() for ip in ips)
+
+
+def baseline_stats(ips: List[str], options: dict) -> int:
+    """Log in, GET each stats type and log out, device after device, as the basic/ examples do."""
+    ok = 0
+    for _ in range(options['sweeps']):
+        for ip in ips:
+            base_url = f"http://{ip}/cgi.lua/apiv1"
+            session = requests.Session()
+            response = session.post(f"{base_url}/login", json={'username': USERNAME, 'password': PASSWORD}, timeout=10)
+            cookies = {'api_token': response.json()['token']}
+            system = session.get(f"{base_url}/stats", params={'type': 'system'}, cookies=cookies, timeout=10).json()
+            family = family_for_model(system['system'].get('model')) or 'tna_30x'
+            for stats_type in stats_types(family)[1:]:
+                session.get(f"{base_url}/stats", params={'type': stats_type}, cookies=cookies, timeout=10).json()
+            session.delete(f"{base_url}/login", cookies=cookies, timeout=10)
+            session.close()
+            ok += 1
+    return ok
+
+
+def baseline_config(ips: List[str], options: dict) -> int:
+    """basic/update-device-hostname.py per device: login, GET /config, POST /config, logout; run twice."""
+    ok = 0
+    for _ in range(2):
+        for ip in ips:
+            connection = http.client.HTTPConnection(ip, timeout=30)
+            headers = {'Content-Type': 'application/json'}
+            connection.request('POST', '/cgi.lua/apiv1/login', json.dumps({'username': USERNAME, 'password': PASSWORD}),
+                               headers=headers)
+            headers['Cookie'] = f"api_token={json.loads(connection.getresponse().read())['token']}"
+            connection.request('GET', '/cgi.lua/apiv1/config', headers=headers)
+            config = json.loads(connection.getresponse().read())['config']
+            config.setdefault('system', {})['hostname'] = options['hostname']
+            connection.request('POST', '/cgi.lua/apiv1/config', json.dumps({'config': config}), headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok += response.status == 200
+            connection.request('DELETE', '/cgi.lua/apiv1/login', headers=headers)
+            connection.getresponse().read()
+            connection.close()
+    return ok // 2
+
+
+def baseline_reboot(ips: List[str], options: dict) -> int:
+    """Reboot every device, then wait for each in turn with the simple upgrader's wait_for_device."""
+    simple = load_simple_upgrader()
+    simple.time = options['clock']
+    upgraders = [simple.FirmwareUpgrader(ip, USERNAME, PASSWORD, FIRMWARE_URL) for ip in ips]
+    for upgrader in upgraders:
+        upgrader.login()
+        upgrader.reboot_device()
+    return sum(upgrader.wait_for_device() and upgrader.login() for upgrader in upgraders)
+
+
+def baseline_login(ips: List[str], options: dict) -> int:
+    """Every run logs in to every device again and reads its firmware version."""
+    simple = load_simple_upgrader()
+    ok = 0
+    for _ in range(options['rounds']):
+        for ip in ips:
+            upgrader = simple.FirmwareUpgrader(ip, USERNAME, PASSWORD, FIRMWARE_URL)
+            ok += bool(upgrader.login() and upgrader.get_current_firmware())
+    return ok // options['rounds']
+
+
+# ----- current: the bulk tools -----
+
+def current_upgrade(ips: List[str], options: dict) -> int:
+    import upgrade_engine
+    from wait_scheduler import WaitScheduler
+    upgrade_engine.time = options['clock']
+    # The scheduler waits on its event loop's clock, so its intervals are scaled instead
+    scale = options['time_scale']
+    scheduler = WaitScheduler(min_interval=2 / scale, max_interval=15 / scale)
+    upgrader = upgrade_engine.FleetUpgrader(ips, USERNAME, PASSWORD, FIRMWARE_URL, concurrency=options['concurrency'],
+                                            scheduler=scheduler, probe_interval=1 / scale)
+    upgrader.run()
+    return sum(device.state == upgrade_engine.State.DONE for device in upgrader.devices.values())
+
+
+def current_stats(ips: List[str], options: dict) -> int:
+    import asyncio
+    from stats_collector import StatsCollector
+    samples = []
+    collector = StatsCollector(ips, USERNAME, PASSWORD, interval=0, jitter=0,
+                               max_in_flight=options['concurrency'] * 10, on_sample=samples.append)
+    asyncio.run(collector.run(sweeps=options['sweeps']))
+    return sum(sample['ok'] for sample in samples) // options['sweeps']
+
+
+def current_config(ips: List[str], options: dict) -> int:
+    from config_diff import ConfigCache, ConfigPusher, set_path
+    from tachyon_session import SessionPool
+
+    def change(config: dict):
+        set_path(config, 'system.hostname', options['hostname'])
+
+    with SessionPool(USERNAME, PASSWORD) as pool:
+        pusher = ConfigPusher(pool, ConfigCache())
+        results = pusher.push_all(ips, change, concurrency=options['concurrency'])
+        pusher.push_all(ips, change, concurrency=options['concurrency'])
+    return sum(result.status == 'pushed' for result in results)
+
+
+def current_reboot(ips: List[str], options: dict) -> int:
+    """Reboot every device, then watch them all come back at once with the upgrade engine's reboot watcher."""
+    import upgrade_engine
+    from tachyon_session import SessionPool
+    from wait_scheduler import WaitScheduler
+    upgrade_engine.time = options['clock']
+    scale = options['time_scale']
+
+    def reboot(device: upgrade_engine.DeviceUpgrade) -> Optional[Future]:
+        device.started_at = time.time()
+        device.state = upgrade_engine.State.REBOOT
+        return device.advance()
+
+    with SessionPool(USERNAME, PASSWORD) as pool, WaitScheduler() as scheduler, \
+            ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+        devices = [upgrade_engine.DeviceUpgrade(pool.get(ip), FIRMWARE_URL, force=True, scheduler=scheduler,
+                                                probe_interval=1 / scale) for ip in ips]
+        wait([future for future in executor.map(reboot, devices) if future is not None])
+        list(executor.map(upgrade_engine.DeviceUpgrade.advance, devices))
+    return sum(device.state == upgrade_engine.State.DONE for device in devices)
+
+
+def current_login(ips: List[str], options: dict) -> int:
+    """Each run is a new SessionPool; tokens are kept between runs in a token cache file."""
+    from tachyon_session import SessionPool, TokenCache
+    ok = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'tokens.json')
+        for _ in range(options['rounds']):
+            token_cache = TokenCache(path)
+            with SessionPool(USERNAME, PASSWORD, token_cache) as pool, \
+                    ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                ok += sum(executor.map(lambda ip: pool.get(ip).get('stats', params={'type': 'system'}).ok, ips))
+            token_cache.save()
+    return ok // options['rounds']
+
+
+SCENARIOS: Dict[str, Dict[str, Callable[[List[str], dict], int]]] = {
+    'upgrade': {'baseline': baseline_upgrade, 'current': current_upgrade},
+    'stats': {'baseline': baseline_stats, 'current': current_stats},
+    'config': {'baseline': baseline_config, 'current': current_config},
+    'reboot': {'baseline': baseline_reboot, 'current': current_reboot},
+    'login': {'baseline': baseline_login, 'current': current_login},
+}
+
+
+# ----- processes -----
+
+def serve_simulator(connection, options: dict):
+    """Simulator process: send the device addresses, serve until told to stop, send the request statistics."""
+    import asyncio
+    from device_simulator import Simulator
+
+    async def serve():
+        simulator = Simulator(**options, record_latency=True)
+        await simulator.start()
+        connection.send([device.address for device in simulator.devices])
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)
+        await simulator.stop()
+        connection.send({'requests': dict(simulator.requests), 'latencies': dict(simulator.latencies)})
+
+    asyncio.run(serve())
+
+
+def run_worker(connection, scenario: str, variant: str, ips: List[str], options: dict):
+    """Worker process: run one scenario variant and send its outcome and peak memory."""
+    import resource
+    options['clock'] = ScaledClock(options['time_scale'])
+    started = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            ok, error = SCENARIOS[scenario][variant](ips, options), None
+    except Exception as e:
+        ok, error = 0, f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    connection.send({'ok': ok, 'error': error, 'wall_s': wall, 'peak_rss_mb': peak_mb})
+
+
+def receive(connection, process, name: str, interval: float = 1):
+    """Receive the next message of a child process.
+
+    Raises:
+        ChildProcessError: If the process exited without sending it.
+    """
+    while not connection.poll(interval):
+        if not process.is_alive() and not connection.poll():
+            break
+    try:
+        if connection.poll():
+            return connection.recv()
+    except EOFError:
+        pass
+    process.join()
+    raise ChildProcessError(f"{name} process exited with code {process.exitcode} before sending its result")
+
+
+def run_case(scenario: str, variant: str, devices: int, options: dict) -> dict:
+    context = multiprocessing.get_context('spawn')
+    scale = options['time_scale']
+    simulator_options = {
+        'devices': devices, 'network': options['network'], 'username': USERNAME, 'password': PASSWORD,
+        'latency': options['latency'] / 1000, 'jitter': options['jitter'] / 1000,
+        'cgi_time': options['cgi_time'] / 1000, 'seed': options['seed'],
+        'download_time': 20 / scale, 'flash_time': 30 / scale, 'reboot_time': 60 / scale,
+    }
+    simulator_end, here = context.Pipe()
+    simulator = context.Process(target=serve_simulator, args=(simulator_end, simulator_options), daemon=True)
+    simulator.start()
+    simulator_end.close()  # the simulator holds the only other end, so its exit shows up as EOF here
+    worker = None
+    try:
+        ips = receive(here, simulator, 'simulator')
+
+        worker_end, worker_here = context.Pipe()
+        worker = context.Process(target=run_worker, args=(worker_end, scenario, variant, ips, options))
+        worker.start()
+        worker_end.close()
+        outcome = receive(worker_here, worker, 'worker')
+        worker.join()
+
+        try:
+            here.send('stop')
+        except OSError:
+            pass  # the simulator is gone; receive() reports how it exited
+        served = receive(here, simulator, 'simulator')
+        simulator.join()
+    finally:
+        for process in (worker, simulator):
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join()
+
+    total = sum(served['requests'].values())
+    result = {
+        'scenario': scenario, 'variant': variant, 'devices': devices, 'succeeded': outcome['ok'],
+        'error': outcome['error'], 'wall_s': round(outcome['wall_s'], 3),
+        'wall_s_per_device': round(outcome['wall_s'] / devices, 4),
+        'requests_per_device': round(total / devices, 2),
+        'peak_rss_mb': round(outcome['peak_rss_mb'], 1),
+        'endpoints': {},
+    }
+    for route, count in sorted(served['requests'].items()):
+        latencies = served['latencies'].get(route, [])
+        result['endpoints'][route] = {
+            'requests': count, 'p50_ms': round(percentile(latencies, 0.50), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2), 'p99_ms': round(percentile(latencies, 0.99), 2),
+        }
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_result(result: dict) -> str:
+    lines = [f"{result['scenario']:<8} {result['variant']:<9} {result['devices']:>5} dev  "
+             f"{result['succeeded']:>5} ok  {result['wall_s']:>8.2f}s  {result['requests_per_device']:>7.1f} req/dev  "
+             f"{result['peak_rss_mb']:>6.1f} MB" + (f"  {result['error']}" if result['error'] else '')]
+    for route, endpoint in result['endpoints'].items():
+        lines.append(f"    {route:<22}{endpoint['requests']:>8}  p50 {endpoint['p50_ms']:>7.2f}  "
+                     f"p95 {endpoint['p95_ms']:>7.2f}  p99 {endpoint['p99_ms']:>7.2f} ms")
+    return '\n'.join(lines)
+
+
+def login_regressions(results: List[dict]) -> List[str]:
+    """Scenarios whose current tools log in more often per device than the sequential baseline."""
+    def logins(result: dict) -> float:
+        return result['endpoints'].get('POST /login', {}).get('requests', 0) / result['devices']
+
+    baselines = {result['scenario']: result for result in results if result['variant'] == 'baseline'}
+    return [f"{result['scenario']}: {logins(result):.1f} logins per device, "
+            f"baseline {logins(baselines[result['scenario']]):.1f}"
+            for result in results
+            if result['variant'] == 'current' and result['scenario'] in baselines
+            and logins(result) > logins(baselines[result['scenario']])]
+
+
+def compare(results: List[dict], previous: List[dict]) -> str:
+    """Change in time per device and requests per device against an earlier run."""
+    earlier = {(result['scenario'], result['variant']): result for result in previous}
+    lines = [f"{'Scenario':<10}{'Variant':<10}{'Time/device':>14}{'Requests/device':>18}{'Peak MB':>10}"]
+    for result in results:
+        before = earlier.get((result['scenario'], result['variant']))
+        if not before:
+            continue
+        cells = []
+        for key in ('wall_s_per_device', 'requests_per_device', 'peak_rss_mb'):
+            cells.append(f"{(result[key] / before[key] - 1) * 100:+.0f}%" if before[key] else 'n/a')
+        lines.append(f"{result['scenario']:<10}{result['variant']:<10}{cells[0]:>14}{cells[1]:>18}{cells[2]:>10}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tools against simulated devices')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='Scenario to run (default: all, repeatable)')
+    parser.add_argument('--variant', choices=('baseline', 'current', 'both'), default='both',
+                        help='Run the sequential baseline, the current tools or both (default: both)')
+    parser.add_argument('--devices', type=int, default=50, help='Simulated devices for the current tools (default: 50)')
+    parser.add_argument('--baseline-devices', type=int, default=5,
+                        help='Simulated devices for the sequential baseline, which is slow (default: 5)')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='Concurrency of the current tools (default: 10)')
+    parser.add_argument('--latency', type=float, default=20, help='Milliseconds of latency per request (default: 20)')
+    parser.add_argument('--jitter', type=float, default=5, help='Random extra milliseconds per request (default: 5)')
+    parser.add_argument('--cgi-time', type=float, default=5, help='Milliseconds of device processing per request (default: 5)')
+    parser.add_argument('--time-scale', type=float, default=10,
+                        help='Run firmware, reboot and poll timers this many times faster (default: 10)')
+    parser.add_argument('--sweeps', type=int, default=3, help='Sweeps in the stats scenario (default: 3)')
+    parser.add_argument('--rounds', type=int, default=5, help='Runs in the login scenario (default: 5)')
+    parser.add_argument('--network', default='127.20.0.0/16', help='Loopback network of the simulated devices')
+    parser.add_argument('--seed', type=int, default=1, help='Simulator random seed (default: 1)')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Earlier results JSON file to compare with')
+    args = parser.parse_args()
+
+    options = {
+        'concurrency': args.concurrency, 'latency': args.latency, 'jitter': args.jitter, 'cgi_time': args.cgi_time,
+        'time_scale': args.time_scale, 'sweeps': args.sweeps, 'rounds': args.rounds, 'network': args.network,
+        'seed': args.seed, 'hostname': 'benchmark-host',
+    }
+    variants = ('baseline', 'current') if args.variant == 'both' else (args.variant,)
+    results = []
+    failed = False
+    for scenario in args.scenario or list(SCENARIOS):
+        for variant in variants:
+            devices = min(args.devices, args.baseline_devices) if variant == 'baseline' else args.devices
+            try:
+                result = run_case(scenario, variant, devices, options)
+            except ChildProcessError as e:
+                print(f"{scenario:<8} {variant:<9} {devices:>5} dev  failed: {e}", file=sys.stderr, flush=True)
+                failed = True
+                continue
+            print(format_result(result), flush=True)
+            results.append(result)
+
+    report = {'revision': git_revision(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': sys.version.split()[0], 'options': options, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n' + compare(results, json.load(f)['results']))
+    for regression in login_regressions(results):
+        print(f"More logins than the baseline: {regression}", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
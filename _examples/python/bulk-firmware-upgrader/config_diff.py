@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Config Diff
+Applies config changes to many devices while skipping pushes that would not
+change anything. The last config fetched from each device is cached, changes
+are diffed locally using the same flattened key paths as the keys_changed /
+keys_added / keys_removed of POST /config (for example system.hostname or
+system.users.4), and only devices whose config really changes are posted to,
+each POST restarting the device's network services.
+
+Usage: python3 config_diff.py -u root -p admin -if ips.txt --set system.hostname=ap-1 --dry-run
+"""
+
+import argparse
+import copy
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from api_specs import FAMILIES
+from config_schema import ConfigValidator, validator_for
+from tachyon_client import CAPABILITIES, ApiError, DeviceClient
+from tachyon_session import SessionPool, TokenCache
+
+# Keys known to need a reboot: the mode change from the POST /config example in
+# swagger.yaml, and SFP 1G support which keys.html says needs a reboot on TNS-10x.
+REBOOT_KEYS = ('wireless.radios.*.mode', 'interfaces.ports.*.enable_sfp_1g_support')
+
+
+def flatten(config: Any, prefix: str = '') -> Dict[str, Any]:
+    """Flatten a config into dotted key paths, the way the API reports them.
+
+    Objects are descended into; list entries are leaves addressed by their
+    index, so an added user shows up as system.users.4 with the whole entry.
+    """
+    flat = {}
+    if isinstance(config, dict) and (config or not prefix):
+        for key, value in config.items():
+            flat.update(flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(config, list) and config:
+        for index, value in enumerate(config):
+            flat[f"{prefix}.{index}"] = value
+    else:
+        flat[prefix] = config
+    return flat
+
+
+def key_pattern(path: str) -> str:
+    """Generalize list indices of a key path, e.g. system.users.4.enabled -> system.users.*.enabled."""
+    return re.sub(r'(?<=\.)\d+(?=\.|$)', '*', path)
+
+
+class ConfigDiff:
+    """Flattened difference between two configs, shaped like the POST /config response."""
+
+    __slots__ = ('changed', 'added', 'removed')
+
+    def __init__(self, old: dict, new: dict):
+        self.compare(flatten(old), flatten(new))
+
+    @classmethod
+    def from_flat(cls, old_flat: Dict[str, Any], new_flat: Dict[str, Any]) -> 'ConfigDiff':
+        """Difference between two already flattened configs, or the flattened parts of them that differ."""
+        diff = cls.__new__(cls)
+        diff.compare(old_flat, new_flat)
+        return diff
+
+    def compare(self, old_flat: Dict[str, Any], new_flat: Dict[str, Any]):
+        self.changed = {path: {'new': new_flat[path], 'prev': value} for path, value in old_flat.items()
+                        if path in new_flat and new_flat[path] != value}
+        self.added = {path: value for path, value in new_flat.items() if path not in old_flat}
+        self.removed = {path: value for path, value in old_flat.items() if path not in new_flat}
+
+    @property
+    def empty(self) -> bool:
+        return not (self.changed or self.added or self.removed)
+
+    def paths(self) -> List[str]:
+        return sorted({*self.changed, *self.added, *self.removed})
+
+    def matches(self, response: dict) -> bool:
+        """Whether the device reported the same key paths as this local diff."""
+        return (set(response.get('keys_changed') or {}) == set(self.changed)
+                and set(response.get('keys_added') or {}) == set(self.added)
+                and set(response.get('keys_removed') or {}) == set(self.removed))
+
+
+class ConfigCache:
+    """Last fetched config per device plus learned reboot behaviour of key paths.
+
+    Args:
+        path: Optional JSON file to keep the cache between runs.
+        max_age: Seconds a cached config may be used instead of GET /config.
+            0 (the default) disables reading configs from the cache, so every
+            push fetches the config. A larger value also saves the GET, at the
+            risk of posting over a change made to the device by someone else
+            in the meantime.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_age: float = 0):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.configs: Dict[str, dict] = {}
+        self.reboot_keys: Dict[str, bool] = {pattern: True for pattern in REBOOT_KEYS}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.configs = data.get('configs', {})
+                self.reboot_keys.update(data.get('reboot_keys', {}))
+            except (OSError, ValueError):
+                pass
+
+    def get(self, ip: str) -> Optional[dict]:
+        """Cached config of a device if it is younger than max_age."""
+        with self.lock:
+            entry = self.configs.get(ip)
+            if entry and time.time() - entry['fetched'] < self.max_age:
+                return entry['config']
+            return None
+
+    def set(self, ip: str, config: dict):
+        with self.lock:
+            self.configs[ip] = {'config': config, 'fetched': time.time()}
+
+    def discard(self, ip: str):
+        with self.lock:
+            self.configs.pop(ip, None)
+
+    def predict_reboot(self, diff: ConfigDiff) -> Optional[bool]:
+        """True if a changed key needs a reboot, False if none does, None if unknown."""
+        with self.lock:
+            known = []
+            for path in diff.paths():
+                pattern = key_pattern(path)
+                reboot = self.reboot_keys.get(pattern)
+                if reboot is None:
+                    reboot = next((value for key, value in self.reboot_keys.items()
+                                   if value and fnmatch.fnmatchcase(pattern, key)), None)
+                known.append(reboot)
+        if any(known):
+            return True
+        return False if all(reboot is False for reboot in known) else None
+
+    def learn(self, diff: ConfigDiff, reboot_required: bool):
+        """Record which key paths needed a reboot, from a POST /config response."""
+        patterns = {key_pattern(path) for path in diff.paths()}
+        with self.lock:
+            if not reboot_required:
+                for pattern in patterns:
+                    self.reboot_keys[pattern] = False
+                return
+            # A reboot can only be attributed to a key if it is the only one not known to be safe
+            unknown = [pattern for pattern in patterns if self.reboot_keys.get(pattern) is not False]
+            if len(unknown) == 1:
+                self.reboot_keys[unknown[0]] = True
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {'configs': self.configs, 'reboot_keys': self.reboot_keys}
+            tmp_path = f"{self.path}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+
+def set_path(config: dict, path: str, value):
+    """Set a dotted key path in a nested config, creating objects as needed.
+
+    A list index one past the end appends, e.g. system.users.4 on a list of four users.
+    """
+    parts = path.split('.')
+    node = config
+    for part in parts[:-1]:
+        if isinstance(node, list):
+            node = node[int(part)]
+        else:
+            node = node.setdefault(part, {})
+    if isinstance(node, list):
+        index = int(parts[-1])
+        if index == len(node):
+            node.append(value)
+        else:
+            node[index] = value
+    else:
+        node[parts[-1]] = value
+
+
+class ConfigError(ApiError):
+    """Error response of POST /config, e.g. status 409 while a config test is in progress."""
+
+    def __init__(self, status: int, details: str):
+        super().__init__(status, details, '/config')
+        self.args = (f"POST /config failed: {details}",)
+
+
+class PushResult:
+    __slots__ = ('ip', 'status', 'diff', 'reboot_predicted', 'reboot_required', 'message')
+
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.status = 'pending'
+        self.diff: Optional[ConfigDiff] = None
+        self.reboot_predicted: Optional[bool] = None
+        self.reboot_required: Optional[bool] = None
+        self.message = ''
+
+
+class ConfigPusher:
+    """Fetch, change, diff and push configs, skipping devices with no real change.
+
+    Args:
+        pool: SessionPool for the devices.
+        cache: ConfigCache shared by all pushes.
+        dry_run: Send changes with dry_run set instead of applying them.
+        allow_reboot: Whether to push changes predicted to need a reboot.
+        probe_unknown: Send a dry run first when the reboot behaviour of a
+            change is unknown, so it is known before the real push.
+        validator: Optional ConfigValidator; configs with errors are not sent.
+    """
+
+    def __init__(self, pool: SessionPool, cache: ConfigCache, dry_run: bool = False, allow_reboot: bool = False,
+                 probe_unknown: bool = False, validator: Optional[ConfigValidator] = None):
+        self.pool = pool
+        self.cache = cache
+        self.dry_run = dry_run
+        self.allow_reboot = allow_reboot
+        self.probe_unknown = probe_unknown
+        self.validator = validator
+
+    def fetch(self, ip: str) -> dict:
+        config = self.cache.get(ip)
+        if config is not None:
+            return config
+        config = self.client(ip).config()
+        self.cache.set(ip, config)
+        return config
+
+    def client(self, ip: str) -> DeviceClient:
+        return DeviceClient(self.pool.get(ip))
+
+    def post(self, ip: str, payload: dict) -> dict:
+        """POST /config with a config or an action, returning the 'response' object.
+
+        Raises:
+            ConfigError: If the device rejects the request.
+        """
+        try:
+            result = self.client(ip).post_config(payload)
+        except ApiError as e:
+            raise ConfigError(e.status, e.details)
+        return result.raw.get('response') or {}
+
+    def prepare(self, ip: str, change: Callable[[dict], Optional[dict]], result: PushResult) -> Optional[dict]:
+        """Fetch, change, diff, validate and predict the reboot behaviour of one device's config.
+
+        Returns:
+            The config to send, or None if there is nothing to send; result.status says why.
+        """
+        current = self.fetch(ip)
+        desired = copy.deepcopy(current)
+        desired = change(desired) or desired
+        result.diff = diff = ConfigDiff(current, desired)
+        if diff.empty:
+            result.status = 'unchanged'
+            result.reboot_predicted = False
+            return None
+        if self.validator:
+            errors = self.validator.check(desired)
+            if errors:
+                result.status = 'invalid'
+                result.message = '; '.join(errors)
+                return None
+
+        result.reboot_predicted = self.cache.predict_reboot(diff)
+        if result.reboot_predicted is None and self.probe_unknown and not self.dry_run:
+            probe = self.post(ip, {'config': desired, 'dry_run': True})
+            self.cache.learn(diff, bool(probe.get('reboot_required')))
+            result.reboot_predicted = bool(probe.get('reboot_required'))
+        if result.reboot_predicted and not self.allow_reboot and not self.dry_run:
+            result.status = 'skipped'
+            result.message = 'change needs a reboot'
+            return None
+        return desired
+
+    def push(self, ip: str, change: Callable[[dict], Optional[dict]]) -> PushResult:
+        """Apply `change` (which edits a config in place or returns a new one) to one device."""
+        result = PushResult(ip)
+        try:
+            desired = self.prepare(ip, change, result)
+            if desired is None:
+                return result
+            diff = result.diff
+            response = self.post(ip, {'config': desired, 'dry_run': self.dry_run})
+            result.reboot_required = bool(response.get('reboot_required'))
+            self.cache.learn(diff, result.reboot_required)
+            if not diff.matches(response):
+                # The device was changed behind our back; don't trust the cached copy
+                self.cache.discard(ip)
+                result.message = 'device reported different keys than the local diff'
+            elif not self.dry_run:
+                self.cache.set(ip, desired)
+            result.status = 'dry run' if self.dry_run else 'pushed'
+        except Exception as e:
+            self.cache.discard(ip)
+            result.status = 'failed'
+            result.message = str(e)
+        return result
+
+    def push_all(self, ips: List[str], change: Callable[[dict], Optional[dict]],
+                 concurrency: int = 10) -> List[PushResult]:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(lambda ip: self.push(ip, change), ips))
+
+
+def parse_assignment(assignment: str):
+    """Parse path=value, with the value read as JSON if possible (e.g. 100, true, "text")."""
+    path, _, raw = assignment.partition('=')
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    return path.strip(), value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push config changes to many Tachyon devices, skipping no-op pushes')
+    parser.add_argument('-u', '--username', type=str, required=True, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, required=True, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to change')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--set', action='append', required=True, metavar='PATH=VALUE',
+                        help='Config key to set, e.g. system.hostname=ap-1 (repeatable)')
+    parser.add_argument('--dry-run', action='store_true', help='Only ask the devices what would change')
+    parser.add_argument('--allow-reboot', action='store_true', help='Also push changes that need a reboot')
+    parser.add_argument('--probe-unknown', action='store_true',
+                        help='Dry run changes with unknown reboot behaviour before pushing them')
+    parser.add_argument('--family', choices=FAMILIES, help='Validate the changed configs against this family\'s keys.html first')
+    parser.add_argument('--spec-version', help='keys.html version used with --family, e.g. v1.0.8 (default: newest)')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='Devices changed at the same time (default: 10)')
+    parser.add_argument('--cache', type=str, help='File used to keep fetched configs and learned reboot keys between runs')
+    parser.add_argument('--max-age', type=float, default=0,
+                        help='Seconds a cached config is used instead of fetching it again (default: 0, which disables it and always fetches)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    if args.ip_file:
+        with open(args.ip_file) as f:
+            ips = [line.strip() for line in f if line.strip()]
+    else:
+        ips = args.ip
+    assignments = [parse_assignment(assignment) for assignment in args.set]
+
+    def change(config: dict):
+        for path, value in assignments:
+            set_path(config, path, value)
+
+    cache = ConfigCache(args.cache, args.max_age)
+    with SessionPool(args.username, args.password, TokenCache(args.token_cache)) as pool:
+        pusher = ConfigPusher(pool, cache, dry_run=args.dry_run, allow_reboot=args.allow_reboot,
+                              probe_unknown=args.probe_unknown,
+                              validator=validator_for(args.family, args.spec_version) if args.family else None)
+        results = pusher.push_all(ips, change, args.concurrency)
+    cache.save()
+    CAPABILITIES.save()
+
+    reboot = {True: 'yes', False: 'no', None: '?'}
+    print(f"{'Device':<20}{'Result':<12}{'Keys':>5}{'Reboot':>8}  Details")
+    for result in results:
+        keys = len(result.diff.paths()) if result.diff else 0
+        needs_reboot = result.reboot_required if result.reboot_required is not None else result.reboot_predicted
+        details = result.message or (', '.join(result.diff.paths()[:3]) if result.diff else '')
+        print(f"{result.ip:<20}{result.status:<12}{keys:>5}{reboot[needs_reboot]:>8}  {details}")
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    print('\n' + ', '.join(f"{count} {status}" for status, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
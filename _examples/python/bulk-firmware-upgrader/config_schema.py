@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Config Schema
+Parses the versioned keys.html listings in this repo (tna_30x/, tna_305/ and
+tns_10x/) into a machine-readable schema of types, allowed values, ranges and
+key dependencies, and compiles it into validators that check configs locally.
+Unlike POST /config, which stops at the first error, a validator reports every
+error of a config, and thousands of configs can be checked without touching a
+device.
+
+Usage:
+    python3 config_schema.py build --out schemas
+    python3 config_schema.py validate --family tna_30x config1.json config2.json
+"""
+
+import argparse
+import html
+import ipaddress
+import json
+import os
+import re
+import sys
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from api_specs import FAMILIES, SPEC_ROOT, _version_key
+
+KEY_RE = re.compile(r"<div class='key-name'>(.*?)</div><div class='key-desc'>(.*?)</div><br/>", re.S)
+ROW_RE = re.compile(r"<td class='label'>(.*?)</td><td class=''>(.*?)</td>", re.S)
+RULE_RE = re.compile(r"<li>(.*?)</li>", re.S)
+REQUIRED_RE = re.compile(r"This config key required to be set when (.+), and will be ignored otherwise")
+INVALID_RE = re.compile(r"This config key is invalid when set to the following value\(s\): (.+?), "
+                        r"while the following key\(s\) are set: (.+?)\.?$")
+HOSTNAME_RE = re.compile(r'^(?=.{1,253}$)[A-Za-z0-9]([A-Za-z0-9-]{0,62}[A-Za-z0-9])?'
+                         r'(\.[A-Za-z0-9]([A-Za-z0-9-]{0,62}[A-Za-z0-9])?)*$')
+OID_RE = re.compile(r'^\.?\d+(\.\d+)*$')
+
+
+def key_pattern(name: str) -> str:
+    """Turn a keys.html key name into a config path pattern.
+
+    system.users.user[x].username -> system.users.*.username, and the *x used by
+    dependencies on a field of the same list entry -> *.
+    """
+    return re.sub(r'\.\w+\[x\]|\.\*x', '.*', name)
+
+
+def parse_conditions(text: str) -> List[Tuple[str, str]]:
+    """Parse 'a.b=true and c.d=ap' into [('a.b', 'true'), ('c.d', 'ap')]."""
+    conditions = []
+    for part in text.split(' and '):
+        path, _, value = part.strip().partition('=')
+        conditions.append((key_pattern(path.strip()), value.strip()))
+    return conditions
+
+
+def parse_value(text: str, value_type: str):
+    """Convert a default, limit or allowed value from keys.html to the key's type."""
+    if value_type == 'bool' and text in ('true', 'false'):
+        return text == 'true'
+    if re.fullmatch(r'-?\d+', text) and value_type not in ('string', 'hostname'):
+        return int(text)
+    if re.fullmatch(r'-?\d+\.\d+', text) and value_type not in ('string', 'hostname'):
+        return float(text)
+    return text
+
+
+def parse_keys_html(path: str) -> Dict[str, dict]:
+    """Parse one keys.html into {pattern: key schema}."""
+    with open(path) as f:
+        content = f.read()
+    schema = {}
+    for name, body in KEY_RE.findall(content):
+        name = html.unescape(name).strip()
+        rows = {html.unescape(label).strip(): html.unescape(value).strip() for label, value in ROW_RE.findall(body)}
+        value_type = rows.get('Value type', 'string')
+        key = {'name': name}
+        if value_type.startswith('array of type:'):
+            key['type'] = 'array'
+            key['items'] = value_type.split(':', 1)[1].strip()
+        else:
+            key['type'] = value_type
+        if 'Default' in rows:
+            key['default'] = parse_value(rows['Default'], value_type)
+        for label, field in (('Min value', 'min'), ('Max value', 'max'),
+                             ('Min length', 'min_length'), ('Max length', 'max_length')):
+            limit = parse_value(rows.get(label, ''), 'int')
+            if isinstance(limit, (int, float)):  # some limits are listed as 'nil'
+                key[field] = limit
+        if rows.get('Allowed values'):
+            key['enum'] = [parse_value(value.strip(), value_type) for value in rows['Allowed values'].split(',')]
+
+        for rule in RULE_RE.findall(body):
+            rule = ' '.join(html.unescape(re.sub(r'<[^>]+>', '', rule)).split())
+            required = REQUIRED_RE.match(rule)
+            invalid = INVALID_RE.match(rule)
+            if required:
+                key.setdefault('required_when', []).append(parse_conditions(required.group(1)))
+            elif invalid:
+                key.setdefault('invalid_when', []).append({
+                    'values': [parse_value(value.strip(), value_type) for value in invalid.group(1).split(',')],
+                    'conditions': parse_conditions(invalid.group(2)),
+                })
+            else:
+                key.setdefault('rules', []).append(rule)
+        schema[key_pattern(name)] = key
+    return schema
+
+
+def schema_versions(family: str, root: str = SPEC_ROOT) -> List[str]:
+    """Versions of a family that ship a keys.html, oldest first."""
+    directory = os.path.join(root, family)
+    if not os.path.isdir(directory):
+        return []
+    versions = [name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name, 'keys.html'))]
+    return sorted(versions, key=_version_key)
+
+
+@lru_cache(maxsize=None)
+def load_schema(family: str, version: Optional[str] = None, schema_dir: Optional[str] = None,
+                root: str = SPEC_ROOT) -> Dict[str, dict]:
+    """Schema of one family and version (default: newest), from a built JSON file if present, else keys.html."""
+    version = version or schema_versions(family, root)[-1]
+    if schema_dir:
+        built = os.path.join(schema_dir, f"{family}-{version}.json")
+        if os.path.exists(built):
+            with open(built) as f:
+                return json.load(f)
+    return parse_keys_html(os.path.join(root, family, version, 'keys.html'))
+
+
+def build_schemas(out_dir: str, root: str = SPEC_ROOT) -> List[str]:
+    """Write <family>-<version>.json for every keys.html in the repo."""
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for family in FAMILIES:
+        for version in schema_versions(family, root):
+            path = os.path.join(out_dir, f"{family}-{version}.json")
+            with open(path, 'w') as f:
+                json.dump(parse_keys_html(os.path.join(root, family, version, 'keys.html')), f, indent=1, sort_keys=True)
+            written.append(path)
+    return written
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_ip(value, version: Optional[int] = None) -> bool:
+    try:
+        address = ipaddress.ip_address(value)
+    except (TypeError, ValueError):
+        return False
+    return version is None or address.version == version
+
+
+TYPE_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    'int': _is_int,
+    'bool': lambda value: isinstance(value, bool),
+    'string': lambda value: isinstance(value, str),
+    'timezone': lambda value: isinstance(value, str),
+    'country': lambda value: isinstance(value, str) and len(value) == 2,
+    'hostname': lambda value: isinstance(value, str) and (bool(HOSTNAME_RE.match(value)) or _is_ip(value)),
+    'ipv4addr': lambda value: _is_ip(value, 4),
+    'ipv6addr': lambda value: _is_ip(value, 6),
+    'ipv4addr_or_ipv6addr': _is_ip,
+    'vlan_id': lambda value: _is_int(value) and 1 <= value <= 4094,
+    'oid_prefix': lambda value: isinstance(value, str) and bool(OID_RE.match(value)),
+    'latitude': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool) and -90 <= value <= 90,
+    'longitude': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool) and -180 <= value <= 180,
+    '5_freq': _is_int,
+}
+
+
+def _as_text(value) -> str:
+    """Config value as written in keys.html conditions (true/false for booleans)."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def walk(config: Any, path: str = '') -> Iterator[Tuple[str, str, Any]]:
+    """Yield (path, pattern, value) for every object, list and value in a config."""
+    if path:
+        yield path, re.sub(r'(?<=\.)\d+(?=\.|$)', '*', path), config
+    if isinstance(config, dict):
+        for key, value in config.items():
+            yield from walk(value, f"{path}.{key}" if path else str(key))
+    elif isinstance(config, list) and any(isinstance(item, dict) for item in config):
+        for index, value in enumerate(config):
+            yield from walk(value, f"{path}.{index}")
+
+
+def _resolve(pattern: str, indices: List[str]) -> str:
+    """Fill the * of a pattern with the list indices of the key being checked."""
+    for index in indices:
+        pattern = pattern.replace('*', index, 1)
+    return pattern
+
+
+def _conditions_hold(conditions: List[Tuple[str, str]], values: Dict[str, Any], indices: List[str]) -> bool:
+    for pattern, expected in conditions:
+        path = _resolve(pattern, indices)
+        if path not in values or _as_text(values[path]) != expected:
+            return False
+    return True
+
+
+def _active_station_profile(path: str, profiles, values: Dict[str, Any]) -> Optional[str]:
+    if values.get(f"{path.rsplit('.', 1)[0]}.enabled") is not True:
+        return None
+    # keys.html lists no enabled key for a profile, so a profile without one counts as active
+    if any(isinstance(profile, dict) and profile.get('enabled', True) is True for profile in profiles or []):
+        return None
+    return 'station profiles are enabled but none is active'
+
+
+# Add'l validation rules that are written as prose rather than key=value conditions
+CUSTOM_RULES: Dict[str, Callable[[str, Any, Dict[str, Any]], Optional[str]]] = {
+    'There must be at least one admin type user enabled at any give time.':
+        lambda path, users, values: None if any(isinstance(user, dict) and user.get('type') == 'admin'
+                                                and user.get('enabled') for user in users or []) else
+        'no enabled admin user',
+    'There must be at least one profile active if station profiles are enabled.': _active_station_profile,
+}
+
+
+def _when_required(check: Callable[[str, Any, Dict[str, Any]], Optional[str]],
+                   required_when: List[List[Tuple[str, str]]]) -> Callable[[str, Any, Dict[str, Any]], Optional[str]]:
+    """Skip `check` unless the key is in effect; a key 'required to be set when ...' is ignored otherwise."""
+    if not required_when:
+        return check
+
+    def check_when_required(path, value, values):
+        indices = re.findall(r'\.(\d+)(?=\.|$)', path)
+        if any(_conditions_hold(conditions, values, indices) for conditions in required_when):
+            return check(path, value, values)
+        return None
+    return check_when_required
+
+
+class ConfigValidator:
+    """Validator compiled from a schema; check() returns every error of a config.
+
+    Lengths and prose rules of a key that is only required when other keys are
+    set are not checked otherwise, since the device ignores the key then:
+
+    >>> validator = ConfigValidator(load_schema('tna_30x', 'v1.0.8'))
+    >>> validator.check({'wireless': {'radios': {'wlan0': {'sta_profiles': {'enabled': False, 'profiles': []}}}}})
+    []
+    >>> for error in validator.check({'wireless': {'radios': {'wlan0': {'sta_profiles': {'enabled': True}}}}}):
+    ...     print(error)
+    wireless.radios.wlan0.sta_profiles.profiles: required when wireless.radios.wlan0.sta_profiles.enabled=true
+    >>> for error in validator.check({'wireless': {'radios': {'wlan0': {'sta_profiles': {'enabled': True,
+    ...                                                                                  'profiles': []}}}}}):
+    ...     print(error)
+    wireless.radios.wlan0.sta_profiles.profiles: length 0 is outside 1..8
+    wireless.radios.wlan0.sta_profiles.profiles: station profiles are enabled but none is active
+
+    Args:
+        schema: Schema from load_schema() or parse_keys_html().
+        strict: Also report config keys that are not in the schema.
+    """
+
+    def __init__(self, schema: Dict[str, dict], strict: bool = False):
+        self.strict = strict
+        self.checks: Dict[str, List[Callable[[str, Any, Dict[str, Any]], Optional[str]]]] = {}
+        self.required: List[Tuple[str, List[List[Tuple[str, str]]]]] = []
+        for pattern, key in schema.items():
+            self.checks[pattern] = self.compile_key(key)
+            # A missing key with a default is filled in by the device, so only keys without one are required
+            if key.get('required_when') and 'default' not in key:
+                self.required.append((pattern, key['required_when']))
+        # Patterns of the containers of known keys, so strict mode doesn't flag e.g. 'system'
+        self.containers = {pattern.rsplit('.', i)[0] for pattern in schema for i in range(1, pattern.count('.') + 1)}
+
+    @staticmethod
+    def compile_key(key: dict) -> List[Callable[[str, Any, Dict[str, Any]], Optional[str]]]:
+        """Build the list of checks for one key; each returns an error message or None."""
+        checks = []
+        value_type = key['type']
+        if value_type == 'array':
+            item_check = TYPE_CHECKS.get(key['items'], lambda item: isinstance(item, dict))
+
+            def check_type(path, value, values):
+                if not isinstance(value, list):
+                    return f"expected an array of {key['items']}, got {type(value).__name__}"
+                bad = [item for item in value if not item_check(item)]
+                return f"invalid {key['items']} entries: {bad[:3]}" if bad else None
+            checks.append(check_type)
+        elif value_type in TYPE_CHECKS:
+            type_check = TYPE_CHECKS[value_type]
+            checks.append(lambda path, value, values: None if type_check(value) else
+                          f"expected {value_type}, got {json.dumps(value)}")
+
+        if 'enum' in key:
+            allowed = {_as_text(value) for value in key['enum']}
+            checks.append(lambda path, value, values: None if _as_text(value) in allowed else
+                          f"{json.dumps(value)} is not one of {', '.join(map(_as_text, key['enum']))}")
+        if 'min' in key or 'max' in key:
+            low, high = key.get('min'), key.get('max')
+
+            def check_range(path, value, values):
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    return None
+                if (low is not None and value < low) or (high is not None and value > high):
+                    return f"{value} is outside {low if low is not None else ''}..{high if high is not None else ''}"
+                return None
+            checks.append(check_range)
+        if 'min_length' in key or 'max_length' in key:
+            shortest, longest = key.get('min_length', 0), key.get('max_length')
+
+            def check_length(path, value, values):
+                if not isinstance(value, (str, list)):
+                    return None
+                if len(value) < shortest or (longest is not None and len(value) > longest):
+                    return f"length {len(value)} is outside {shortest}..{longest if longest is not None else ''}"
+                return None
+            checks.append(_when_required(check_length, key.get('required_when')))
+        for rule in key.get('invalid_when', []):
+            invalid = {_as_text(value) for value in rule['values']}
+            conditions = rule['conditions']
+
+            def check_invalid(path, value, values, invalid=invalid, conditions=conditions):
+                if _as_text(value) in invalid and _conditions_hold(conditions, values, re.findall(r'\.(\d+)(?=\.|$)', path)):
+                    return (f"{_as_text(value)} is not allowed while "
+                            + ' and '.join(f"{name}={expected}" for name, expected in conditions))
+                return None
+            checks.append(check_invalid)
+        for rule in key.get('rules', []):
+            if rule in CUSTOM_RULES:
+                checks.append(_when_required(CUSTOM_RULES[rule], key.get('required_when')))
+        return checks
+
+    def check(self, config: dict) -> List[str]:
+        """Return all errors of one config as 'path: message' strings."""
+        if 'config' in config and isinstance(config['config'], dict):
+            config = config['config']  # a GET /config response
+        errors = []
+        values = {}
+        nodes = list(walk(config))
+        for path, pattern, value in nodes:
+            values[path] = value
+        for path, pattern, value in nodes:
+            checks = self.checks.get(pattern)
+            if checks is None:
+                if self.strict and pattern not in self.containers:
+                    errors.append(f"{path}: unknown key")
+                continue
+            for check in checks:
+                error = check(path, value, values)
+                if error:
+                    errors.append(f"{path}: {error}")
+
+        for pattern, rules in self.required:
+            for indices in self.list_indices(pattern, values):
+                path = _resolve(pattern, indices)
+                if path in values:
+                    continue
+                for conditions in rules:
+                    if _conditions_hold(conditions, values, indices):
+                        errors.append(f"{path}: required when "
+                                      + ' and '.join(f"{_resolve(name, indices)}={expected}"
+                                                     for name, expected in conditions))
+                        break
+        return errors
+
+    @staticmethod
+    def list_indices(pattern: str, values: Dict[str, Any]) -> List[List[str]]:
+        """All index combinations of the existing list entries a pattern with * can refer to."""
+        combinations = [[]]
+        parts = pattern.split('.*')
+        for depth in range(len(parts) - 1):
+            expanded = []
+            for indices in combinations:
+                parent = _resolve('.*'.join(parts[:depth + 1]), indices)
+                entries = values.get(parent)
+                if isinstance(entries, list):
+                    expanded.extend(indices + [str(index)] for index in range(len(entries)))
+            combinations = expanded
+        return combinations
+
+    def check_many(self, configs: Dict[str, dict]) -> Dict[str, List[str]]:
+        """Validate many configs, returning the errors of each invalid one by name."""
+        results = {}
+        for name, config in configs.items():
+            errors = self.check(config)
+            if errors:
+                results[name] = errors
+        return results
+
+
+@lru_cache(maxsize=None)
+def validator_for(family: str, version: Optional[str] = None, strict: bool = False,
+                  schema_dir: Optional[str] = None) -> ConfigValidator:
+    return ConfigValidator(load_schema(family, version, schema_dir), strict)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build config schemas from keys.html and validate configs offline')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Write a JSON schema for every keys.html in the repo')
+    build.add_argument('--out', default='schemas', help='Output directory (default: schemas)')
+    validate = commands.add_parser('validate', help='Validate config files')
+    validate.add_argument('--family', required=True, choices=FAMILIES, help='Product family of the configs')
+    validate.add_argument('--version', help='Spec version, e.g. v1.0.8 (default: newest)')
+    validate.add_argument('--schema-dir', help='Directory with schemas written by build (default: parse keys.html)')
+    validate.add_argument('--strict', action='store_true', help='Also report keys that are not in the schema')
+    validate.add_argument('configs', nargs='+',
+                          help='JSON files holding a config, a GET /config response or a list of configs')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for path in build_schemas(args.out):
+            print(path)
+        return
+
+    validator = validator_for(args.family, args.version, args.strict, args.schema_dir)
+    configs = {}
+    for path in args.configs:
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            configs.update((f"{path}[{index}]", config) for index, config in enumerate(data))
+        else:
+            configs[path] = data
+    results = validator.check_many(configs)
+    for name, errors in results.items():
+        print(f"{name}: {len(errors)} error(s)")
+        for error in errors:
+            print(f"\t{error}")
+    print(f"{len(configs) - len(results)} of {len(configs)} config(s) valid")
+    sys.exit(1 if results else 0)
+
+
+if __name__ == "__main__":
+    main()
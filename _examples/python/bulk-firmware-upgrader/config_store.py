@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Config Store
+Content-addressed history of device configs. Every object and every
+non-scalar list in a config is stored as its own node, named by the hash of
+its leaves and of the hashes of its children, so a subtree shared by many
+devices or by many days - services, wireless defaults - is stored once,
+zlib-compressed, and a snapshot of a device is one row with its root hash.
+
+Two snapshots are diffed by walking both trees from the root and descending
+only where the hashes differ: unchanged devices cost one comparison, and a
+changed one only the nodes on the way to its changes. The result is a
+ConfigDiff with the same key paths as config_diff.py and POST /config.
+
+Usage: python3 config_store.py -u root -p admin -if ips.txt --store configs.db --since 7d
+"""
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from async_client import AsyncDeviceSession
+from config_diff import ConfigDiff, flatten
+from tachyon_client import ApiError, AsyncDeviceClient
+from tachyon_session import AuthenticationError, TokenCache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    address TEXT NOT NULL,
+    taken REAL NOT NULL,
+    root TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_address ON snapshots (address, taken);
+'''
+SNAPSHOT_COLUMNS = ('id', 'address', 'taken', 'root', 'size')
+MISSING = object()  # a key a node doesn't have, told apart from a null leaf
+# Decoded nodes kept in memory for diffs; shared subtrees are read once
+NODE_CACHE_SIZE = 100000
+
+
+def canonical(value: Any) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+
+
+def is_subtree(value: Any) -> bool:
+    """Whether a value gets a node of its own: a non-empty object, or a non-empty list of anything but scalars.
+
+    Lists of scalars such as DNS servers stay inline in their parent, like every other leaf.
+    """
+    if isinstance(value, dict):
+        return bool(value)
+    return isinstance(value, list) and any(isinstance(item, (dict, list)) for item in value)
+
+
+class Snapshot:
+    """The config of one device at one time, by the hash of its root node."""
+
+    __slots__ = SNAPSHOT_COLUMNS
+
+    def __init__(self, *values):
+        for name, value in zip(SNAPSHOT_COLUMNS, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"Snapshot(id={self.id}, address={self.address!r}, root={self.root[:12]})"
+
+
+class ConfigStore:
+    """Deduplicated config snapshots in a SQLite file.
+
+    A node is {'t': 'd' or 'l', 'v': {key: leaf}, 'c': {key: child hash}}, with
+    list indices as keys in 'l' nodes; its hash is the SHA-256 of its canonical
+    JSON, which is what is stored, compressed.
+
+    Args:
+        path: SQLite file, created if missing; ':memory:' for one run only.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        # Hashes known to be stored, so a shared subtree is only written once per run
+        self.stored = set()
+        self.nodes: Dict[str, dict] = {}
+
+    # ----- writing -----
+
+    def put(self, config: Any) -> str:
+        """Store a config, or any subtree of one, and return the hash of its root node."""
+        with self.lock:
+            return self.write(lambda: self.put_node(config))
+
+    def write(self, action: Callable[[], Any]) -> Any:
+        """Run `action` in one transaction; if it is rolled back, forget which hashes it stored."""
+        try:
+            with self.db:
+                return action()
+        except BaseException:
+            self.stored.clear()
+            raise
+
+    def put_node(self, value: Any) -> str:
+        node = {'t': 'd' if isinstance(value, dict) else 'l', 'v': {}, 'c': {}}
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        for key, item in items:
+            if is_subtree(item):
+                node['c'][str(key)] = self.put_node(item)
+            else:
+                node['v'][str(key)] = item
+        data = canonical(node)
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.stored:
+            self.db.execute('INSERT OR IGNORE INTO objects VALUES (?, ?)', (digest, zlib.compress(data, 6)))
+            self.stored.add(digest)
+        return digest
+
+    def add(self, ip: str, config: dict, taken: Optional[float] = None) -> Snapshot:
+        """Record a snapshot of a device's config."""
+        taken = time.time() if taken is None else taken
+        size = len(canonical(config))
+
+        def insert():
+            root = self.put_node(config)
+            cursor = self.db.execute('INSERT INTO snapshots (address, taken, root, size) VALUES (?, ?, ?, ?)',
+                                     (ip, taken, root, size))
+            return Snapshot(cursor.lastrowid, ip, taken, root, size)
+        with self.lock:
+            return self.write(insert)
+
+    # ----- reading -----
+
+    def node(self, digest: str) -> dict:
+        node = self.nodes.get(digest)
+        if node is None:
+            with self.lock:
+                row = self.db.execute('SELECT data FROM objects WHERE hash = ?', (digest,)).fetchone()
+            if row is None:
+                raise KeyError(f"object {digest} not in {self.path}")
+            node = json.loads(zlib.decompress(row[0]))
+            if len(self.nodes) >= NODE_CACHE_SIZE:
+                self.nodes.clear()
+            self.nodes[digest] = node
+        return node
+
+    def get(self, digest: str) -> Any:
+        """The config, or subtree, stored under a hash."""
+        node = self.node(digest)
+        entries = dict(node['v'])
+        entries.update((key, self.get(child)) for key, child in node['c'].items())
+        if node['t'] == 'l':
+            return [entries[key] for key in sorted(entries, key=int)]
+        return entries
+
+    def snapshot(self, snapshot_id: int) -> Optional[Snapshot]:
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM snapshots WHERE id = ?",
+                                  (snapshot_id,)).fetchone()
+        return Snapshot(*row) if row else None
+
+    def history(self, ip: str) -> List[Snapshot]:
+        """The snapshots of a device, oldest first."""
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM snapshots WHERE address = ? "
+                                   f"ORDER BY taken, id", (ip,)).fetchall()
+        return [Snapshot(*row) for row in rows]
+
+    def added(self, after: int = 0) -> List[Snapshot]:
+        """The snapshots recorded after the one with id `after`, in the order they were."""
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM snapshots WHERE id > ? ORDER BY id",
+                                   (after,)).fetchall()
+        return [Snapshot(*row) for row in rows]
+
+    def latest(self, before: Optional[float] = None) -> Dict[str, Snapshot]:
+        """The last snapshot of every device, or the last one taken at or before `before`."""
+        where = 'WHERE taken <= ?' if before is not None else ''
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM snapshots {where} ORDER BY taken, id",
+                                   (before,) if before is not None else ()).fetchall()
+        return {row[1]: Snapshot(*row) for row in rows}
+
+    def usage(self) -> Tuple[int, int, int, int]:
+        """(snapshots, their JSON size, objects, their stored size) in bytes."""
+        with self.lock:
+            snapshots, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM snapshots').fetchone()
+            objects, stored = self.db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM objects').fetchone()
+        return snapshots, size, objects, stored
+
+    # ----- diffing -----
+
+    def diff(self, old: str, new: str) -> ConfigDiff:
+        """Difference between the configs under two root hashes, descending only into changed subtrees."""
+        old_flat, new_flat = {}, {}
+        if old != new:
+            self.diff_nodes(old, new, '', old_flat, new_flat)
+        return ConfigDiff.from_flat(old_flat, new_flat)
+
+    def diff_nodes(self, old: str, new: str, prefix: str, old_flat: dict, new_flat: dict):
+        """Collect the flattened leaves that differ between two nodes under `prefix`."""
+        old_node, new_node = self.node(old), self.node(new)
+        if old_node['t'] != new_node['t']:
+            old_flat.update(flatten(self.get(old), prefix))
+            new_flat.update(flatten(self.get(new), prefix))
+            return
+        is_list = old_node['t'] == 'l'
+        for key in {*old_node['v'], *old_node['c'], *new_node['v'], *new_node['c']}:
+            path = f"{prefix}.{key}" if prefix else key
+            old_child, new_child = old_node['c'].get(key), new_node['c'].get(key)
+            if old_child is not None and new_child is not None:
+                if old_child == new_child:
+                    continue
+                if not is_list:
+                    self.diff_nodes(old_child, new_child, path, old_flat, new_flat)
+                    continue
+            elif old_child is None and new_child is None and old_node['v'].get(key, MISSING) == \
+                    new_node['v'].get(key, MISSING):
+                continue
+            # A list entry is one leaf, as in flatten(); anything else is flattened below its path
+            for node, child, flat in ((old_node, old_child, old_flat), (new_node, new_child, new_flat)):
+                if child is not None:
+                    value = self.get(child)
+                elif key in node['v']:
+                    value = node['v'][key]
+                else:
+                    continue
+                flat.update({path: value} if is_list else flatten(value, path))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ConfigFetcher:
+    """Fetch the config of many devices at once and record a snapshot of each.
+
+    Args:
+        store: ConfigStore the snapshots go to.
+        username: Login username.
+        password: Login password.
+        timeout: Per-request timeout in seconds.
+        max_in_flight: Maximum number of devices fetched at once.
+        token_cache: Optional TokenCache shared with other tools.
+    """
+
+    def __init__(self, store: ConfigStore, username: str, password: str, timeout: float = 10,
+                 max_in_flight: int = 200, token_cache: Optional[TokenCache] = None):
+        self.store = store
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.token_cache = token_cache or TokenCache()
+        self.snapshots: Dict[str, Snapshot] = {}
+        self.errors: Dict[str, str] = {}
+
+    async def fetch_device(self, ip: str, semaphore: asyncio.Semaphore):
+        client = AsyncDeviceClient(AsyncDeviceSession(ip, self.username, self.password, self.token_cache,
+                                                      timeout=self.timeout))
+        async with semaphore:
+            try:
+                config = await client.config()
+                self.snapshots[ip] = self.store.add(ip, config)
+            except (ApiError, AuthenticationError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.errors[ip] = str(e) or type(e).__name__
+            finally:
+                await client.session.close()
+
+    async def run(self, ips: List[str]):
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        await asyncio.gather(*(self.fetch_device(ip, semaphore) for ip in dict.fromkeys(ips)))
+
+
+def import_files(store: ConfigStore, paths: List[str]) -> int:
+    """Record the <ip>-config.json files written by config-fetch.sh, taken at their modification time."""
+    imported = 0
+    for path in paths:
+        match = re.match(r'(.+)-config\.json$', os.path.basename(path))
+        if not match:
+            print(f"Skipping {path}: not named <ip>-config.json", file=sys.stderr)
+            continue
+        with open(path) as f:
+            data = json.load(f)
+        store.add(match.group(1), data.get('config', data), os.path.getmtime(path))
+        imported += 1
+    return imported
+
+
+def parse_age(age: str) -> float:
+    """Seconds in an age such as 7d, 12h, 30m or 90 (seconds)."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if age and age[-1] in units:
+        return float(age[:-1]) * units[age[-1]]
+    return float(age)
+
+
+def describe(diff: ConfigDiff, limit: int = 3) -> str:
+    paths = diff.paths()
+    return ', '.join(paths[:limit]) + (f" (+{len(paths) - limit} more)" if len(paths) > limit else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep a deduplicated history of the configs of many Tachyon devices')
+    parser.add_argument('-u', '--username', type=str, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to fetch')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--store', type=str, required=True, help='SQLite file the snapshots are kept in')
+    parser.add_argument('--import', dest='import_files', nargs='+', metavar='FILE',
+                        help='Record <ip>-config.json files written by config-fetch.sh')
+    parser.add_argument('--since', type=str,
+                        help='Diff the last snapshot of every device against the one from this long ago, e.g. 7d')
+    parser.add_argument('--diff', nargs=2, type=int, metavar=('OLD', 'NEW'), help='Diff two snapshots by id')
+    parser.add_argument('--history', type=str, metavar='IP', help='List the snapshots of a device')
+    parser.add_argument('--show', type=int, metavar='ID', help='Print the config of a snapshot')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds (default: 10)')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='Maximum devices fetched at once (default: 200)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    args = parser.parse_args()
+
+    store = ConfigStore(args.store)
+    if args.import_files:
+        paths = [path for pattern in args.import_files for path in sorted(glob.glob(pattern)) or [pattern]]
+        print(f"Imported {import_files(store, paths)} config file(s)", file=sys.stderr)
+    if args.ip or args.ip_file:
+        if not (args.username and args.password):
+            parser.error('-u and -p are required to fetch configs')
+        if args.ip_file:
+            with open(args.ip_file) as f:
+                ips = [line.strip() for line in f if line.strip()]
+        else:
+            ips = args.ip
+        fetcher = ConfigFetcher(store, args.username, args.password, timeout=args.timeout,
+                                max_in_flight=args.max_in_flight, token_cache=TokenCache(args.token_cache))
+        started = time.monotonic()
+        asyncio.run(fetcher.run(ips))
+        print(f"Fetched {len(fetcher.snapshots)} config(s) in {time.monotonic() - started:.1f}s", file=sys.stderr)
+        for ip, error in fetcher.errors.items():
+            print(f"[{ip}] ✗ {error}", file=sys.stderr)
+
+    if args.history:
+        print(f"{'Id':>6}  {'Taken':<20}{'Root':<14}{'Size':>8}  Changes")
+        previous = None
+        for snapshot in store.history(args.history):
+            changes = describe(store.diff(previous.root, snapshot.root)) if previous else ''
+            print(f"{snapshot.id:>6}  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot.taken)):<20}"
+                  f"{snapshot.root[:12]:<14}{snapshot.size:>8}  {changes}")
+            previous = snapshot
+    if args.diff:
+        old, new = store.snapshot(args.diff[0]), store.snapshot(args.diff[1])
+        if old is None or new is None:
+            parser.error(f"No snapshot {args.diff[0] if old is None else args.diff[1]} in {args.store}")
+        diff = store.diff(old.root, new.root)
+        for path in diff.paths():
+            if path in diff.changed:
+                print(f"~ {path}: {json.dumps(diff.changed[path]['prev'])} -> {json.dumps(diff.changed[path]['new'])}")
+            elif path in diff.added:
+                print(f"+ {path}: {json.dumps(diff.added[path])}")
+            else:
+                print(f"- {path}: {json.dumps(diff.removed[path])}")
+    if args.show is not None:
+        snapshot = store.snapshot(args.show)
+        if snapshot is None:
+            parser.error(f"No snapshot {args.show} in {args.store}")
+        print(json.dumps(store.get(snapshot.root), indent=2))
+    if args.since:
+        started = time.monotonic()
+        latest = store.latest()
+        earlier = store.latest(time.time() - parse_age(args.since))
+        changed = 0
+        print(f"{'Device':<20}{'Keys':>5}  Changes")
+        for ip, snapshot in sorted(latest.items()):
+            if ip not in earlier:
+                print(f"{ip:<20}{'-':>5}  no snapshot {args.since} ago")
+                continue
+            diff = store.diff(earlier[ip].root, snapshot.root)
+            if not diff.empty:
+                changed += 1
+                print(f"{ip:<20}{len(diff.paths()):>5}  {describe(diff)}")
+        print(f"\n{changed} of {len(latest)} device(s) changed in {args.since}, "
+              f"diffed in {(time.monotonic() - started) * 1000:.0f}ms", file=sys.stderr)
+
+    snapshots, size, objects, stored = store.usage()
+    print(f"{snapshots} snapshot(s) of {size / 1e6:.1f} MB of JSON stored as {objects} object(s) "
+          f"in {stored / 1e6:.2f} MB", file=sys.stderr)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Config Test Run
+Rolls a config change out to many devices as a POST /config test run. Tests
+are started on all devices in parallel, and while they are active every
+device is probed for health: it is still reachable, its wireless peers are
+still connected and their link rates are within tolerance of what they were
+before the change. Healthy devices are confirmed and the others aborted
+before the test times out, so the whole fleet is done within one test window.
+
+Usage: python3 config_test_run.py -u root -p admin -if ips.txt --set network.general.mtu=1500 --test-duration 120
+"""
+
+import argparse
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+from api_specs import FAMILIES
+from config_diff import ConfigCache, ConfigError, ConfigPusher, PushResult, parse_assignment, set_path
+from config_schema import validator_for
+from tachyon_client import CAPABILITIES, Model
+from tachyon_session import SessionPool, TokenCache
+from wait_scheduler import SCHEDULER, WaitScheduler, WaitTimeout
+
+CONFLICT_ACTIONS = ('skip', 'abort', 'wait')
+
+
+class TestRunDevice(PushResult):
+    """Test run state of one device, on top of the PushResult of its change."""
+
+    __slots__ = ('family', 'desired', 'baseline', 'started', 'deadline', 'passes', 'unhealthy_since', 'remaining',
+                 'waiting')
+
+    def __init__(self, ip: str):
+        super().__init__(ip)
+        self.family: Optional[str] = None
+        self.desired: Optional[dict] = None
+        self.baseline: Dict[str, tuple] = {}
+        self.started = 0.0
+        self.deadline = 0.0
+        self.passes = 0
+        self.unhealthy_since: Optional[float] = None
+        self.remaining: Optional[int] = None
+        # End of another test the device is waiting for (on_conflict='wait')
+        self.waiting: Optional[Future] = None
+
+
+class TestRunOrchestrator:
+    """Start config test runs in parallel, probe device health and confirm or abort each test.
+
+    Args:
+        pusher: ConfigPusher used to fetch, diff, validate and post configs.
+        test_duration: Test duration in seconds; the device reverts if the test
+            is not confirmed in time.
+        probe_interval: Seconds between health probes of a device.
+        settle: Seconds to wait after starting a test before the first probe,
+            while the device restarts its network services.
+        passes: Consecutive healthy probes needed to confirm.
+        rate_tolerance: Allowed drop of a peer's tx/rx link rate compared to
+            before the change, e.g. 0.3 for 30%.
+        margin: Abort tests that are not healthy this many seconds before
+            they would time out.
+        on_conflict: What to do when a device already has a test running
+            (409): 'skip' the device, 'abort' the other test and retry, or
+            'wait' for it to end and retry. Waiting devices don't hold up the
+            others.
+        concurrency: Devices started or probed at the same time.
+        scheduler: WaitScheduler polling tests that are in the way until they end.
+    """
+
+    def __init__(self, pusher: ConfigPusher, test_duration: int = 120, probe_interval: float = 10, settle: float = 15,
+                 passes: int = 2, rate_tolerance: float = 0.3, margin: float = 20, on_conflict: str = 'skip',
+                 concurrency: int = 50, scheduler: Optional[WaitScheduler] = None):
+        self.pusher = pusher
+        self.pool = pusher.pool
+        self.test_duration = test_duration
+        self.probe_interval = probe_interval
+        self.settle = settle
+        self.passes = passes
+        self.rate_tolerance = rate_tolerance
+        self.margin = margin
+        self.on_conflict = on_conflict
+        self.concurrency = concurrency
+        self.scheduler = scheduler or SCHEDULER
+        self.devices: Dict[str, TestRunDevice] = {}
+
+    def test_status(self, ip: str) -> Model:
+        """GET /config?target=test, e.g. TestStatus(running=True, timeout=290)."""
+        return self.pusher.client(ip).test_status(timeout=5)
+
+    def peers(self, device: TestRunDevice) -> Dict[str, tuple]:
+        """Connected wireless peers of a device as {mac: (tx_rate, rx_rate)}."""
+        wireless = self.pusher.client(device.ip).stats('wireless', timeout=5).wireless
+        peers = wireless.peers if wireless else None
+        return {peer.get('mac'): (peer.get('tx_rate') or 0, peer.get('rx_rate') or 0)
+                for peer in peers or [] if peer.get('mac')}
+
+    def start(self, device: TestRunDevice, change: Callable[[dict], Optional[dict]]):
+        """Resolve a test already running, prepare the change, record the health baseline and start the test run.
+
+        With on_conflict='wait' the device is left 'waiting' for the other
+        test to end, and start() is called again once it has.
+        """
+        try:
+            client = self.pusher.client(device.ip)
+            if device.waiting is not None:
+                waiting, device.waiting = device.waiting, None
+                try:
+                    waiting.result()
+                except WaitTimeout:
+                    device.status = 'skipped'
+                    device.message = 'another config test is still in progress'
+                    return
+                self.pusher.cache.discard(device.ip)  # the cached config may be the other test's
+            elif not client.supports('POST', 'config', 'test_run'):
+                device.status = 'skipped'
+                device.message = 'the device\'s firmware does not support config test runs'
+                return
+            elif self.test_status(device.ip).get('running'):
+                if self.on_conflict == 'skip':
+                    device.status = 'skipped'
+                    device.message = 'another config test is in progress'
+                    return
+                if self.on_conflict == 'abort':
+                    self.pusher.post(device.ip, {'action': 'abort'})
+                    time.sleep(self.settle)
+                else:
+                    poller = self.scheduler.client(self.pool.get(device.ip))
+                    device.waiting = self.scheduler.submit(
+                        poller.test_status, lambda status: not status.get('running'), self.test_duration + self.margin,
+                        kind='test', description='the other config test to end', hint=lambda status: status.get('timeout'))
+                    device.status = 'waiting'
+                    return
+                self.pusher.cache.discard(device.ip)  # the cached config may be the other test's
+            device.family = client.capabilities.family
+
+            device.desired = self.pusher.prepare(device.ip, change, device)
+            if device.desired is None:
+                return
+            device.baseline = self.peers(device)
+            self.pusher.post(device.ip, {'config': device.desired, 'test_run': True,
+                                         'test_duration': self.test_duration})
+            device.status = 'testing'
+            device.started = time.monotonic()
+            device.deadline = device.started + self.test_duration
+        except ConfigError as e:
+            # 409: another test was started between the status check and our POST
+            device.status = 'skipped' if e.status == 409 else 'failed'
+            device.message = e.details
+        except Exception as e:
+            device.status = 'failed'
+            device.message = str(e)
+
+    def check_health(self, device: TestRunDevice) -> Optional[str]:
+        """Probe one device; returns None if healthy, else the reason it isn't."""
+        status = self.test_status(device.ip)
+        if not status.get('running'):
+            return 'test no longer running'
+        device.remaining = status.get('timeout')
+        if device.remaining is not None:
+            device.deadline = time.monotonic() + device.remaining
+        if not device.baseline:
+            return None
+        current = self.peers(device)
+        missing = [mac for mac in device.baseline if mac not in current]
+        if missing:
+            return f"{len(missing)} peer(s) missing: {', '.join(missing[:3])}"
+        floor = 1 - self.rate_tolerance
+        for mac, (tx_rate, rx_rate) in device.baseline.items():
+            if current[mac][0] < tx_rate * floor or current[mac][1] < rx_rate * floor:
+                return f"peer {mac} rate dropped to {current[mac][0]}/{current[mac][1]} from {tx_rate}/{rx_rate}"
+        return None
+
+    def probe(self, device: TestRunDevice):
+        """Probe a testing device and confirm or abort its test when the outcome is clear."""
+        try:
+            reason = self.check_health(device)
+        except Exception as e:
+            reason = f"unreachable: {e.__class__.__name__}"
+        now = time.monotonic()
+
+        if reason == 'test no longer running':
+            device.status = 'reverted'
+            device.message = device.message or 'test ended without being confirmed'
+            return
+        if reason is None:
+            device.passes += 1
+            device.unhealthy_since = None
+            if device.passes >= self.passes:
+                self.finish(device, 'confirm')
+            return
+
+        device.passes = 0
+        device.message = reason
+        device.unhealthy_since = device.unhealthy_since or now
+        if now >= device.deadline - self.margin:
+            if reason.startswith('unreachable'):
+                if now >= device.deadline + self.probe_interval:
+                    device.status = 'unreachable'
+                    device.message = 'unreachable until the test timed out, the device should have reverted'
+            else:
+                self.finish(device, 'abort')
+
+    def finish(self, device: TestRunDevice, action: str):
+        try:
+            self.pusher.post(device.ip, {'action': action})
+        except Exception as e:
+            device.status = 'failed'
+            device.message = f"{action} failed: {e}"
+            return
+        if action == 'confirm':
+            device.status = 'confirmed'
+            device.message = ''
+            self.pusher.cache.set(device.ip, device.desired)
+        else:
+            device.status = 'aborted'
+            self.pusher.cache.discard(device.ip)
+
+    def run(self, ips: List[str], change: Callable[[dict], Optional[dict]]) -> List[TestRunDevice]:
+        self.devices = {ip: TestRunDevice(ip) for ip in dict.fromkeys(ips)}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                list(executor.map(lambda device: self.start(device, change), self.devices.values()))
+                while True:
+                    waiting = [device for device in self.devices.values() if device.status == 'waiting']
+                    resumed = [device for device in waiting if device.waiting.done()]
+                    list(executor.map(lambda device: self.start(device, change), resumed))
+                    testing = [device for device in self.devices.values() if device.status == 'testing']
+                    waiting = [device for device in waiting if device.status == 'waiting']
+                    if not testing and not waiting:
+                        break
+                    now = time.monotonic()
+                    ready = [device for device in testing if now - device.started >= self.settle]
+                    list(executor.map(self.probe, ready))
+                    first_probe = min((device.started + self.settle for device in testing), default=now)
+                    delay = self.probe_interval if ready or not testing else max(0.1, first_probe - now)
+                    if waiting:
+                        wait([device.waiting for device in waiting], timeout=delay, return_when=FIRST_COMPLETED)
+                    else:
+                        time.sleep(delay)
+            except KeyboardInterrupt:
+                # Don't leave half-checked changes behind: abort every test that is still running
+                testing = [device for device in self.devices.values() if device.status == 'testing']
+                list(executor.map(lambda device: self.finish(device, 'abort'), testing))
+                raise
+            finally:
+                self.scheduler.stop()
+        return list(self.devices.values())
+
+    def summary(self) -> str:
+        lines = [f"{'Device':<20}{'Result':<13}{'Keys':>5}  Details"]
+        counts: Dict[str, int] = {}
+        for device in self.devices.values():
+            keys = len(device.diff.paths()) if device.diff else 0
+            lines.append(f"{device.ip:<20}{device.status:<13}{keys:>5}  {device.message}")
+            counts[device.status] = counts.get(device.status, 0) + 1
+        lines.append('\n' + ', '.join(f"{count} {status}" for status, count in counts.items()))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roll out a config change as health-checked test runs')
+    parser.add_argument('-u', '--username', type=str, required=True, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, required=True, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to change')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--set', action='append', required=True, metavar='PATH=VALUE',
+                        help='Config key to set, e.g. network.general.mtu=1500 (repeatable)')
+    parser.add_argument('--test-duration', type=int, default=120, help='Test duration in seconds (default: 120)')
+    parser.add_argument('--probe-interval', type=float, default=10, help='Seconds between health probes (default: 10)')
+    parser.add_argument('--settle', type=float, default=15,
+                        help='Seconds to wait after starting a test before probing (default: 15)')
+    parser.add_argument('--passes', type=int, default=2, help='Consecutive healthy probes needed to confirm (default: 2)')
+    parser.add_argument('--rate-tolerance', type=float, default=0.3,
+                        help='Allowed drop of peer link rates, as a fraction (default: 0.3)')
+    parser.add_argument('--margin', type=float, default=20,
+                        help='Abort unhealthy tests this many seconds before they time out (default: 20)')
+    parser.add_argument('--on-conflict', choices=CONFLICT_ACTIONS, default='skip',
+                        help='When a test is already running on a device: skip it, abort that test, or wait for it (default: skip)')
+    parser.add_argument('--family', choices=FAMILIES, help='Validate the changed configs against this family\'s keys.html first')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='Devices started or probed at the same time (default: 50)')
+    parser.add_argument('--cache', type=str, help='Config cache file shared with config_diff.py')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    if args.ip_file:
+        with open(args.ip_file) as f:
+            ips = [line.strip() for line in f if line.strip()]
+    else:
+        ips = args.ip
+    assignments = [parse_assignment(assignment) for assignment in args.set]
+
+    def change(config: dict):
+        for path, value in assignments:
+            set_path(config, path, value)
+
+    cache = ConfigCache(args.cache)
+    with SessionPool(args.username, args.password, TokenCache(args.token_cache)) as pool:
+        pusher = ConfigPusher(pool, cache, validator=validator_for(args.family) if args.family else None)
+        orchestrator = TestRunOrchestrator(pusher, test_duration=args.test_duration, probe_interval=args.probe_interval,
+                                           settle=args.settle, passes=args.passes, rate_tolerance=args.rate_tolerance,
+                                           margin=args.margin, on_conflict=args.on_conflict,
+                                           concurrency=args.concurrency)
+        orchestrator.run(ips, change)
+    cache.save()
+    CAPABILITIES.save()
+    print(orchestrator.summary())
+
+
+if __name__ == "__main__":
+    main()
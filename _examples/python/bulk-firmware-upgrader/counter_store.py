@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Counter Store
+Compact in-memory time series of the counters in /stats payloads. Every series
+lives in a row of a fixed-size NumPy ring buffer and is stored as 8- or 16-bit
+delta codes, so throughput and error rates for the whole fleet come out of one
+vectorized pass instead of walking parsed JSON samples.
+
+Usage: python3 counter_store.py stats.ndjson --window 10
+"""
+
+import argparse
+import json
+import time
+import warnings
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+COUNTER_FIELDS = ('rx_bytes', 'tx_bytes', 'rx_packets', 'tx_packets',
+                  'rx_error', 'tx_error', 'rx_errors', 'tx_errors', 'rx_drop', 'tx_drop')
+GAUGE_PATHS = ('system.cpu_usage_percent', 'system.memory.used', 'system.cpu_temp')
+
+# Counter deltas are stored as 8- or 16-bit codes: values below 2**(bits-1) as
+# they are, larger ones with the top bit set, as an exponent and MANTISSA_BITS
+# bits of mantissa. Those are rounded to MANTISSA_BITS + 1 significant bits, so
+# the increase over any window is within 2**-(MANTISSA_BITS + 1) of the exact
+# one: 0.05% for 16-bit codes and 3% for 8-bit codes.
+MANTISSA_BITS = {8: 4, 16: 10}
+CODE_TYPES = {8: np.uint8, 16: np.uint16}
+# Counters that are mostly zero or small get 8-bit codes, and move to 16 bits if they outgrow them
+NARROW_FIELDS = ('rx_error', 'tx_error', 'rx_errors', 'tx_errors', 'rx_drop', 'tx_drop')
+# Gauges are stored as float16, in these units
+GAUGE_SCALES = {'system.memory.used': 1 << 20}
+# Sample intervals are stored in ms as uint16; longer gaps are escaped to a dict
+DT_ESCAPE = np.iinfo(np.uint16).max
+BLOCK_ROWS = 256
+# Ring slots a rate query gathers at once, bounding its temporary arrays
+QUERY_SLOTS = 1 << 22
+
+
+def code_limit(bits: int) -> int:
+    """Largest delta an 8- or 16-bit code holds."""
+    mantissa_bits = MANTISSA_BITS[bits]
+    max_exponent = (bits - 1 - mantissa_bits) + (1 << (bits - 1 - mantissa_bits)) - 1
+    return ((2 << mantissa_bits) - 1) << max_exponent
+
+
+CODE_LIMITS = {bits: code_limit(bits) for bits in MANTISSA_BITS}
+
+
+def encode(value: int, bits: int) -> int:
+    """The code of a delta, which is clamped to code_limit(bits)."""
+    if value < 1 << (bits - 1):
+        return value
+    mantissa_bits = MANTISSA_BITS[bits]
+    min_exponent = bits - 1 - mantissa_bits
+    max_exponent = min_exponent + (1 << min_exponent) - 1
+    exponent = value.bit_length() - mantissa_bits - 1
+    mantissa = (value + (1 << (exponent - 1))) >> exponent  # round to nearest
+    if mantissa >> (mantissa_bits + 1):
+        exponent += 1
+        mantissa >>= 1
+    if exponent > max_exponent:
+        exponent, mantissa = max_exponent, (2 << mantissa_bits) - 1
+    return (1 << (bits - 1)) | ((exponent - min_exponent) << mantissa_bits) | (mantissa & ((1 << mantissa_bits) - 1))
+
+
+def decode(codes: np.ndarray, bits: int) -> np.ndarray:
+    """The deltas of an array of codes, as int64."""
+    codes = codes.astype(np.int64)
+    mantissa_bits = MANTISSA_BITS[bits]
+    exponent = ((codes >> mantissa_bits) & ((1 << (bits - 1 - mantissa_bits)) - 1)) + (bits - 1 - mantissa_bits)
+    mantissa = (codes & ((1 << mantissa_bits) - 1)) | (1 << mantissa_bits)
+    return np.where(codes < 1 << (bits - 1), codes, mantissa << exponent)
+
+
+class RingRows:
+    """Ring buffer rows of `capacity` slots, allocated BLOCK_ROWS rows at a time.
+
+    Adding a row never copies the existing ones, and rows given back with
+    release() are reused.
+    """
+
+    def __init__(self, capacity: int, dtype, fill=0):
+        self.capacity = capacity
+        self.dtype = dtype
+        self.fill = fill
+        self.blocks: List[np.ndarray] = []
+        self.rows = 0
+        self.free: List[int] = []
+
+    def add(self) -> int:
+        if self.free:
+            row = self.free.pop()
+            self.row(row)[:] = self.fill
+            return row
+        if self.rows == len(self.blocks) * BLOCK_ROWS:
+            self.blocks.append(np.full((BLOCK_ROWS, self.capacity), self.fill, dtype=self.dtype))
+        self.rows += 1
+        return self.rows - 1
+
+    def release(self, row: int):
+        self.free.append(row)
+
+    def row(self, row: int) -> np.ndarray:
+        return self.blocks[row // BLOCK_ROWS][row % BLOCK_ROWS]
+
+    def gather(self, rows: np.ndarray, index: np.ndarray) -> np.ndarray:
+        """Values at `index[i]` of each row `rows[i]`."""
+        values = np.empty(index.shape, dtype=self.dtype)
+        block_of = rows // BLOCK_ROWS
+        order = np.argsort(block_of, kind='stable')
+        sorted_blocks = block_of[order]
+        starts = np.flatnonzero(np.r_[True, sorted_blocks[1:] != sorted_blocks[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(rows)]):
+            selected = order[start:end]
+            values[selected] = self.blocks[sorted_blocks[start]][(rows[selected] % BLOCK_ROWS)[:, None], index[selected]]
+        return values
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks)
+
+
+def extract_metrics(stats: dict) -> Tuple[Dict[str, int], Dict[str, float], Optional[float]]:
+    """Pull counters, gauges and uptime out of a /stats payload.
+
+    Counter paths follow the payload layout, with wireless peers keyed by MAC:
+    wireless.radios.wlan0.rx_bytes, wireless.peers.78:5E:E8:D0:10:22.tx_bytes,
+    ethernet.ports.eth0.tx_error, interfaces.eth1.rx_errors.
+
+    Returns:
+        (counters, gauges, uptime)
+    """
+    counters = {}
+    wireless = stats.get('wireless') or {}
+    groups = [('wireless.radios', wireless.get('radios') or {}),
+              ('wireless.peers', {peer.get('mac'): peer for peer in wireless.get('peers') or [] if peer.get('mac')}),
+              ('ethernet.ports', (stats.get('ethernet') or {}).get('ports') or {}),
+              ('interfaces', stats.get('interfaces') or {})]
+    for prefix, entries in groups:
+        if not isinstance(entries, dict):
+            continue
+        for name, entry in entries.items():
+            for field in COUNTER_FIELDS:
+                value = entry.get(field) if isinstance(entry, dict) else None
+                if isinstance(value, (int, float)):
+                    counters[f"{prefix}.{name}.{field}"] = int(value)
+
+    system = stats.get('system') or {}
+    gauges = {}
+    for path in GAUGE_PATHS:
+        value = system
+        for part in path.split('.')[1:]:
+            value = value.get(part) if isinstance(value, dict) else None
+        if isinstance(value, (int, float)):
+            gauges[path] = float(value)
+    uptime = system.get('uptime')
+    return counters, gauges, float(uptime) if isinstance(uptime, (int, float)) else None
+
+
+class CounterStore:
+    """Delta-encoded ring buffers for counters and gauges of many devices.
+
+    Per device sample the store keeps the time since the previous sample
+    (uint16 ms), an 8-bit code per error and drop counter, a 16-bit code per
+    byte and packet counter and a float16 per gauge, so a device with one
+    radio reporting rx/tx bytes, rx packets and tx errors, and 3 gauges,
+    costs 15 bytes per sample. The rows are allocated in blocks, so a new
+    device or series doesn't copy the stored ones.
+
+    Args:
+        capacity: Samples kept per series, e.g. 20160 for a week at 30 s.
+    """
+
+    def __init__(self, capacity: int = 20160):
+        self.capacity = capacity
+        self.devices: Dict[str, int] = {}
+        self.series: Dict[Tuple[str, str], int] = {}
+        self.series_keys: List[Tuple[str, str]] = []
+        self.device_series: List[List[int]] = []
+        self.gauges: Dict[Tuple[str, str], int] = {}
+        self.gauge_keys: List[Tuple[str, str]] = []
+
+        # per device
+        self.head = np.full(16, -1, dtype=np.int64)
+        self.count = np.zeros(16, dtype=np.int64)
+        self.seen = np.zeros(16, dtype=bool)
+        self.last_ts = np.zeros(16, dtype=np.float64)
+        self.last_uptime = np.full(16, -1.0, dtype=np.float64)
+        self.dt_ms = RingRows(capacity, np.uint16)
+        self.dt_escapes: Dict[Tuple[int, int], int] = {}  # (device, position) -> ms of intervals over DT_ESCAPE
+        # per counter series: its code width and row, and its last value
+        self.series_device = np.zeros(64, dtype=np.int64)
+        self.series_bits = np.zeros(64, dtype=np.int64)
+        self.series_row = np.zeros(64, dtype=np.int64)
+        self.base = np.full(64, -1, dtype=np.int64)
+        self.codes = {bits: RingRows(capacity, dtype) for bits, dtype in CODE_TYPES.items()}
+        # per gauge series
+        self.gauge_device = np.zeros(16, dtype=np.int64)
+        self.gauge_scale = np.ones(16, dtype=np.float64)
+        self.gauge_values = RingRows(capacity, np.float16, np.nan)
+
+    @staticmethod
+    def _grow(array: np.ndarray, size: int, fill=0) -> np.ndarray:
+        if size <= len(array):
+            return array
+        grown = np.full(max(size, len(array) * 2), fill, dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def _device_index(self, device: str) -> int:
+        index = self.devices.get(device)
+        if index is None:
+            index = self.devices[device] = len(self.devices)
+            self.device_series.append([])
+            size = index + 1
+            self.head = self._grow(self.head, size, -1)
+            self.count = self._grow(self.count, size)
+            self.seen = self._grow(self.seen, size, False)
+            self.last_ts = self._grow(self.last_ts, size)
+            self.last_uptime = self._grow(self.last_uptime, size, -1.0)
+            self.dt_ms.add()
+        return index
+
+    def _series_index(self, device_index: int, key: Tuple[str, str]) -> int:
+        index = self.series.get(key)
+        if index is None:
+            index = self.series[key] = len(self.series_keys)
+            self.series_keys.append(key)
+            self.device_series[device_index].append(index)
+            size = index + 1
+            self.series_device = self._grow(self.series_device, size)
+            self.series_bits = self._grow(self.series_bits, size)
+            self.series_row = self._grow(self.series_row, size)
+            self.base = self._grow(self.base, size, -1)
+            bits = 8 if key[1].endswith(NARROW_FIELDS) else 16
+            self.series_device[index] = device_index
+            self.series_bits[index] = bits
+            self.series_row[index] = self.codes[bits].add()
+        return index
+
+    def _widen(self, s: int):
+        """Move an 8-bit series to 16-bit codes; every 8-bit code has an exact 16-bit one."""
+        old_row = self.series_row[s]
+        deltas = decode(self.codes[8].row(old_row), 8)
+        row = self.codes[16].add()
+        self.codes[16].row(row)[:] = [encode(int(delta), 16) for delta in deltas]
+        self.codes[8].release(old_row)
+        self.series_bits[s] = 16
+        self.series_row[s] = row
+
+    def _gauge_index(self, device_index: int, key: Tuple[str, str]) -> int:
+        index = self.gauges.get(key)
+        if index is None:
+            index = self.gauges[key] = len(self.gauge_keys)
+            self.gauge_keys.append(key)
+            self.gauge_device = self._grow(self.gauge_device, index + 1)
+            self.gauge_scale = self._grow(self.gauge_scale, index + 1, 1.0)
+            self.gauge_device[index] = device_index
+            self.gauge_scale[index] = GAUGE_SCALES.get(key[1], 1)
+            self.gauge_values.add()
+        return index
+
+    def add_sample(self, device: str, stats: dict, ts: Optional[float] = None):
+        """Add one /stats payload of a device.
+
+        The first sample of a device only sets the counter baselines. A counter
+        that goes down, or all counters of a device whose uptime went backwards
+        (reboot), are treated as reset to zero.
+        """
+        ts = time.time() if ts is None else ts
+        counters, gauges, uptime = extract_metrics(stats)
+        d = self._device_index(device)
+        rebooted = uptime is not None and 0 <= uptime < self.last_uptime[d]
+        first = not self.seen[d]
+        self.seen[d] = True
+        if uptime is not None:
+            self.last_uptime[d] = uptime
+
+        if not first:
+            position = (self.head[d] + 1) % self.capacity
+            self.head[d] = position
+            self.count[d] = min(self.count[d] + 1, self.capacity)
+            dt_ms = max(int((ts - self.last_ts[d]) * 1000), 1)
+            self.dt_ms.row(d)[position] = min(dt_ms, DT_ESCAPE)
+            if dt_ms >= DT_ESCAPE:
+                self.dt_escapes[(d, position)] = dt_ms
+            else:
+                self.dt_escapes.pop((d, position), None)
+        self.last_ts[d] = ts
+
+        seen = set()
+        for path, value in counters.items():
+            s = self._series_index(d, (device, path))
+            seen.add(s)
+            base = int(self.base[s])
+            self.base[s] = value
+            if first:
+                continue  # baseline only
+            if base < 0:
+                base = value  # first sight of this series
+            elif rebooted or value < base:
+                base = 0
+            delta = value - base
+            if self.series_bits[s] == 8 and delta > CODE_LIMITS[8]:
+                self._widen(s)
+            bits = int(self.series_bits[s])
+            self.codes[bits].row(self.series_row[s])[position] = encode(delta, bits)
+        if not first:
+            for s in self.device_series[d]:
+                if s not in seen:
+                    self.codes[int(self.series_bits[s])].row(self.series_row[s])[position] = 0  # e.g. a peer that disconnected
+
+        for path, value in gauges.items():
+            g = self._gauge_index(d, (device, path))
+            if not first:
+                self.gauge_values.row(g)[position] = value / self.gauge_scale[g]
+
+    def _window(self, rows: np.ndarray, devices: np.ndarray, window: int):
+        """Ring indexes and validity mask of the last `window` samples per row."""
+        offsets = np.arange(window)
+        index = (self.head[devices][:, None] - offsets[None, :]) % self.capacity
+        valid = offsets[None, :] < self.count[devices][:, None]
+        return index, valid
+
+    def select(self, metric: str) -> np.ndarray:
+        """Rows of all counter series whose path ends with `metric`, e.g. 'rx_bytes'."""
+        return np.array([i for i, (_, path) in enumerate(self.series_keys) if path.endswith(metric)],
+                        dtype=np.int64)
+
+    def interval_seconds(self, devices: np.ndarray, index: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """Seconds covered by the valid ring slots of each device row."""
+        dt_ms = self.dt_ms.gather(devices, index).astype(np.float64)
+        if self.dt_escapes:
+            for i, j in zip(*np.nonzero(dt_ms == DT_ESCAPE)):
+                dt_ms[i, j] = self.dt_escapes.get((int(devices[i]), int(index[i, j])), DT_ESCAPE)
+        return (dt_ms * valid).sum(axis=1) / 1000.0
+
+    def rates(self, rows: np.ndarray, window: int = 1) -> np.ndarray:
+        """Per-second rate of each series row over its last `window` intervals, vectorized per code width."""
+        if len(rows) > max(QUERY_SLOTS // window, 1):
+            chunk = max(QUERY_SLOTS // window, 1)
+            return np.concatenate([self.rates(rows[i:i + chunk], window) for i in range(0, len(rows), chunk)])
+        if len(rows) == 0:
+            return np.zeros(0)
+        devices = self.series_device[rows]
+        index, valid = self._window(rows, devices, window)
+        increase = np.zeros(len(rows))
+        for bits, codes in self.codes.items():
+            selected = self.series_bits[rows] == bits
+            if selected.any():
+                deltas = decode(codes.gather(self.series_row[rows[selected]], index[selected]), bits)
+                increase[selected] = (deltas * valid[selected]).sum(axis=1)
+        seconds = self.interval_seconds(devices, index, valid)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(seconds > 0, increase / seconds, np.nan)
+
+    def throughput(self, window: int = 1) -> List[Tuple[str, str, float, float]]:
+        """(device, series, rx Mbit/s, tx Mbit/s) for every *_bytes series pair."""
+        rx_rows = self.select('.rx_bytes')
+        tx_rows = np.array([self.series.get((device, path[:-len('rx_bytes')] + 'tx_bytes'), -1)
+                            for device, path in (self.series_keys[r] for r in rx_rows)], dtype=np.int64)
+        rx = self.rates(rx_rows, window) * 8 / 1e6
+        tx = np.full(len(rx_rows), np.nan)
+        has_tx = tx_rows >= 0
+        tx[has_tx] = self.rates(tx_rows[has_tx], window) * 8 / 1e6
+        return [(self.series_keys[r][0], self.series_keys[r][1][:-len('.rx_bytes')], rx[i], tx[i])
+                for i, r in enumerate(rx_rows)]
+
+    def error_rates(self, window: int = 1) -> List[Tuple[str, str, float]]:
+        """(device, series, errors per packet) for every tx_error/tx_errors series with a tx_packets pair."""
+        results = []
+        for suffix in ('.tx_error', '.tx_errors'):
+            error_rows = self.select(suffix)
+            packet_rows = np.array([self.series.get((device, path[:-len(suffix)] + '.tx_packets'), -1)
+                                    for device, path in (self.series_keys[r] for r in error_rows)], dtype=np.int64)
+            keep = packet_rows >= 0
+            error_rows, packet_rows = error_rows[keep], packet_rows[keep]
+            errors = self.rates(error_rows, window)
+            packets = self.rates(packet_rows, window)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.where(packets > 0, errors / packets, 0.0)
+            results.extend((self.series_keys[r][0], self.series_keys[r][1][:-len(suffix)], ratio[i])
+                           for i, r in enumerate(error_rows))
+        return results
+
+    def gauge_means(self, metric: str, window: int = 1) -> Dict[str, float]:
+        """Mean of a gauge (e.g. 'system.cpu_temp') per device over the last `window` samples."""
+        rows = np.array([i for i, (_, path) in enumerate(self.gauge_keys) if path == metric], dtype=np.int64)
+        if len(rows) == 0:
+            return {}
+        means = np.zeros(len(rows))
+        chunk = max(QUERY_SLOTS // window, 1)
+        for i in range(0, len(rows), chunk):
+            part = rows[i:i + chunk]
+            index, valid = self._window(part, self.gauge_device[part], window)
+            values = np.where(valid, self.gauge_values.gather(part, index).astype(np.float64), np.nan)
+            with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  # a device without samples yet has no mean
+                means[i:i + chunk] = np.nanmean(values, axis=1) * self.gauge_scale[part]
+        return {self.gauge_keys[r][0]: float(means[i]) for i, r in enumerate(rows)}
+
+    def memory_bytes(self) -> int:
+        """Bytes allocated for the buffers, including rows allocated ahead of use."""
+        arrays = (self.head, self.count, self.seen, self.last_ts, self.last_uptime, self.series_device,
+                  self.series_bits, self.series_row, self.base, self.gauge_device, self.gauge_scale)
+        rings = [self.dt_ms, self.gauge_values, *self.codes.values()]
+        return sum(array.nbytes for array in arrays) + sum(ring.nbytes for ring in rings)
+
+
+def read_samples(path: str) -> Iterator[dict]:
+    """Read stats_collector.py NDJSON output."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute fleet throughput and error rates from collected stats')
+    parser.add_argument('samples', help='NDJSON file written by stats_collector.py')
+    parser.add_argument('--window', type=int, default=1, help='Number of sample intervals to average over (default: 1)')
+    parser.add_argument('--capacity', type=int, default=20160, help='Samples kept per series (default: 20160, a week at 30 s)')
+    args = parser.parse_args()
+
+    store = CounterStore(args.capacity)
+    for sample in read_samples(args.samples):
+        if sample.get('ok'):
+            store.add_sample(sample['ip'], sample['stats'], sample['ts'])
+
+    started = time.perf_counter()
+    throughput = store.throughput(args.window)
+    errors = store.error_rates(args.window)
+    elapsed = time.perf_counter() - started
+
+    print(f"{'Device':<20}{'Series':<50}{'RX Mbps':>10}{'TX Mbps':>10}")
+    for device, series, rx, tx in throughput:
+        print(f"{device:<20}{series:<50}{rx:>10.2f}{tx:>10.2f}")
+    print(f"\n{'Device':<20}{'Series':<50}{'TX errors/packet':>20}")
+    for device, series, ratio in errors:
+        if ratio:
+            print(f"{device:<20}{series:<50}{ratio:>20.6f}")
+    print(f"\n{len(store.devices)} device(s), {len(store.series_keys)} counter series, "
+          f"rates computed in {elapsed * 1000:.1f} ms, "
+          f"{store.memory_bytes() / 1e6:.1f} MB allocated for {args.capacity} samples per series")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,683 @@
+#!/usr/bin/env python3
+"""
+Device Simulator
+Serves /cgi.lua/apiv1/* for thousands of virtual Tachyon devices from one
+asyncio process, so the tools in this directory can be load-tested without
+real radios. Routes and response bodies come from the swagger.yaml of each
+device's family and spec version; on top of that every device keeps its own
+state: login tokens, firmware download and flashing tasks, reboot downtime,
+config test runs, speedtests and aiming sessions. Network latency, CGI
+processing time and failure rates are configurable.
+
+With --stations-per-ap, the devices form APs with stations connected to them:
+their /stats?type=wireless report each other as peers, a station can't be
+reached while its AP is down, and a download is lost if the AP reboots meanwhile.
+
+Each device listens on its own loopback address (127.20.0.1, 127.20.0.2, ...),
+which Linux routes without any setup; on other systems use --base-port to give
+each device its own port on one address instead.
+
+Usage: python3 device_simulator.py --devices 5000 --mix tna_30x=0.7,tna_305=0.2,tns_10x=0.1 --ip-file sim_ips.txt
+"""
+
+import argparse
+import asyncio
+import base64
+import copy
+import fnmatch
+import ipaddress
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from api_specs import FAMILIES, load_spec, spec_versions, stats_types
+from config_diff import REBOOT_KEYS, ConfigDiff, key_pattern
+from config_schema import validator_for
+from tachyon_client import parse_version
+from tachyon_session import API_PATH
+
+METHODS = ('get', 'post', 'put', 'delete')
+REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 409: 'Conflict',
+           500: 'Internal Server Error'}
+MAX_TOKENS = 16
+
+
+def error_body(status: int, details: str, path: str) -> dict:
+    """Error response in the GenericFailureReponse format of the specs."""
+    return {'statusCode': status, 'description': REASONS.get(status, ''), 'error': {'details': details, 'path': path}}
+
+
+class DeviceSpec:
+    """Routes and response examples of one family and spec version, shared by its devices."""
+
+    def __init__(self, family: str, version: Optional[str] = None):
+        self.family = family
+        self.version = version or spec_versions(family)[-1]
+        spec = load_spec(family, self.version)
+        self.routes = set()
+        self.examples: Dict[Tuple[str, str, int], List[Tuple[str, object]]] = {}
+        self.request_fields: Dict[Tuple[str, str], set] = {}
+        for path, operations in spec['paths'].items():
+            for method, operation in operations.items():
+                if method not in METHODS:
+                    continue
+                self.routes.add((path, method.upper()))
+                body = (operation.get('requestBody') or {}).get('content', {}).get('application/json', {})
+                self.request_fields[(path, method.upper())] = set(body.get('schema', {}).get('properties') or {})
+                for code, response in (operation.get('responses') or {}).items():
+                    content = (response.get('content') or {}).get('application/json') or {}
+                    values = [(name, self.decode(example.get('value')))
+                              for name, example in (content.get('examples') or {}).items() if example]
+                    if 'example' in content:
+                        values.append(('example', self.decode(content['example'])))
+                    self.examples[(path, method.upper(), int(code))] = values
+
+        self.stats: Dict[str, dict] = {}
+        for _, value in self.examples.get(('/stats', 'GET', 200), []):
+            if isinstance(value, dict):
+                for stats_type, fragment in value.items():
+                    self.stats.setdefault(stats_type, fragment)
+        self.stats_types = stats_types(family, self.version)
+        self.config = next((value['config'] for _, value in self.examples.get(('/config', 'GET', 200), [])
+                            if isinstance(value, dict) and 'config' in value), {})
+        self.model = self.stats.get('system', {}).get('model', family.upper())
+        self.supports_test_run = 'test_run' in self.request_fields.get(('/config', 'POST'), ())
+        self.validator = validator_for(family, self.version)
+        # Errors the spec's own example config has are not held against posted configs
+        self.baseline_errors = set(self.validator.check(self.config))
+
+    @staticmethod
+    def decode(value):
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+        return value
+
+    def example(self, path: str, method: str, code: int = 200, name: Optional[str] = None):
+        for example_name, value in self.examples.get((path, method, code), []):
+            if name is None or example_name == name:
+                return copy.deepcopy(value)
+        return None
+
+
+class VirtualDevice:
+    """State of one simulated device."""
+
+    __slots__ = ('index', 'host', 'port', 'spec', 'serial', 'mac', 'version', 'backup_version', 'pending_version',
+                 'booted', 'up', 'tokens', 'task', 'config', 'test', 'speedtest', 'aiming', 'server', 'connections',
+                 'cgi', 'seed', 'uplink', 'stations', 'went_down')
+
+    def __init__(self, index: int, host: str, port: int, spec: DeviceSpec, version: str):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.spec = spec
+        self.serial = f"{spec.model.replace('-', '')[:6]}{index:08d}"
+        self.mac = ':'.join(f"{byte:02X}" for byte in (0x78, 0x5E, 0xE8, (index >> 16) & 0xFF, (index >> 8) & 0xFF,
+                                                       index & 0xFF))
+        self.version = version
+        self.backup_version = version
+        self.pending_version: Optional[str] = None
+        self.booted = time.time() - random.uniform(3600, 30 * 86400)
+        self.up = False
+        self.tokens: Dict[str, None] = {}
+        self.task: dict = {}
+        self.config: Optional[dict] = None  # None: unchanged from the spec example, shared by all devices
+        self.test: Optional[dict] = None
+        self.speedtest: dict = {}
+        self.aiming: Optional[dict] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections = set()
+        self.cgi = asyncio.Lock()
+        self.seed = random.random()
+        self.uplink: Optional['VirtualDevice'] = None  # the AP of a station
+        self.stations: List['VirtualDevice'] = []
+        self.went_down = 0.0
+
+    @property
+    def address(self) -> str:
+        return self.host if self.port == 80 else f"{self.host}:{self.port}"
+
+    @property
+    def current_config(self) -> dict:
+        return self.config if self.config is not None else self.spec.config
+
+
+class Simulator:
+    """Serve many VirtualDevices from one event loop.
+
+    Args:
+        devices: Number of devices.
+        network: Loopback network the device addresses are taken from.
+        base_port: If set, all devices listen on `bind` with consecutive ports
+            starting here instead of on their own address.
+        mix: Share of each family, e.g. {'tna_30x': 0.8, 'tns_10x': 0.2}.
+        versions: Spec version per family (default: newest).
+        firmware: Firmware version the devices start with.
+        latency: Network round trip added to every request, in seconds.
+        jitter: Random extra latency of up to this many seconds.
+        cgi_time: Processing time per request; requests to the same device are
+            processed one at a time, like the device's CGI.
+        error_rate: Fraction of requests answered with a 500 error.
+        drop_rate: Fraction of requests whose connection is dropped without an answer.
+        download_time: Seconds a firmware download takes.
+        flash_time: Seconds flashing takes.
+        reboot_time: Seconds a device is unreachable while rebooting.
+        update_failure_rate: Fraction of downloads and flashes that fail.
+        speedtest_time: Seconds a speedtest runs.
+        stations_per_ap: Make every group of this many devices plus one an AP
+            and its stations, 0 for devices that all report the spec's peers.
+        record_latency: Keep the response time of every request, per route,
+            in `latencies` (milliseconds).
+    """
+
+    def __init__(self, devices: int = 100, network: str = '127.20.0.0/16', base_port: int = 0, bind: str = '127.0.0.1',
+                 mix: Optional[Dict[str, float]] = None, versions: Optional[Dict[str, str]] = None,
+                 firmware: str = '1.12.1 rev 54920', username: str = 'root', password: str = 'admin',
+                 latency: float = 0.0, jitter: float = 0.0, cgi_time: float = 0.0, error_rate: float = 0.0,
+                 drop_rate: float = 0.0, download_time: float = 20, flash_time: float = 30, reboot_time: float = 60,
+                 update_failure_rate: float = 0.0, speedtest_time: float = 10, seed: Optional[int] = None,
+                 record_latency: bool = False, stations_per_ap: int = 0):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.cgi_time = cgi_time
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.download_time = download_time
+        self.flash_time = flash_time
+        self.reboot_time = reboot_time
+        self.update_failure_rate = update_failure_rate
+        self.speedtest_time = speedtest_time
+        self.random = random.Random(seed)
+        self.requests: Counter = Counter()
+        self.latencies: Optional[Dict[str, List[float]]] = defaultdict(list) if record_latency else None
+        self.started = time.monotonic()
+
+        mix = mix or {'tna_30x': 1.0}
+        versions = versions or {}
+        specs = {family: DeviceSpec(family, versions.get(family)) for family in mix}
+        families = self.random.choices(list(mix), weights=list(mix.values()), k=devices)
+        hosts = ipaddress.ip_network(network).hosts()
+        self.devices: List[VirtualDevice] = []
+        for index, family in enumerate(families):
+            host, port = (bind, base_port + index) if base_port else (str(next(hosts)), 80)
+            self.devices.append(VirtualDevice(index, host, port, specs[family], firmware))
+        if stations_per_ap:
+            radios = [device for device in self.devices if 'wireless' in device.spec.stats]
+            for start in range(0, len(radios), stations_per_ap + 1):
+                ap, *stations = radios[start:start + stations_per_ap + 1]
+                ap.stations = stations
+                for station in stations:
+                    station.uplink = ap
+
+        self.handlers = {
+            ('/login', 'POST'): self.login, ('/login', 'DELETE'): self.logout,
+            ('/stats', 'GET'): self.get_stats, ('/reboot', 'POST'): self.post_reboot,
+            ('/update', 'GET'): self.get_update, ('/update', 'PUT'): self.put_update,
+            ('/update', 'POST'): self.post_update,
+            ('/config', 'GET'): self.get_config, ('/config', 'POST'): self.post_config,
+            ('/speedtest', 'GET'): self.get_speedtest, ('/speedtest', 'POST'): self.post_speedtest,
+            ('/aiming', 'GET'): self.get_aiming, ('/aiming', 'POST'): self.post_aiming,
+            ('/aiming', 'DELETE'): self.delete_aiming,
+            ('/bridge_table', 'GET'): self.get_bridge_table, ('/poe_reset', 'POST'): self.post_poe_reset,
+        }
+
+    # ----- serving -----
+
+    async def start(self):
+        raise_file_limit()
+        await asyncio.gather(*(self.listen(device) for device in self.devices))
+
+    async def stop(self):
+        for device in self.devices:
+            self.take_down(device)
+
+    async def listen(self, device: VirtualDevice):
+        device.server = await asyncio.start_server(partial(self.handle, device), device.host, device.port,
+                                                   reuse_address=True, backlog=64)
+        device.up = True
+
+    def take_down(self, device: VirtualDevice):
+        device.up = False
+        if device.server:
+            device.server.close()
+            device.server = None
+        for writer in list(device.connections):
+            writer.transport.abort()
+        device.connections.clear()
+
+    async def handle(self, device: VirtualDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve HTTP/1.1 keep-alive requests on one connection to a device."""
+        device.connections.add(writer)
+        try:
+            while device.up:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+
+                response = await self.respond(device, method.upper(), target, headers, body)
+                if response is None or not device.up:
+                    writer.transport.abort()  # dropped connection, or the device went down meanwhile
+                    break
+                status, payload, extra_headers = response
+                data = json.dumps(payload).encode()
+                lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", 'Content-Type: application/json',
+                         f"Content-Length: {len(data)}"]
+                lines.extend(f"{name}: {value}" for name, value in extra_headers.items())
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass  # cancelled: the simulator is shutting down
+        finally:
+            device.connections.discard(writer)
+            writer.close()
+
+    async def respond(self, device: VirtualDevice, method: str, target: str, headers: Dict[str, str],
+                      body: bytes) -> Optional[Tuple[int, object, Dict[str, str]]]:
+        url = urlsplit(target)
+        path = url.path[len(API_PATH):] if url.path.startswith(API_PATH) else url.path
+        route = f"{method} {path}"
+        self.requests[route] += 1
+        if self.latencies is None:
+            return await self.route(device, method, url, path, headers, body)
+        started = time.perf_counter()
+        try:
+            return await self.route(device, method, url, path, headers, body)
+        finally:
+            self.latencies[route].append((time.perf_counter() - started) * 1000)
+
+    async def route(self, device: VirtualDevice, method: str, url, path: str, headers: Dict[str, str],
+                    body: bytes) -> Optional[Tuple[int, object, Dict[str, str]]]:
+        """Route one request, applying latency, CGI time and injected failures."""
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        async with device.cgi:
+            if self.cgi_time:
+                await asyncio.sleep(self.cgi_time)
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                return None
+            if device.uplink is not None and not device.uplink.up:
+                return None  # cut off behind its AP
+            if self.error_rate and self.random.random() < self.error_rate:
+                return 500, error_body(500, 'System error - simulated failure', url.path), {}
+            if (path, method) not in device.spec.routes:
+                return 404, error_body(404, 'Not Found', url.path), {}
+
+            token = None
+            for cookie in headers.get('cookie', '').split(';'):
+                name, _, value = cookie.strip().partition('=')
+                if name == 'api_token':
+                    token = value
+            if path != '/login' and token not in device.tokens:
+                return 401, error_body(401, 'Authorization Failed', url.path), {}
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                return 400, error_body(400, 'Invalid JSON in request body', url.path), {}
+            params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            result = self.handlers[(path, method)](device, params, data, token)
+            status, payload = result[0], result[1]
+            if isinstance(payload, dict) and status >= 400 and 'error' not in payload:
+                payload = error_body(status, payload.get('details', ''), url.path)
+            return status, payload, result[2] if len(result) > 2 else {}
+
+    # ----- routes -----
+
+    def login(self, device, params, data, token):
+        if data.get('username') != self.username or data.get('password') != self.password:
+            return 401, {'details': 'Authorization Failed'}
+        token = base64.b32encode(os.urandom(30)).decode()
+        device.tokens[token] = None
+        while len(device.tokens) > MAX_TOKENS:
+            device.tokens.pop(next(iter(device.tokens)))
+        return 200, {'token': token, 'level': 0, 'auth': True}, {'Set-Cookie': f"token={token}; Path=/"}
+
+    def logout(self, device, params, data, token):
+        device.tokens.pop(token, None)
+        return 200, {'status': 'ok'}
+
+    def get_stats(self, device, params, data, token):
+        requested = [name for name in params.get('type', 'system').split(',') if name]
+        unknown = [name for name in requested if name not in device.spec.stats]
+        if unknown:
+            return 400, {'details': f"Invalid stats type: {unknown[0]}"}
+        now = time.time()
+        uptime = int(now - device.booted)
+        result = {}
+        for name in requested:
+            fragment = copy.deepcopy(device.spec.stats[name])
+            if name == 'system':
+                self.advance_task(device)
+                fragment.update(uptime=uptime, epoch_time=int(now), fw_version=device.version, serial_no=device.serial,
+                                hostname=device.current_config.get('system', {}).get('hostname', fragment.get('hostname')))
+                if 'bootbanks' in fragment:
+                    fragment['bootbanks'] = {'active': {'bootbank': 1, 'version': device.version},
+                                             'backup': {'bootbank': 2,
+                                                        'version': device.pending_version or device.backup_version}}
+            else:
+                self.advance_counters(fragment, uptime, device.seed)
+                if name == 'wireless' and (device.uplink or device.stations):
+                    self.link_peers(device, fragment)
+            result[name] = fragment
+        return 200, result
+
+    @staticmethod
+    def advance_counters(fragment, uptime: int, seed: float):
+        """Make byte and packet counters grow with uptime, at a per-device rate."""
+        if isinstance(fragment, dict):
+            for key, value in fragment.items():
+                if isinstance(value, int) and not isinstance(value, bool) and key.endswith(('_bytes', '_packets')):
+                    fragment[key] = value + int(uptime * (1 + seed) * (1500 if key.endswith('_bytes') else 1))
+                else:
+                    Simulator.advance_counters(value, uptime, seed)
+        elif isinstance(fragment, list):
+            for value in fragment:
+                Simulator.advance_counters(value, uptime, seed)
+
+    @staticmethod
+    def link_peers(device: VirtualDevice, wireless: dict):
+        """Report the AP of a station, or the stations of an AP, as the peers of its first radio."""
+        radio_name, radio = next(iter(wireless['radios'].items()))
+        radio.update(mac=device.mac, op_mode='managed' if device.uplink else 'master', ptp=False)
+        template = (wireless.get('peers') or [{}])[0]
+        wireless['peers'] = [dict(template, mac=peer.mac, ipv4=peer.host, model=peer.spec.model, radio_name=radio_name,
+                                  system_name=f"{peer.spec.model} {peer.index}")
+                             for peer in ([device.uplink] if device.uplink else device.stations)]
+
+    def post_reboot(self, device, params, data, token):
+        asyncio.get_running_loop().call_later(0.2, lambda: asyncio.ensure_future(self.reboot(device)))
+        return 200, {'status': 'ok'}
+
+    async def reboot(self, device: VirtualDevice):
+        self.take_down(device)
+        device.went_down = time.time()
+        device.tokens.clear()
+        device.test = device.aiming = None
+        device.speedtest = {}
+        if device.pending_version:
+            device.backup_version, device.version = device.version, device.pending_version
+            device.pending_version = None
+        device.task = {}
+        await asyncio.sleep(self.reboot_time * self.random.uniform(0.8, 1.2))
+        device.booted = time.time()
+        await self.listen(device)
+
+    def advance_task(self, device: VirtualDevice):
+        task = device.task
+        if task.get('status') == 'IN_PROGRESS' and time.time() >= task['_ends']:
+            task['last_changed'] = int(task['_ends'])
+            if task['state'] == 'FIRMWARE_DOWNLOAD' and device.uplink \
+                    and task['_started'] < device.uplink.went_down < task['_ends']:
+                task['status'] = 'FAIL'
+                task['error'] = 'Connection lost while downloading'
+            elif self.random.random() < self.update_failure_rate:
+                task['status'] = 'FAIL'
+                task['error' if task['state'] == 'FIRMWARE_DOWNLOAD' else 'url'] = 'Simulated failure'
+            elif task['state'] == 'FIRMWARE_DOWNLOAD':
+                task['status'] = 'SUCCESS'
+            else:
+                task['status'] = 'COMPLETE'
+                task['comment'] = 'Reboot device for the new firmware to become active.'
+                device.pending_version = task['_version']
+
+    def get_update(self, device, params, data, token):
+        self.advance_task(device)
+        return 200, {key: value for key, value in device.task.items() if not key.startswith('_')}
+
+    def put_update(self, device, params, data, token):
+        url = data.get('firmware_url') or ''
+        if not url.startswith(('http://', 'https://')):
+            return 400, {'details': 'Invalid firmware URL, only http/https protocols are currently supported.'}
+        parsed = parse_version(urlsplit(url).path.rsplit('/', 1)[-1])
+        now = time.time()
+        device.task = {'state': 'FIRMWARE_DOWNLOAD', 'status': 'IN_PROGRESS', 'url': url, 'last_changed': int(now),
+                       '_started': now, '_ends': now + self.download_time * self.random.uniform(0.8, 1.2),
+                       '_version': f"{parsed[0]} rev {parsed[1]}" if parsed else device.version}
+        return 200, {'status': 'ok'}
+
+    def post_update(self, device, params, data, token):
+        self.advance_task(device)
+        task = device.task
+        if task.get('state') != 'FIRMWARE_DOWNLOAD' or task.get('status') != 'SUCCESS':
+            return 400, {'details': 'Invalid firmware upgrade: local firmware file is missing.'}
+        now = time.time()
+        device.task = {'state': 'FIRMWARE_FLASHING', 'status': 'IN_PROGRESS', 'last_changed': int(now),
+                       '_ends': now + self.flash_time * self.random.uniform(0.8, 1.2), '_version': task['_version']}
+        return 200, {'status': 'ok'}
+
+    def expire_test(self, device: VirtualDevice):
+        if device.test and time.time() >= device.test['ends']:
+            device.config = device.test['previous']
+            device.test = None
+
+    def get_config(self, device, params, data, token):
+        self.expire_test(device)
+        if params.get('target') == 'test':
+            if device.test:
+                return 200, {'running': True, 'timeout': int(device.test['ends'] - time.time())}
+            return 200, {'running': False}
+        return 200, {'config': device.current_config}
+
+    def post_config(self, device, params, data, token):
+        self.expire_test(device)
+        action = data.get('action')
+        if action:
+            if action not in ('confirm', 'abort'):
+                return 400, {'details': 'Invalid action'}
+            if not device.test:
+                return 400, {'details': 'No test is currently running'}
+            if action == 'abort':
+                device.config = device.test['previous']
+            device.test = None
+            if action == 'abort':
+                return 200, {'status_msg': 'Test aborted, reverting to previous configuration'}
+            return 200, {'status_msg': 'Test confirmed, configuration applied permanently'}
+
+        config = data.get('config')
+        if not isinstance(config, dict):
+            return 400, {'details': 'Missing config in POST data.'}
+        if device.test and not data.get('dry_run'):
+            return 409, {'details': 'Configuration test in progress. Confirm or abort the test first.'}
+        errors = [error for error in device.spec.validator.check(config) if error not in device.spec.baseline_errors]
+        if errors:
+            return 400, {'details': f"Configuration validation failed: {errors[0]}"}  # only the first, like the device
+
+        diff = ConfigDiff(device.current_config, config)
+        reboot_required = any(fnmatch.fnmatchcase(key_pattern(path), pattern)
+                              for path in diff.paths() for pattern in REBOOT_KEYS)
+        response = {'reboot_required': reboot_required, 'keys_changed': diff.changed, 'keys_added': diff.added,
+                    'keys_removed': diff.removed, 'warnings': {}}
+        if data.get('dry_run'):
+            return 200, {'status_msg': 'Dry run only, no changes made on this device.', 'response': response}
+        if data.get('test_run'):
+            if not device.spec.supports_test_run:
+                return 400, {'details': 'Test runs are not supported'}
+            if reboot_required:
+                return 400, {'details': 'Test run not allowed when the config change requires a reboot'}
+            device.test = {'previous': device.config, 'ends': time.time() + int(data.get('test_duration') or 120)}
+        device.config = config
+        return 200, {'status_msg': 'Configuration saved, applying changes now.', 'response': response}
+
+    def peers(self, device: VirtualDevice) -> List[dict]:
+        return device.spec.stats.get('wireless', {}).get('peers') or []
+
+    def get_speedtest(self, device, params, data, token):
+        test = device.speedtest
+        if test.get('_ends') and time.time() >= test['_ends']:
+            radio = test.get('_radio')
+            device.speedtest = test = {'last_changed': int(test['_ends']), 'peer_mac': test['peer_mac'],
+                                       'reverse': test['reverse'], 'status': 'ok',
+                                       'mbps': round(self.random.uniform(1500, 2800), 2)}
+            if radio:
+                test['radio'] = radio
+        if test.get('_error'):
+            return 200, test['_error']
+        return 200, {key: value for key, value in test.items() if not key.startswith('_')}
+
+    def post_speedtest(self, device, params, data, token):
+        peer_mac = data.get('peer_mac')
+        mode = device.current_config.get('wireless', {}).get('radios', {}).get('wlan0', {}).get('mode')
+        if not peer_mac and mode == 'ap':
+            return 400, {'details': 'Peer mac is required for AP mode.'}
+        now = time.time()
+        if device.speedtest.get('_ends', 0) > now:
+            # The running test goes on; the second request is aborted, which GET shows until the first one ends
+            device.speedtest['_error'] = {'last_changed': int(now), 'peer_mac': peer_mac,
+                                          'reverse': bool(data.get('reverse')), 'status': 'error',
+                                          'error': 'speedtest: already running, aborted.'}
+            return 200, {'status': 'ok'}
+        peers = self.peers(device)
+        if peer_mac and peers and peer_mac.upper() not in {peer.get('mac', '').upper() for peer in peers}:
+            device.speedtest = {'last_changed': int(now), 'peer_mac': peer_mac, 'reverse': bool(data.get('reverse')),
+                                'status': 'error', 'error': f"Invalid peer {peer_mac} (detected {len(peers)} peer(s))"}
+            return 200, {'status': 'ok'}
+        device.speedtest = {'peer_mac': peer_mac, 'reverse': bool(data.get('reverse')), '_radio': data.get('radio'),
+                            '_ends': now + self.speedtest_time * self.random.uniform(0.9, 1.1)}
+        return 200, {'status': 'ok'}
+
+    def get_aiming(self, device, params, data, token):
+        now = time.time()
+        if device.aiming and now >= device.aiming['ends']:
+            device.aiming = None
+        if not device.aiming:
+            return 200, {'status': 'stopped'}
+        return 200, {'status': 'running', 'last_updated': int(now), 'remaining': int(device.aiming['ends'] - now),
+                     'channel': 5, 'channel_width': 2160, 'duration': device.aiming['duration']}
+
+    def post_aiming(self, device, params, data, token):
+        now = time.time()
+        if device.aiming and now < device.aiming['ends']:
+            return 409, {'details': 'Already aiming'}
+        duration = int(data.get('duration') or 300)
+        device.aiming = {'ends': now + duration, 'duration': duration}
+        return 200, {'success': True}
+
+    def delete_aiming(self, device, params, data, token):
+        if not device.aiming or time.time() >= device.aiming['ends']:
+            device.aiming = None
+            return 409, {'details': 'Aiming not running, nothing to stop'}
+        device.aiming = None
+        return 200, {'status': 'Stopping aiming now'}
+
+    def get_bridge_table(self, device, params, data, token):
+        return 200, device.spec.example('/bridge_table', 'GET') or {'bridge_table': []}
+
+    def post_poe_reset(self, device, params, data, token):
+        port = data.get('port')
+        if not port:
+            return 400, {'details': 'Port not provided'}
+        ports = device.current_config.get('interfaces', {}).get('ports', {})
+        if port not in ports:
+            return 400, {'details': 'Port not valid'}
+        if 'poe_out' not in ports[port]:
+            return 400, {'details': 'Port does not support PoE out'}
+        return 200, {'status': 'ok'}
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.started
+        total = sum(self.requests.values())
+        lines = [f"{len(self.devices)} device(s), {total} request(s) in {elapsed:.0f}s ({total / elapsed:.0f}/s)"]
+        lines.extend(f"  {count:>8}  {route}" for route, count in self.requests.most_common())
+        return '\n'.join(lines)
+
+
+def raise_file_limit():
+    """Every device needs a listening socket; raise the open file limit as far as allowed."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parse 'tna_30x=0.7,tns_10x=0.3' into {'tna_30x': 0.7, 'tns_10x': 0.3}."""
+    mix = {}
+    for part in text.split(','):
+        family, _, share = part.partition('=')
+        if family.strip() not in FAMILIES:
+            raise argparse.ArgumentTypeError(f"unknown family {family!r}, choose from {', '.join(FAMILIES)}")
+        mix[family.strip()] = float(share or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate many Tachyon devices for load testing')
+    parser.add_argument('--devices', type=int, default=100, help='Number of simulated devices (default: 100)')
+    parser.add_argument('--network', default='127.20.0.0/16', help='Loopback network for device addresses (default: 127.20.0.0/16)')
+    parser.add_argument('--base-port', type=int, default=0, help='Give each device its own port from here on --bind instead')
+    parser.add_argument('--bind', default='127.0.0.1', help='Address used with --base-port (default: 127.0.0.1)')
+    parser.add_argument('--mix', type=parse_mix, default={'tna_30x': 1.0},
+                        help='Share of each family, e.g. tna_30x=0.7,tna_305=0.2,tns_10x=0.1 (default: tna_30x)')
+    parser.add_argument('--spec-version', action='append', default=[], metavar='FAMILY=VERSION',
+                        help='Spec version a family behaves like, e.g. tna_30x=v1.0.7 (default: newest, repeatable)')
+    parser.add_argument('--firmware', default='1.12.1 rev 54920', help='Firmware version the devices start with')
+    parser.add_argument('-u', '--username', default='root', help='Accepted username (default: root)')
+    parser.add_argument('-p', '--password', default='admin', help='Accepted password (default: admin)')
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds of latency added to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra latency of up to this many milliseconds')
+    parser.add_argument('--cgi-time', type=float, default=0,
+                        help='Milliseconds of processing per request, one request at a time per device')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with HTTP 500')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Fraction of requests whose connection is dropped')
+    parser.add_argument('--download-time', type=float, default=20, help='Seconds a firmware download takes (default: 20)')
+    parser.add_argument('--flash-time', type=float, default=30, help='Seconds flashing takes (default: 30)')
+    parser.add_argument('--reboot-time', type=float, default=60, help='Seconds a reboot takes (default: 60)')
+    parser.add_argument('--update-failure-rate', type=float, default=0, help='Fraction of downloads and flashes that fail')
+    parser.add_argument('--speedtest-time', type=float, default=10, help='Seconds a speedtest runs (default: 10)')
+    parser.add_argument('--stations-per-ap', type=int, default=0,
+                        help='Group the devices into APs with this many stations each (default: no topology)')
+    parser.add_argument('--seed', type=int, help='Random seed, for reproducible runs')
+    parser.add_argument('--ip-file', help='Write the device addresses to this file, one per line')
+    args = parser.parse_args()
+
+    versions = dict(item.split('=', 1) for item in args.spec_version)
+    simulator = Simulator(args.devices, args.network, args.base_port, args.bind, args.mix, versions, args.firmware,
+                          args.username, args.password, args.latency / 1000, args.jitter / 1000, args.cgi_time / 1000,
+                          args.error_rate, args.drop_rate, args.download_time, args.flash_time, args.reboot_time,
+                          args.update_failure_rate, args.speedtest_time, args.seed,
+                          stations_per_ap=args.stations_per_ap)
+    if args.ip_file:
+        with open(args.ip_file, 'w') as f:
+            f.write('\n'.join(device.address for device in simulator.devices) + '\n')
+
+    async def serve():
+        await simulator.start()
+        counts = Counter(f"{device.spec.family} {device.spec.version}" for device in simulator.devices)
+        print(f"Simulating {len(simulator.devices)} device(s) from {simulator.devices[0].address} to "
+              f"{simulator.devices[-1].address}: " + ', '.join(f"{count} {name}" for name, count in counts.items()),
+              file=sys.stderr)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    print(simulator.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Firmware Mirror Server
+Serves firmware images to many devices at once: keep-alive, HTTP Range/resume,
+zero-copy sendfile, per-client and total bandwidth shaping, a checksum manifest
+and a live per-device download progress view.
+
+Usage: python3 firmware_mirror.py --dir ./firmware --bind 192.168.101.69 --port 8000
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+CHUNK_SIZE = 256 * 1024
+
+
+class TokenBucket:
+    """Thread-safe token bucket used to cap a transfer rate in bytes/second."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int):
+        """Block until `amount` bytes may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount or self.tokens >= self.rate:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(min(wait, 0.5))
+
+
+class DownloadProgress:
+    """Per-client download progress, shown on /progress."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients: Dict[str, dict] = {}
+
+    def update(self, client: str, name: str, total: int, sent: int, done: bool = False):
+        with self.lock:
+            entry = self.clients.get(client)
+            if entry is None or entry['file'] != name:
+                entry = self.clients[client] = {'file': name, 'size': total, 'sent': 0,
+                                                'started': time.time(), 'status': 'downloading'}
+            entry['sent'] = max(entry['sent'], sent)
+            entry['updated'] = time.time()
+            if done and entry['sent'] >= total:
+                entry['status'] = 'complete'
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self.lock:
+            result = {}
+            for client, entry in self.clients.items():
+                elapsed = max(entry['updated'] - entry['started'], 0.001)
+                result[client] = dict(entry, percent=round(100.0 * entry['sent'] / max(entry['size'], 1), 1),
+                                      mbps=round(entry['sent'] * 8 / elapsed / 1e6, 2))
+            return result
+
+    def render(self) -> str:
+        lines = [f"{'Device':<20}{'File':<60}{'Progress':>10}{'Mbps':>10}  Status"]
+        for client, entry in sorted(self.snapshot().items()):
+            lines.append(f"{client:<20}{entry['file'][:59]:<60}{entry['percent']:>9}%{entry['mbps']:>10}  {entry['status']}")
+        return '\n'.join(lines) + '\n'
+
+
+class FirmwareMirror(ThreadingHTTPServer):
+    """Threaded HTTP/1.1 server for the files in one directory."""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, directory: str, bind: str = '0.0.0.0', port: int = 8000,
+                 client_rate: float = 0, total_rate: float = 0):
+        """
+        Args:
+            directory: Directory containing the firmware images to serve.
+            bind: Address to listen on.
+            port: Port to listen on.
+            client_rate: Per-client bandwidth cap in Mbit/s, 0 for no limit.
+            total_rate: Total bandwidth cap in Mbit/s, 0 for no limit.
+        """
+        super().__init__((bind, port), MirrorRequestHandler)
+        self.directory = os.path.abspath(directory)
+        self.client_rate = client_rate * 1e6 / 8
+        self.total_bucket = TokenBucket(total_rate * 1e6 / 8) if total_rate else None
+        self.client_buckets: Dict[str, TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+        self.progress = DownloadProgress()
+        self.checksums: Dict[str, Tuple[float, int, str]] = {}
+        self.checksums_lock = threading.Lock()
+
+    def client_bucket(self, client: str) -> Optional[TokenBucket]:
+        if not self.client_rate:
+            return None
+        with self.buckets_lock:
+            if client not in self.client_buckets:
+                self.client_buckets[client] = TokenBucket(self.client_rate)
+            return self.client_buckets[client]
+
+    def resolve(self, name: str) -> Optional[str]:
+        """Map a request path to a file inside the mirror directory."""
+        path = os.path.abspath(os.path.join(self.directory, name.lstrip('/')))
+        if os.path.dirname(path) != self.directory or not os.path.isfile(path):
+            return None
+        return path
+
+    def sha256(self, path: str) -> str:
+        """SHA-256 of a file, cached until its size or mtime changes."""
+        stat = os.stat(path)
+        with self.checksums_lock:
+            cached = self.checksums.get(path)
+            if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+                return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        with self.checksums_lock:
+            self.checksums[path] = (stat.st_mtime, stat.st_size, digest.hexdigest())
+        return digest.hexdigest()
+
+    def manifest(self) -> Dict[str, dict]:
+        manifest = {}
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                manifest[name] = {'size': os.path.getsize(path), 'sha256': self.sha256(path)}
+        return manifest
+
+    def url_for(self, host: str, name: str) -> str:
+        return f"http://{host}:{self.server_address[1]}/{os.path.basename(name)}"
+
+    def start(self) -> threading.Thread:
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FirmwareMirror
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, code: int, body: bytes, content_type: str):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def parse_range(self, size: int) -> Optional[Tuple[int, int]]:
+        """Parse a single-range Range header into an inclusive (start, end) tuple.
+
+        Returns None for no/unsupported Range header, or (-1, -1) if unsatisfiable.
+        """
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', '').strip())
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+        if start >= size or start > end:
+            return (-1, -1)
+        return (start, end)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path)
+        if path in ('/manifest.json', '/SHA256SUMS'):
+            manifest = self.server.manifest()
+            if path == '/SHA256SUMS':
+                body = ''.join(f"{entry['sha256']}  {name}\n" for name, entry in manifest.items())
+                return self.send_body(200, body.encode(), 'text/plain')
+            return self.send_body(200, json.dumps(manifest, indent=2).encode(), 'application/json')
+        if path == '/progress':
+            return self.send_body(200, self.server.progress.render().encode(), 'text/plain')
+        if path == '/progress.json':
+            return self.send_body(200, json.dumps(self.server.progress.snapshot()).encode(), 'application/json')
+
+        file_path = self.server.resolve(path)
+        if not file_path:
+            return self.send_body(404, b'Not found\n', 'text/plain')
+        self.send_file(file_path)
+
+    def send_file(self, file_path: str):
+        size = os.path.getsize(file_path)
+        byte_range = self.parse_range(size)
+        if byte_range == (-1, -1):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1 if size else 0
+
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(os.path.getmtime(file_path)))
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.wfile.flush()
+
+        client = self.client_address[0]
+        name = os.path.basename(file_path)
+        client_bucket = self.server.client_bucket(client)
+        total_bucket = self.server.total_bucket
+        offset = start
+        with open(file_path, 'rb') as f:
+            while offset <= end:
+                count = min(CHUNK_SIZE, end - offset + 1)
+                if client_bucket:
+                    client_bucket.consume(count)
+                if total_bucket:
+                    total_bucket.consume(count)
+                sent = self.connection.sendfile(f, offset, count)
+                if not sent:
+                    break
+                offset += sent
+                self.server.progress.update(client, name, size, offset)
+        self.server.progress.update(client, name, size, offset, done=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Firmware mirror server for Tachyon device upgrades')
+    parser.add_argument('-d', '--dir', default='.', help='Directory containing the firmware images (default: current directory)')
+    parser.add_argument('-b', '--bind', default='0.0.0.0', help='Address to listen on (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--client-rate', type=float, default=0, help='Per-device bandwidth cap in Mbit/s (default: no limit)')
+    parser.add_argument('--total-rate', type=float, default=0, help='Total bandwidth cap in Mbit/s (default: no limit)')
+    args = parser.parse_args()
+
+    mirror = FirmwareMirror(args.dir, args.bind, args.port, args.client_rate, args.total_rate)
+    print(f"Serving {mirror.directory} on http://{args.bind}:{args.port}/")
+    for name, entry in mirror.manifest().items():
+        print(f"  {entry['sha256']}  {name} ({entry['size']} bytes)")
+    print("Checksums: /manifest.json, download progress: /progress")
+    try:
+        mirror.serve_forever()
+    except KeyboardInterrupt:
+        print("\nMirror stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
-import requests
 import argparse
-import time
-import socket
-import json
+import os
+import sys
+
+from firmware_mirror import FirmwareMirror
+from inventory import Inventory
+from upgrade_engine import FleetUpgrader, Mode
 
 # pip install requests
 # python3 firmware_upgrade.py -u root -p admin -f https://tachyon-networks.com/fw/tna-30x-1.11.1-r53981-20230426-tn-110-prs-squashfs-sysupgrade.bin -i 192.168.101.172
@@ -15,199 +17,75 @@ parser.add_argument('-f', '--firmware', type=str, required=True, help='Path to f
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to be upgraded')
 group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+parser.add_argument('-c', '--concurrency', type=int, default=10, help='Maximum number of devices upgraded at once (default: 10)')
+parser.add_argument('--per-subnet', type=int, default=0, help='Maximum number of devices upgraded at once in the same subnet (default: no limit)')
+parser.add_argument('--subnet-prefix', type=int, default=24, help='Prefix length used to group devices into subnets (default: 24)')
+parser.add_argument('--canary', type=int, default=1, help='Number of devices upgraded first; any canary failure halts the rollout (default: 1, 0 to disable)')
+parser.add_argument('--wave-size', type=int, default=0, help='Number of devices per wave after the canary wave (default: all remaining)')
+parser.add_argument('--max-failures', type=int, default=0, help='Failures tolerated per wave before the rollout is halted (default: 0)')
+parser.add_argument('--topology', action='store_true', help='Read the wireless links first and upgrade stations before the AP they are connected through')
+parser.add_argument('--per-link', type=int, default=0, help='Maximum number of firmware downloads at once through one AP radio, implies --topology (default: no limit)')
+stage = parser.add_mutually_exclusive_group()
+stage.add_argument('--stage', action='store_true', help='Only download and flash the firmware to the backup bootbank, without rebooting; the devices keep running')
+stage.add_argument('--activate', action='store_true', help='Only reboot the devices that have the firmware staged by --stage, and verify them')
+parser.add_argument('--force', action='store_true', help='Upgrade even if the device already runs the same or a newer version')
+parser.add_argument('--mirror-dir', type=str, help='Serve the firmware file from this local directory with the built-in mirror')
+parser.add_argument('--mirror-host', type=str, help='Address of this machine as seen by the devices (required with --mirror-dir)')
+parser.add_argument('--mirror-port', type=int, default=8000, help='Port for the built-in mirror (default: 8000)')
+parser.add_argument('--mirror-client-rate', type=float, default=0, help='Per-device mirror bandwidth cap in Mbit/s (default: no limit)')
+parser.add_argument('--mirror-total-rate', type=float, default=0, help='Total mirror bandwidth cap in Mbit/s (default: no limit)')
+parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs so devices are not logged into again')
+parser.add_argument('--journal', type=str, help='File the state changes of each device are appended to; a rollout run again with the same firmware and journal resumes where it stopped')
+parser.add_argument('--inventory', type=str, help='SQLite file of the fleet inventory; devices it saw on the new firmware within --inventory-ttl are skipped without a request')
+parser.add_argument('--inventory-ttl', type=float, default=3600, help='Seconds an inventory entry is trusted (default: 3600)')
+parser.add_argument('--profile', action='store_true', help='Print how long each phase of each upgrade took, and the latency of each API endpoint')
+parser.add_argument('--metrics', type=str, help='Write the request latency metrics to this file: Prometheus text if it ends in .prom, JSON otherwise')
+parser.add_argument('--capability-cache', type=str, help='File used to keep the model and firmware of each device between runs')
 args = parser.parse_args()
 
 if args.ip_file:
     with open(args.ip_file, 'r') as f:
-        ips = f.read().splitlines()
+        ips = [line.strip() for line in f.read().splitlines() if line.strip()]
 elif args.ip:
     ips = args.ip
 
-def make_request(method=None, url=None, headers=None, json=None):
-    """
-    Makes a REST API request using the provided HTTP/HTTPS method, URL, headers, JSON data.
-
-    Args:
-        method (str): The HTTP/HTTPS method to use for the request (e.g., "GET", "POST", "PUT", etc.).
-        url (str): The URL to send the request to.
-        headers (dict, optional): A dictionary of headers to include in the request.
-        json (dict, optional): A dictionary of JSON data to include in the request body.
-
-    Returns:
-        The response object returned by the requests library.
-    """
-
-    # Send the request and get the response object
-    response = requests.request(method=method, url=url, headers=headers, json=data)
-
-    # Return the response object
-    return response
-
-for ip in ips: # Iterate over all specified devices
-    
-    print(f"\nWill now attempt to upgrade device at {ip} ...")
-    cgi_url = f'http://{ip}/cgi.lua/apiv1/'
-    
-    # Post login credentials to your device in order to authenticate using REST interface.
-    url = cgi_url + 'login'
-    data = {'username': args.username, 'password': args.password}
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
-    response = make_request(method='post', url=url, headers=headers, json=data)
-
-    # Check success of authentication.
-    if response.status_code == 200:
-        print('Authentication successful!')
-    else:
-        print(response.content)
-        exit(1)
-
-    # Retrieve the authentication token.
-
-    auth_token = response.cookies.get_dict().get('token')
-    if not auth_token:
-        print(response.content)
-        exit(1)
-    
-    # Fetch firmware version from the device and check whether the versions aren't already the same.
-
-    url = cgi_url + 'stats?type=system'
-    headers = {'accept': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    response = make_request(method='get', url=url, headers=headers)
-
-    # Check success of firmware version fetch.
-    if response.status_code == 200:
-        specified_firmware_name = args.firmware.split('/')[-1]            # User specified firmware version
-        tokens = specified_firmware_name.split('-')
-        try:
-            fw_version = json.loads(response.content)['system']['fw_version'] # Existing device firmware version
-            version_number = fw_version.split()[0]
-            revision_number = fw_version.split()[2]
-            if (version_number in tokens) and ('r'+revision_number in tokens):
-                print(f"Device already has firmware version '{version_number} rev {revision_number}'.\n")
-                continue
-        except:  #v1.10.3 does not have firmware version in response.content
-            version_number = '1.10.3'
-            if version_number in tokens:
-                print(f"Device already has firmware version '{version_number}'.\n")
-                continue
-    else:
-        print(response.content)
-        exit(1)
-        
-    # Download firmware using REST interface
-    url = cgi_url + 'update'
-    data = {'firmware_url': args.firmware}
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    response = make_request(method='put',url=url, json=data, headers=headers)
-
-    if response.status_code == 200:
-        print(f"Firmware {args.firmware} started downloading.")
-    else:
-        print(response.content)
-        exit(1)
-
-    # Get firmware upgrade status after download
-    headers = {'accept': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    response = make_request(method='get', url=url, headers=headers)
-
-    if response.status_code != 200:
-        print(response.content)
-        exit(1)
-    else:
-        status = response.json()
-        print(f"Firmware upgrade status: {status['status']}")
-        
-    # Perform firmware upgrade
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    data = {'reset': False, 'force': False}
-    print("Will now wait up to 5 minutes for firmware download to finish...")
-    start_time = time.time()
-    while time.time() - start_time < 300:
-        response = make_request(method='post', url=url, json=data, headers=headers)
-        if response.status_code == 200:
-            print('Firmware was sucessfully downloaded! Device will be upgraded after reboot.')
-            break
-        time.sleep(2)
-
-    if response.status_code != 200:
-        print(response.content)
-        exit(1)
-
-    # Keep getting response status until firmware flashing is done
-    headers = {'accept': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    print("Will now wait up to 5 minutes for firmware flashing to complete...")
-    start_time = time.time()
-    while status['status'] != 'COMPLETE' and time.time() - start_time < 300:
-        response = make_request(method='get', url=url, headers=headers)
-        status = response.json()
-        print(f"Firmware upgrade status: {status['status']}")
-        time.sleep(5)
-
-    if status['status'] != 'COMPLETE':
-        print(f"Firmware flashing failed.")
-        exit(1)
-        
-    # Reboot system for firmware to be upgraded
-    url = cgi_url + 'reboot'
-    headers = {'accept': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    response = make_request(method='post', url=url, headers=headers)
-    if response.status_code == 200:
-        print(f"Device started rebooting! Waiting for it to finish...")
-        time.sleep(10)  # wait for device to start rebooting
-    else:
-        print(response.content)
-        exit(1)
-
-    # Wait for reboot to finish
-    start_time = time.time()
-    successful_reboot = False
-    print("Will now wait up to 5 minutes for device to reboot...")
-    while time.time() - start_time < 300:
-        try:
-            s = socket.create_connection((ip, 80), timeout=1)  # create a socket connection to the IP address
-            s.close()
-            print("Reboot finished successfully!")
-            successful_reboot = True
-            break
-        except OSError:
-            time.sleep(10)  # wait for the specified time before trying again
-
-    if not successful_reboot:
-        print("Can no longer reach device after reboot start! Reboot failed.")
-        exit(1)
-
-    # Post login credentials to your device once again in order to authenticate (necessary after reboot).
-    url = cgi_url + 'login'
-    data = {'username': args.username, 'password': args.password}
-    headers = {'accept': 'application/json', 'Content-Type': 'application/json'}
-    response = make_request(method='post', url=url, headers=headers, json=data)
-
-    # Check success of authentication.
-    if response.status_code == 200:
-        print('Authentication successful!')
-    else:
-        print(response.content)
-        exit(1)
-
-    # Retrieve the authentication token.
-
-    auth_token = response.cookies.get_dict().get('token')
-    if not auth_token:
-        print(response.content)
-        exit(1)
-        
-    # Fetch firmware version from the device.
-    url = cgi_url + 'stats?type=system'
-    headers = {'accept': 'application/json', 'Cookie': f'api_token={auth_token}'}
-    response = make_request(method='get', url=url, headers=headers)
-
-    # Check success of firmware version fetch.
-    if response.status_code == 200:
-        try:
-            print("Updated firmware version: " + json.loads(response.content)['system']['fw_version'] + "\n") # Print device firmware version.
-        except:
-            print("Updated firmware version: " + "v1.10.3" + "\n") # Print device firmware version.
-        
-    else:
-        print(response.content)
-        exit(1)
\ No newline at end of file
+firmware_url = args.firmware
+if args.mirror_dir:
+    if not args.mirror_host:
+        parser.error('--mirror-host is required with --mirror-dir')
+    mirror = FirmwareMirror(args.mirror_dir, port=args.mirror_port, client_rate=args.mirror_client_rate,
+                            total_rate=args.mirror_total_rate)
+    firmware_name = os.path.basename(args.firmware)
+    if not mirror.resolve(firmware_name):
+        parser.error(f"Firmware file {firmware_name} not found in {mirror.directory}")
+    print(f"Serving {firmware_name} (sha256 {mirror.sha256(mirror.resolve(firmware_name))}) from the built-in mirror")
+    mirror.start()
+    firmware_url = mirror.url_for(args.mirror_host, firmware_name)
+    print(f"Devices will download {firmware_url}, progress: http://{args.mirror_host}:{args.mirror_port}/progress")
+
+upgrader = FleetUpgrader(ips, args.username, args.password, firmware_url, force=args.force,
+                         concurrency=args.concurrency, per_subnet=args.per_subnet,
+                         subnet_prefix=args.subnet_prefix, canary=args.canary,
+                         wave_size=args.wave_size, max_failures=args.max_failures,
+                         token_cache=args.token_cache, capability_cache=args.capability_cache,
+                         inventory=Inventory(args.inventory) if args.inventory else None,
+                         inventory_ttl=args.inventory_ttl, journal=args.journal,
+                         mode=Mode.STAGE if args.stage else Mode.ACTIVATE if args.activate else Mode.UPGRADE)
+
+try:
+    if args.topology or args.per_link:
+        topology = upgrader.discover_topology(per_link=args.per_link)
+        print(f"Read {len(topology.devices)} device(s): {len(topology.upstream)} wireless link(s), "
+              f"{sum(topology.parent(ip) is not None for ip in topology.devices)} device(s) behind another one")
+    success = upgrader.run()
+except KeyboardInterrupt:
+    print("\n\n✗ Upgrade interrupted by user")
+    success = False
+
+print("\n" + upgrader.summary())
+if args.profile:
+    print("\nPhases (wall / in-request seconds):\n" + upgrader.profile())
+if args.metrics:
+    upgrader.metrics.write(args.metrics)
+    print(f"Request metrics written to {args.metrics}")
+sys.exit(0 if success else 1)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Fleet Query
+Answers questions about the whole fleet from the configs in a ConfigStore and
+the stats written by stats_collector.py, without a request to any device.
+Every scalar in them is indexed by its flattened key path and value, e.g.
+wireless.radios.wlan0.channel = 5 or stats.system.model = "TNA-303L", so a
+query looks up the devices of each predicate in the index and combines the
+sets, instead of reading every config.
+
+A query is predicates on key paths joined with AND, OR, NOT and parentheses.
+A path segment can be *, for any radio, user or port; config paths are as in
+config_diff.py but go down into lists too (system.users.1.username), and stats
+paths start with stats.:
+
+    wireless.radios.*.channel = 5 AND wireless.radios.*.channel_width = 2160
+    network.traffic_control.limit_upload.enabled = true OR NOT services.ntp.enabled
+    stats.system.cpu_usage_percent >= 80 AND stats.system.model ~ "^TNA-30"
+
+The index is updated incrementally: a device's new snapshot only touches the
+key paths whose value changed, and an unchanged config is not read at all.
+
+Usage: python3 fleet_query.py --store configs.db --stats stats.ndjson "system.users.*.username = guest"
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from config_store import ConfigStore
+
+TOKEN = re.compile(r'''\s*(?:
+    (?P<paren>[()])
+  | (?P<keyword>(?:AND|OR|NOT)(?![\w.*]))
+  | (?P<path>[\w.*:\-\[\]]+)\s*(?:(?P<op><=|>=|!=|=|<|>|~)\s*(?P<value>"(?:[^"\\]|\\.)*"|[^\s()]+))?
+)''', re.VERBOSE | re.IGNORECASE)
+
+
+class QueryError(ValueError):
+    """A query that can't be parsed."""
+
+
+def leaves(value: Any, prefix: str = '') -> Iterator[Tuple[str, Any]]:
+    """Every scalar of a config or stats payload with its dotted key path, list indices included.
+
+    Empty objects and lists are leaves of their own, so their path can still be asked for.
+    """
+    if isinstance(value, dict) and value:
+        for key, item in value.items():
+            yield from leaves(item, f"{prefix}.{key}" if prefix else str(key))
+    elif isinstance(value, list) and value:
+        for index, item in enumerate(value):
+            yield from leaves(item, f"{prefix}.{index}" if prefix else str(index))
+    else:
+        yield prefix, value
+
+
+def value_key(value: Any) -> str:
+    """Index key of a scalar; JSON keeps 1, 1.0, true and "1" apart."""
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+def parse_value(text: str) -> Any:
+    """A predicate's value, as JSON where possible (5, true, null, "text"), otherwise the bare text."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse(query: str):
+    """Parse a query into a tree of ('or', a, b), ('and', a, b), ('not', a) and ('pred', path, op, value).
+
+    Raises:
+        QueryError: If the query is not well-formed.
+    """
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN.match(query, position)
+        if not match or match.end() == position:
+            raise QueryError(f"Unexpected {query[position:position + 20]!r} at position {position}")
+        if match.group('paren'):
+            tokens.append(match.group('paren'))
+        elif match.group('keyword'):
+            tokens.append(match.group('keyword').upper())
+        else:
+            op = match.group('op')
+            tokens.append(('pred', match.group('path'), op or 'exists',
+                           parse_value(match.group('value')) if op else None))
+        position = match.end()
+        while position < len(query) and query[position].isspace():
+            position += 1
+
+    def expression(index: int):
+        node, index = term(index)
+        while index < len(tokens) and tokens[index] == 'OR':
+            right, index = term(index + 1)
+            node = ('or', node, right)
+        return node, index
+
+    def term(index: int):
+        node, index = factor(index)
+        while index < len(tokens) and tokens[index] == 'AND':
+            right, index = factor(index + 1)
+            node = ('and', node, right)
+        return node, index
+
+    def factor(index: int):
+        if index >= len(tokens):
+            raise QueryError('Query ends early')
+        token = tokens[index]
+        if token == 'NOT':
+            node, index = factor(index + 1)
+            return ('not', node), index
+        if token == '(':
+            node, index = expression(index + 1)
+            if index >= len(tokens) or tokens[index] != ')':
+                raise QueryError("Missing ')'")
+            return node, index + 1
+        if isinstance(token, tuple):
+            return token, index + 1
+        raise QueryError(f"Unexpected {token!r}")
+
+    tree, end = expression(0)
+    if end != len(tokens):
+        raise QueryError(f"Unexpected {tokens[end]!r}")
+    return tree
+
+
+def predicates(tree) -> List[tuple]:
+    """The predicates of a query that a device matches by having a value, i.e. not under a NOT."""
+    if tree[0] == 'pred':
+        return [tree]
+    if tree[0] == 'not':
+        return []
+    return predicates(tree[1]) + predicates(tree[2])
+
+
+class FleetIndex:
+    """Inverted index from key path and value to the devices that have it.
+
+    Each device has a document per source (its config, its stats), kept as
+    {path: value key} so that a new snapshot is applied as a diff.
+    """
+
+    def __init__(self):
+        # path -> value key -> devices
+        self.postings: Dict[str, Dict[str, Set[str]]] = {}
+        # (device, prefix) -> {path: value key}
+        self.documents: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self.devices: Set[str] = set()
+        self.prefixes: Set[str] = set()
+        self.values: Dict[str, Any] = {}
+        self.patterns: Dict[str, List[str]] = {}
+
+    def update(self, device: str, data: Any, prefix: str = '') -> int:
+        """Index a device's new config (or, with a prefix such as 'stats', other payload); returns the paths changed."""
+        document = {sys.intern(path): value_key(value) for path, value in leaves(data, prefix)}
+        old = self.documents.get((device, prefix), {})
+        changed = 0
+        for path, key in old.items():
+            if document.get(path) != key:
+                self.unpost(path, key, device)
+                changed += 1
+        for path, key in document.items():
+            if old.get(path) != key:
+                self.post(path, key, device)
+                changed += path not in old
+        self.documents[(device, prefix)] = document
+        self.prefixes.add(prefix)
+        self.devices.add(device)
+        return changed
+
+    def remove(self, device: str):
+        for source in [source for source in self.documents if source[0] == device]:
+            for path, key in self.documents.pop(source).items():
+                self.unpost(path, key, device)
+        self.devices.discard(device)
+
+    def post(self, path: str, key: str, device: str):
+        values = self.postings.get(path)
+        if values is None:
+            values = self.postings[path] = {}
+            self.patterns.clear()  # a new path may match a cached pattern
+        values.setdefault(key, set()).add(device)
+
+    def unpost(self, path: str, key: str, device: str):
+        values = self.postings[path]
+        devices = values[key]
+        devices.discard(device)
+        if not devices:
+            del values[key]
+            if not values:
+                del self.postings[path]
+                self.patterns.clear()
+
+    def value(self, key: str) -> Any:
+        if key not in self.values:
+            self.values[key] = json.loads(key)
+        return self.values[key]
+
+    def paths(self, pattern: str) -> List[str]:
+        """The indexed paths a path pattern matches; * stands for one segment."""
+        if '*' not in pattern:
+            return [pattern] if pattern in self.postings else []
+        paths = self.patterns.get(pattern)
+        if paths is None:
+            regex = re.compile('\\.'.join('[^.]+' if part == '*' else re.escape(part) for part in pattern.split('.')))
+            paths = self.patterns[pattern] = sorted(path for path in self.postings if regex.fullmatch(path))
+        return paths
+
+    def matching_keys(self, path: str, op: str, value: Any) -> List[str]:
+        """The value keys under `path` that satisfy a predicate."""
+        values = self.postings.get(path, {})
+        if op == 'exists':
+            return list(values)
+        if op == '=':
+            key = value_key(value)
+            return [key] if key in values else []
+        if op == '~':
+            regex = re.compile(str(value))
+            return [key for key in values if regex.search(self.text(key))]
+        return [key for key in values if compare(self.value(key), op, value)]
+
+    def text(self, key: str) -> str:
+        value = self.value(key)
+        return value if isinstance(value, str) else key
+
+    def evaluate(self, tree) -> Set[str]:
+        kind = tree[0]
+        if kind == 'pred':
+            _, pattern, op, value = tree
+            devices = set()
+            for path in self.paths(pattern):
+                values = self.postings[path]
+                for key in self.matching_keys(path, op, value):
+                    devices |= values[key]
+            return devices
+        if kind == 'not':
+            return self.devices - self.evaluate(tree[1])
+        left, right = self.evaluate(tree[1]), self.evaluate(tree[2])
+        return left & right if kind == 'and' else left | right
+
+    def query(self, query: str) -> Set[str]:
+        """The devices a query matches.
+
+        Raises:
+            QueryError: If the query is not well-formed.
+        """
+        return self.evaluate(parse(query))
+
+    def explain(self, device: str, query: str) -> List[Tuple[str, Any]]:
+        """The (path, value) pairs of a device that its query's predicates matched, e.g. which radio."""
+        found = []
+        for _, pattern, op, value in predicates(parse(query)):
+            for path in self.paths(pattern):
+                keys = set(self.matching_keys(path, op, value))
+                for prefix in self.prefixes:
+                    document = self.documents.get((device, prefix)) or {}
+                    if document.get(path) in keys:
+                        found.append((path, self.value(document[path])))
+        return list(dict.fromkeys(found))
+
+    @property
+    def size(self) -> int:
+        """Number of (path, value, device) entries."""
+        return sum(len(document) for document in self.documents.values())
+
+
+def compare(found: Any, op: str, value: Any) -> bool:
+    if op == '!=':
+        return found != value
+    # Only numbers with numbers and strings with strings; bools are not numbers here
+    numbers = (int, float)
+    if isinstance(found, bool) or isinstance(value, bool):
+        return False
+    if not (isinstance(found, numbers) and isinstance(value, numbers) or isinstance(found, str) and isinstance(value, str)):
+        return False
+    return {'<': found < value, '<=': found <= value, '>': found > value, '>=': found >= value}[op]
+
+
+class StoreFeed:
+    """Apply the snapshots a ConfigStore records to a FleetIndex, each new one only once."""
+
+    def __init__(self, index: FleetIndex, store: ConfigStore):
+        self.index = index
+        self.store = store
+        self.last_id = 0
+        self.roots: Dict[str, str] = {}
+
+    def poll(self) -> int:
+        """Index the snapshots recorded since the last poll; returns the devices whose config changed."""
+        newest = {}
+        for snapshot in self.store.added(self.last_id):
+            newest[snapshot.address] = snapshot
+            self.last_id = snapshot.id
+        changed = 0
+        for ip, snapshot in newest.items():
+            if self.roots.get(ip) != snapshot.root:
+                self.index.update(ip, self.store.get(snapshot.root))
+                self.roots[ip] = snapshot.root
+                changed += 1
+        return changed
+
+
+class StatsFeed:
+    """Apply the samples stats_collector.py appends to an NDJSON file to a FleetIndex, under stats."""
+
+    def __init__(self, index: FleetIndex, path: str):
+        self.index = index
+        self.path = path
+        self.offset = 0
+
+    def poll(self) -> int:
+        """Index the samples appended since the last poll, the newest of each device; returns how many devices."""
+        if not os.path.exists(self.path):
+            return 0
+        newest = {}
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # being written; read it on the next poll
+                self.offset += len(line)
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    continue
+                if sample.get('ok') and isinstance(sample.get('stats'), dict):
+                    newest[sample['ip']] = sample['stats']
+        for ip, stats in newest.items():
+            self.index.update(ip, stats, 'stats')
+        return len(newest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the configs and stats of many Tachyon devices offline')
+    parser.add_argument('queries', nargs='*', help='Queries to run; without any, they are read from stdin')
+    parser.add_argument('--store', type=str, help='SQLite file written by config_store.py')
+    parser.add_argument('--stats', type=str, help='NDJSON file written by stats_collector.py')
+    parser.add_argument('--paths', type=str, metavar='PATTERN', help='List the indexed key paths matching a pattern')
+    parser.add_argument('--limit', type=int, default=4, help='Matched values shown per device (default: 4)')
+    args = parser.parse_args()
+    if not (args.store or args.stats):
+        parser.error('--store or --stats is required')
+
+    index = FleetIndex()
+    feeds = []
+    if args.store:
+        feeds.append(StoreFeed(index, ConfigStore(args.store)))
+    if args.stats:
+        feeds.append(StatsFeed(index, args.stats))
+    started = time.monotonic()
+    for feed in feeds:
+        feed.poll()
+    print(f"Indexed {len(index.devices)} device(s), {len(index.postings)} key path(s), {index.size} value(s) "
+          f"in {time.monotonic() - started:.2f}s", file=sys.stderr)
+
+    if args.paths:
+        for path in index.paths(args.paths):
+            print(f"{path}  ({len(index.postings[path])} value(s))")
+        return
+
+    def run(query: str):
+        started = time.monotonic()
+        try:
+            devices = index.query(query)
+        except (QueryError, re.error) as e:
+            print(f"✗ {e}", file=sys.stderr)
+            return
+        elapsed = time.monotonic() - started
+        for device in sorted(devices):
+            matched = index.explain(device, query)
+            shown = ', '.join(f"{path}={json.dumps(value)}" for path, value in matched[:args.limit])
+            more = f" (+{len(matched) - args.limit} more)" if len(matched) > args.limit else ''
+            print(f"{device:<20}{shown}{more}")
+        print(f"{len(devices)} of {len(index.devices)} device(s) in {elapsed * 1000:.1f}ms", file=sys.stderr)
+
+    if args.queries:
+        for query in args.queries:
+            run(query)
+        return
+    interactive = sys.stdin.isatty()
+    while True:
+        try:
+            query = input('query> ' if interactive else '')
+        except EOFError:
+            break
+        if query.strip():
+            for feed in feeds:
+                feed.poll()  # snapshots and samples recorded meanwhile
+            run(query)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Fleet Inventory
+Keeps what the last /stats?type=system of each device said - model, hostname,
+active and backup bootbank versions, uptime and capabilities - in a SQLite
+file keyed by serial number, so the next run can plan from it instead of
+logging into every device first. An entry younger than the TTL is trusted: the
+upgrader skips a device the inventory shows on the target firmware without a
+single request, and only the remaining devices are touched.
+
+The inventory listens to the shared CapabilityRegistry, so every system stats
+response any tool reads updates its device's entry, one row at a time.
+
+Usage: python3 inventory.py -u root -p admin -if ips.txt --inventory fleet.db --ttl 3600
+"""
+
+import argparse
+import asyncio
+import json
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from async_client import AsyncDeviceSession
+from tachyon_client import (CAPABILITIES, ApiError, AsyncDeviceClient, Capabilities, CapabilityRegistry,
+                            parse_version, system_firmware)
+from tachyon_session import AuthenticationError, TokenCache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    serial TEXT PRIMARY KEY,
+    address TEXT,
+    model TEXT,
+    hostname TEXT,
+    active_version TEXT,
+    backup_version TEXT,
+    uptime INTEGER,
+    capabilities TEXT,
+    seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_address ON devices (address);
+'''
+COLUMNS = ('serial', 'address', 'model', 'hostname', 'active_version', 'backup_version', 'uptime', 'capabilities',
+           'seen')
+
+
+class InventoryEntry:
+    """One device as its last /stats?type=system described it."""
+
+    __slots__ = COLUMNS
+
+    def __init__(self, *values):
+        for name, value in zip(COLUMNS, values):
+            setattr(self, name, value)
+
+    @property
+    def version(self) -> Optional[Tuple[str, int]]:
+        """The active firmware, e.g. ('1.12.3', 54999)."""
+        return parse_version(self.active_version) if self.active_version else None
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.seen
+
+    @property
+    def booted(self) -> Optional[float]:
+        """When the device booted, as far as the last uptime tells."""
+        return self.seen - self.uptime if self.uptime is not None else None
+
+    def to_capabilities(self) -> Optional[Capabilities]:
+        return Capabilities.from_dict(json.loads(self.capabilities)) if self.capabilities else None
+
+
+class Inventory:
+    """Devices by serial number in a SQLite file, located by their last address.
+
+    Args:
+        path: SQLite file, created if missing; ':memory:' for one run only.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        self.lock = threading.Lock()
+        # Shared by the worker threads and the event loop of the tools, behind the lock
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def attach(self, registry: CapabilityRegistry = CAPABILITIES):
+        """Record every system stats the registry learns from, and let it know the stored capabilities."""
+        if self.record not in registry.listeners:
+            registry.listeners.append(self.record)
+        for entry in self.entries():
+            capabilities = entry.to_capabilities()
+            if capabilities is not None and entry.address:
+                registry.add(entry.address, capabilities)
+
+    def detach(self, registry: CapabilityRegistry = CAPABILITIES):
+        if self.record in registry.listeners:
+            registry.listeners.remove(self.record)
+
+    def record(self, ip: str, system: dict, capabilities: Optional[Capabilities] = None):
+        """Store a device's /stats?type=system, replacing what was known about its serial number."""
+        serial = system.get('serial_no') or ip
+        bootbanks = system.get('bootbanks') or {}
+        row = (serial, ip, system.get('model'), system.get('hostname'), system_firmware(system),
+               (bootbanks.get('backup') or {}).get('version'), system.get('uptime'),
+               json.dumps(capabilities.to_dict()) if capabilities is not None else None, time.time())
+        with self.lock:
+            # An address belongs to the device seen there last
+            self.db.execute('UPDATE devices SET address = NULL WHERE address = ? AND serial != ?', (ip, serial))
+            self.db.execute(f"INSERT OR REPLACE INTO devices VALUES ({', '.join('?' * len(COLUMNS))})", row)
+
+    def lookup(self, ip: str, ttl: Optional[float] = None) -> Optional[InventoryEntry]:
+        """The entry of the device last seen at `ip`; with a `ttl`, only if it was seen within `ttl` seconds."""
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM devices WHERE address = ?", (ip,)).fetchone()
+        if row is None:
+            return None
+        entry = InventoryEntry(*row)
+        return entry if ttl is None or entry.age <= ttl else None
+
+    def get(self, serial: str) -> Optional[InventoryEntry]:
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM devices WHERE serial = ?", (serial,)).fetchone()
+        return InventoryEntry(*row) if row else None
+
+    def entries(self) -> List[InventoryEntry]:
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM devices ORDER BY address").fetchall()
+        return [InventoryEntry(*row) for row in rows]
+
+    def stale(self, ips: List[str], ttl: float) -> List[str]:
+        """The devices of `ips` without an entry seen within `ttl` seconds."""
+        return [ip for ip in dict.fromkeys(ips) if self.lookup(ip, ttl) is None]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class InventoryRefresher:
+    """Read /stats?type=system of the devices whose entry is older than the TTL.
+
+    The responses reach the inventory through the registry it is attached to.
+
+    Args:
+        inventory: Inventory to refresh, attached to CAPABILITIES.
+        username: Login username.
+        password: Login password.
+        ttl: Seconds an entry is trusted; 0 refreshes every device.
+        timeout: Per-request timeout in seconds.
+        max_in_flight: Maximum number of devices refreshed at once.
+        token_cache: Optional TokenCache shared with other tools.
+    """
+
+    def __init__(self, inventory: Inventory, username: str, password: str, ttl: float = 3600, timeout: float = 10,
+                 max_in_flight: int = 200, token_cache: Optional[TokenCache] = None):
+        self.inventory = inventory
+        self.username = username
+        self.password = password
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.token_cache = token_cache or TokenCache()
+        self.errors: Dict[str, str] = {}
+        self.refreshed = 0
+
+    async def refresh_device(self, ip: str, semaphore: asyncio.Semaphore):
+        client = AsyncDeviceClient(AsyncDeviceSession(ip, self.username, self.password, self.token_cache,
+                                                      timeout=self.timeout))
+        async with semaphore:
+            try:
+                await client.system(timeout=self.timeout)
+                self.refreshed += 1
+            except (ApiError, AuthenticationError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.errors[ip] = str(e) or type(e).__name__
+            finally:
+                await client.session.close()
+
+    async def run(self, ips: List[str]):
+        """Refresh the stale devices of `ips` once."""
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        await asyncio.gather(*(self.refresh_device(ip, semaphore) for ip in self.inventory.stale(ips, self.ttl)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep an inventory of many Tachyon devices')
+    parser.add_argument('-u', '--username', type=str, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to refresh')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--inventory', type=str, required=True, help='SQLite file the inventory is kept in')
+    parser.add_argument('--ttl', type=float, default=3600,
+                        help='Seconds an entry is trusted before the device is asked again (default: 3600)')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds (default: 10)')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='Maximum devices refreshed at once (default: 200)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    args = parser.parse_args()
+
+    inventory = Inventory(args.inventory)
+    inventory.attach()
+    if args.ip or args.ip_file:
+        if not (args.username and args.password):
+            parser.error('-u and -p are required to refresh devices')
+        if args.ip_file:
+            with open(args.ip_file) as f:
+                ips = [line.strip() for line in f if line.strip()]
+        else:
+            ips = args.ip
+        refresher = InventoryRefresher(inventory, args.username, args.password, ttl=args.ttl, timeout=args.timeout,
+                                       max_in_flight=args.max_in_flight, token_cache=TokenCache(args.token_cache))
+        started = time.monotonic()
+        asyncio.run(refresher.run(ips))
+        print(f"Refreshed {refresher.refreshed} of {len(set(ips))} device(s) in {time.monotonic() - started:.1f}s, "
+              f"the others were seen within {args.ttl:.0f}s", file=sys.stderr)
+        for ip, error in refresher.errors.items():
+            print(f"[{ip}] ✗ {error}", file=sys.stderr)
+
+    print(f"{'Device':<20}{'Serial':<18}{'Model':<12}{'Active':<20}{'Backup':<20}{'Uptime':>9}{'Seen':>9}  Hostname")
+    for entry in inventory.entries():
+        print(f"{entry.address or '-':<20}{entry.serial:<18}{entry.model or '':<12}{entry.active_version or '':<20}"
+              f"{entry.backup_version or '':<20}{entry.uptime if entry.uptime is not None else '':>9}"
+              f"{entry.age:>8.0f}s  {entry.hostname or ''}")
+    inventory.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+MAC Address Index
+Finds where a MAC or IP address sits in the network without asking every AP.
+The index maps MAC addresses to the (device, bridge, iface) entries of the
+/bridge_table of each device, and the MAC, IPv4 and IPv6 addresses of wireless
+peers to the AP and radio they are connected to, from the peers[] of
+/stats?type=wireless. A client MAC learned on a peer's prs interface is thus
+found behind that peer.
+
+Addresses are kept as integers and every lookup is a dict lookup. Refreshes are
+incremental: the tables of a device are compared with the ones indexed before,
+and only the entries that appeared or went away are touched, so an unchanged
+table costs no index update at all.
+
+Usage: python3 mac_index.py -u root -p admin -if ips.txt --index macs.json 78:5e:e8:d0:10:20 192.168.201.150
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import sys
+import time
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from async_client import AsyncDeviceSession
+from tachyon_client import CAPABILITIES, ApiError, AsyncDeviceClient
+from tachyon_session import AuthenticationError, TokenCache
+
+# Bits of a name id (device, bridge, iface or radio) in a packed location
+NAME_BITS = 20
+NAME_MASK = (1 << NAME_BITS) - 1
+ENTRY_MASK = (1 << 2 * NAME_BITS) - 1
+
+# (peer MAC, IPv4, IPv6, iface id, radio id); a missing address is 0
+Peer = Tuple[int, int, int, int, int]
+
+
+def mac_to_int(mac: str) -> Optional[int]:
+    """78:5E:E8:D0:10:22 (or 78-5e-e8-d0-10-22, 785ee8d01022) as an integer, None if it isn't a MAC."""
+    digits = mac.replace(':', '').replace('-', '').replace('.', '')
+    if len(digits) != 12:
+        return None
+    try:
+        return int(digits, 16)
+    except ValueError:
+        return None
+
+
+def int_to_mac(value: int) -> str:
+    digits = f"{value:012x}"
+    return ':'.join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def ip_to_int(address) -> int:
+    """An IPv4 or IPv6 address as an integer, 0 if there is none."""
+    try:
+        return int(ipaddress.ip_address(address)) if address else 0
+    except ValueError:
+        return 0
+
+
+class Location:
+    """Where an address was seen: a bridge table entry, or the AP of a wireless peer.
+
+    For a bridge table entry on an interface of a wireless peer, `peer` and
+    `radio` name that peer and the radio of the AP it is connected to.
+    """
+
+    __slots__ = ('device', 'iface', 'bridge', 'peer', 'radio')
+
+    def __init__(self, device: str, iface: str, bridge: Optional[str] = None, peer: Optional[str] = None,
+                 radio: Optional[str] = None):
+        self.device = device
+        self.iface = iface
+        self.bridge = bridge
+        self.peer = peer
+        self.radio = radio
+
+    def __repr__(self) -> str:
+        return f"Location({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+    def __str__(self) -> str:
+        text = f"{self.device:<18}{(self.bridge + '/' if self.bridge else '') + self.iface:<16}"
+        if self.peer:
+            text += f"peer {self.peer} on {self.radio or '?'}"
+        return text.rstrip()
+
+
+class DeviceTables:
+    """The tables of one device as indexed, kept to see what a refresh changed."""
+
+    __slots__ = ('id', 'bridge', 'peers', 'refreshed', 'error')
+
+    def __init__(self, device_id: int):
+        self.id = device_id
+        # MAC << 2 * NAME_BITS | bridge id << NAME_BITS | iface id, per bridge table entry
+        self.bridge: FrozenSet[int] = frozenset()
+        self.peers: FrozenSet[Peer] = frozenset()
+        self.refreshed: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class MacIndex:
+    """MAC, IPv4 and IPv6 addresses of the fleet to the places they were seen.
+
+    A peer that roams to another AP is found there, also after the AP it left
+    stopped reporting it:
+
+    >>> index = MacIndex()
+    >>> peer = {'mac': '78:5e:e8:d0:10:20', 'ipv4': '10.0.0.5', 'iface_name': 'prs0', 'radio_name': 'wlan0'}
+    >>> index.update_peers('A', [peer]), index.update_peers('B', [peer]), index.update_peers('A', [])
+    (True, True, True)
+    >>> index.lookup('10.0.0.5')
+    [Location(device='B', iface='prs0', bridge=None, peer='78:5e:e8:d0:10:20', radio='wlan0')]
+
+    Args:
+        path: Optional JSON file to keep the index between runs.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        # Device addresses, bridge, iface and radio names, stored once each
+        self.names: List[str] = []
+        self.name_ids: Dict[str, int] = {}
+        self.devices: Dict[str, DeviceTables] = {}
+        # MAC -> packed locations: device id << 2 * NAME_BITS | bridge id << NAME_BITS | iface id
+        self.macs: Dict[int, Tuple[int, ...]] = {}
+        # Peer MAC -> device id << 2 * NAME_BITS | iface id << NAME_BITS | radio id
+        self.peer_macs: Dict[int, int] = {}
+        self.peer_ips: Dict[int, int] = {}  # IPv4 or IPv6 -> peer MAC
+        self.peer_ifaces: Dict[int, int] = {}  # device id << NAME_BITS | iface id -> peer MAC
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.load(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+    def name_id(self, name: str) -> int:
+        index = self.name_ids.get(name)
+        if index is None:
+            index = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def tables(self, ip: str) -> DeviceTables:
+        tables = self.devices.get(ip)
+        if tables is None:
+            tables = self.devices[ip] = DeviceTables(self.name_id(ip))
+        return tables
+
+    def update_bridge_table(self, ip: str, table) -> bool:
+        """Index the entries of a GET /bridge_table; returns whether they changed."""
+        tables = self.tables(ip)
+        entries = set()
+        # An empty table is reported as {}
+        for entry in table if isinstance(table, list) else ():
+            mac = mac_to_int(entry.get('mac') or '')
+            if mac is not None:
+                entries.add(mac << 2 * NAME_BITS | self.name_id(entry.get('bridge') or '') << NAME_BITS
+                            | self.name_id(entry.get('iface') or ''))
+        entries = frozenset(entries)
+        if entries == tables.bridge:
+            return False
+        self.index_bridge_table(tables, entries)
+        return True
+
+    def index_bridge_table(self, tables: DeviceTables, entries: FrozenSet[int]):
+        device = tables.id << 2 * NAME_BITS
+        for entry in tables.bridge - entries:
+            mac = entry >> 2 * NAME_BITS
+            locations = tuple(location for location in self.macs[mac] if location != device | entry & ENTRY_MASK)
+            if locations:
+                self.macs[mac] = locations
+            else:
+                del self.macs[mac]
+        for entry in entries - tables.bridge:
+            mac = entry >> 2 * NAME_BITS
+            self.macs[mac] = self.macs.get(mac, ()) + (device | entry & ENTRY_MASK,)
+        tables.bridge = entries
+
+    def update_peers(self, ip: str, peers) -> bool:
+        """Index the peers[] of a GET /stats?type=wireless; returns whether they changed."""
+        tables = self.tables(ip)
+        entries = set()
+        for peer in peers if isinstance(peers, list) else ():
+            mac = mac_to_int(peer.get('mac') or '')
+            if mac is not None:
+                entries.add((mac, ip_to_int(peer.get('ipv4')), ip_to_int(peer.get('ipv6')),
+                             self.name_id(peer.get('iface_name') or ''), self.name_id(peer.get('radio_name') or '')))
+        entries = frozenset(entries)
+        if entries == tables.peers:
+            return False
+        self.index_peers(tables, entries)
+        return True
+
+    def index_peers(self, tables: DeviceTables, entries: FrozenSet[Peer]):
+        removed = tables.peers - entries
+        for mac, ipv4, ipv6, iface, radio in removed:
+            location = self.peer_macs.get(mac)
+            # Unless the peer moved to another AP meanwhile, which now owns its addresses
+            if location is None or location >> 2 * NAME_BITS == tables.id:
+                self.peer_macs.pop(mac, None)
+                for address in (ipv4, ipv6):
+                    if address and self.peer_ips.get(address) == mac:
+                        del self.peer_ips[address]
+            self.peer_ifaces.pop(tables.id << NAME_BITS | iface, None)
+        # A peer can be reported more than once, e.g. on two ifaces: index again what the removed entries shared
+        stale = {mac for mac, *_ in removed} | {('iface', iface) for *_, iface, radio in removed} | \
+            {address for _, ipv4, ipv6, *_ in removed for address in (ipv4, ipv6) if address}
+        for mac, ipv4, ipv6, iface, radio in entries:
+            if (mac, ipv4, ipv6, iface, radio) in tables.peers and not \
+                    stale.intersection((mac, ('iface', iface), ipv4 or None, ipv6 or None)):
+                continue
+            self.peer_macs[mac] = tables.id << 2 * NAME_BITS | iface << NAME_BITS | radio
+            for address in (ipv4, ipv6):
+                if address:
+                    self.peer_ips[address] = mac
+            self.peer_ifaces[tables.id << NAME_BITS | iface] = mac
+        tables.peers = entries
+
+    def remove(self, ip: str):
+        """Drop a device and everything seen on it from the index."""
+        if ip in self.devices:
+            self.update_bridge_table(ip, [])
+            self.update_peers(ip, [])
+            del self.devices[ip]
+
+    def lookup(self, address: str) -> List[Location]:
+        """Where a MAC, IPv4 or IPv6 address was seen, bridge table entries first."""
+        mac = mac_to_int(address)
+        if mac is None:
+            mac = self.peer_ips.get(ip_to_int(address))
+            if mac is None:
+                return []
+        names = self.names
+        locations = []
+        for location in self.macs.get(mac, ()):
+            device = location >> 2 * NAME_BITS
+            iface = location & NAME_MASK
+            peer = self.peer_ifaces.get(device << NAME_BITS | iface)
+            radio = self.peer_macs.get(peer, 0) & NAME_MASK if peer is not None else None
+            locations.append(Location(names[device], names[iface], names[location >> NAME_BITS & NAME_MASK],
+                                      int_to_mac(peer) if peer is not None else None,
+                                      names[radio] if radio is not None else None))
+        location = self.peer_macs.get(mac)
+        if location is not None:
+            locations.append(Location(names[location >> 2 * NAME_BITS], names[location >> NAME_BITS & NAME_MASK],
+                                      peer=int_to_mac(mac), radio=names[location & NAME_MASK]))
+        return locations
+
+    def load(self, data: dict):
+        self.names = data['names']
+        self.name_ids = {name: index for index, name in enumerate(self.names)}
+        for ip, entry in data['devices'].items():
+            tables = self.tables(ip)
+            tables.refreshed = entry.get('refreshed')
+            self.index_bridge_table(tables, frozenset(entry['bridge']))
+            self.index_peers(tables, frozenset(tuple(peer) for peer in entry['peers']))
+
+    def save(self):
+        if not self.path:
+            return
+        data = {'names': self.names,
+                'devices': {ip: {'refreshed': tables.refreshed, 'bridge': sorted(tables.bridge),
+                                 'peers': sorted(tables.peers)} for ip, tables in self.devices.items()}}
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+
+class IndexRefresher:
+    """Fetch the bridge tables and wireless peers of many devices concurrently into a MacIndex.
+
+    Args:
+        index: Index to update.
+        username: Login username.
+        password: Login password.
+        timeout: Per-request timeout in seconds.
+        max_in_flight: Maximum number of devices refreshed at once.
+        token_cache: Optional TokenCache shared with other tools.
+    """
+
+    def __init__(self, index: MacIndex, username: str, password: str, timeout: float = 10,
+                 max_in_flight: int = 200, token_cache: Optional[TokenCache] = None):
+        self.index = index
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.token_cache = token_cache or TokenCache()
+        self.clients: Dict[str, AsyncDeviceClient] = {}
+        self.changed = {'bridge': 0, 'peers': 0}
+
+    def client(self, ip: str) -> AsyncDeviceClient:
+        client = self.clients.get(ip)
+        if client is None:
+            session = AsyncDeviceSession(ip, self.username, self.password, self.token_cache, timeout=self.timeout)
+            client = self.clients[ip] = AsyncDeviceClient(session)
+        return client
+
+    async def refresh_device(self, ip: str, semaphore: asyncio.Semaphore):
+        client = self.client(ip)
+        tables = self.index.tables(ip)
+        async with semaphore:
+            try:
+                bridge_table = (await client.bridge_table()).raw.get('bridge_table')
+                if client.api and 'wireless' in client.api.stats_types:
+                    wireless = (await client.stats('wireless', timeout=self.timeout)).raw.get('wireless') or {}
+                    peers = wireless.get('peers')
+                else:
+                    peers = []  # e.g. a TNS-10x switch
+            except (ApiError, AuthenticationError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                tables.error = str(e) or type(e).__name__
+                return
+        # Keep what was indexed before for a device that didn't answer, only replace it with an answer
+        self.changed['bridge'] += self.index.update_bridge_table(ip, bridge_table)
+        self.changed['peers'] += self.index.update_peers(ip, peers)
+        tables.refreshed = time.time()
+        tables.error = None
+
+    async def refresh(self, ips: List[str]):
+        """Refresh the tables of all devices once."""
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.changed = {'bridge': 0, 'peers': 0}
+        await asyncio.gather(*(self.refresh_device(ip, semaphore) for ip in dict.fromkeys(ips)))
+
+    async def close(self):
+        await asyncio.gather(*(client.session.close() for client in self.clients.values()), return_exceptions=True)
+
+    async def run(self, ips: List[str]):
+        try:
+            await self.refresh(ips)
+        finally:
+            await self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find which device and radio a MAC or IP address is behind')
+    parser.add_argument('address', nargs='*', help='MAC, IPv4 or IPv6 address to look up')
+    parser.add_argument('-u', '--username', type=str, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to index')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--index', type=str, help='File used to keep the index between runs')
+    parser.add_argument('--offline', action='store_true', help='Only look up in the saved index, without a refresh')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds (default: 10)')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='Maximum devices refreshed at once (default: 200)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if not args.offline and not (args.username and args.password and (args.ip or args.ip_file)):
+        parser.error('-u, -p and -i/-if are required unless --offline is given')
+    if args.offline and not args.index:
+        parser.error('--offline needs an --index file')
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    index = MacIndex(args.index)
+    if not args.offline:
+        if args.ip_file:
+            with open(args.ip_file) as f:
+                ips = [line.strip() for line in f if line.strip()]
+        else:
+            ips = args.ip
+        # The index covers the devices of the last refresh
+        for ip in set(index.devices) - set(ips):
+            index.remove(ip)
+        refresher = IndexRefresher(index, args.username, args.password, timeout=args.timeout,
+                                   max_in_flight=args.max_in_flight, token_cache=TokenCache(args.token_cache))
+        started = time.monotonic()
+        asyncio.run(refresher.run(ips))
+        failed = [ip for ip in dict.fromkeys(ips) if index.devices[ip].error]
+        print(f"Refreshed {len(ips) - len(failed)} of {len(ips)} device(s) in {time.monotonic() - started:.1f}s: "
+              f"{refresher.changed['bridge']} bridge table(s) and {refresher.changed['peers']} peer list(s) changed; "
+              f"{len(index.macs)} MAC(s), {len(index.peer_macs)} wireless peer(s)", file=sys.stderr)
+        for ip in failed:
+            print(f"[{ip}] ✗ {index.devices[ip].error}", file=sys.stderr)
+        index.save()
+        CAPABILITIES.save()
+
+    width = max((len(address) for address in args.address), default=0) + 2
+    for address in args.address:
+        locations = index.lookup(address)
+        if not locations:
+            print(f"{address:<{width}}not found")
+        for location in locations:
+            print(f"{address:<{width}}{location}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Reboot Watcher
+Waits for rebooting devices to come back, many at once from one event loop.
+
+A device is probed every `interval` seconds, in two steps where the second
+only runs once the first passed:
+
+1. a non-blocking TCP connect to the API port, which costs nothing while the
+   device is down;
+2. GET /stats?type=system, whose uptime tells a device that booted again from
+   one that is still shutting down.
+
+Until a device has been seen down, only the TCP connect is probed; a device
+that stays up for longer than `8 * interval` gets the full probe, less and
+less often, in case it went down and up between two probes. That probe is
+sent with the token from before the reboot, so a device that is still up
+answers it without a login, and one that has rebooted rejects the token and
+is logged in again. Once the device has been seen down its token is dropped,
+and the probe after the port opened again logs in first; the web server
+accepts connections some time before the API accepts logins, so that login is
+what tells the API is ready. A device is thus logged in once after it came
+back, within about `interval` seconds of its API being ready, and the new
+token is kept in the session's token cache for the caller to go on with.
+
+    requested = time.monotonic()
+    client.reboot()
+    system = await wait_rebooted(async_client, timeout=300, requested=requested)
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+from tachyon_client import ApiError, AsyncDeviceClient
+from tachyon_session import AuthenticationError
+from wait_scheduler import WaitTimeout
+
+# Errors of a probe of a device that isn't back yet
+PROBE_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, AuthenticationError, ApiError)
+
+
+def booted_since(system, elapsed: float) -> bool:
+    """Whether the device of a /stats?type=system booted within the last `elapsed` seconds.
+
+    Uptime is compared rather than the boot time (epoch_time - uptime) before
+    and after, because the device clock may be off until NTP has set it again.
+    """
+    uptime = system.get('uptime')
+    return isinstance(uptime, (int, float)) and uptime < elapsed
+
+
+async def wait_rebooted(client: AsyncDeviceClient, timeout: float = 300, interval: float = 1,
+                        connect_timeout: float = 1, requested: Optional[float] = None):
+    """Wait until the device of a client has rebooted and its API takes logins again.
+
+    Args:
+        client: Client of the device, logged in or not.
+        timeout: Seconds after `requested` after which WaitTimeout is raised.
+        interval: Seconds between the starts of two probes of a device that is down.
+        connect_timeout: Seconds a TCP connect may take.
+        requested: time.monotonic() of the reboot request (default: now).
+
+    Returns:
+        The /stats?type=system of the rebooted device, as a SystemStats model.
+    """
+    session = client.session
+    requested = time.monotonic() if requested is None else requested
+    deadline = requested + timeout
+    error = 'no probe yet'
+    delay = interval
+    went_down = False
+    while True:
+        started = time.monotonic()
+        try:
+            session.disconnect()  # a connection from before the reboot is dead
+            await asyncio.wait_for(session.connect(), connect_timeout)
+            if went_down or started - requested >= 8 * interval:
+                system = await client.system()
+                if booted_since(system, time.monotonic() - requested):
+                    return system
+                error = 'device has not rebooted yet'
+                delay = min(delay * 2, 8 * interval)
+            else:
+                error = 'device has not gone down yet'
+        except PROBE_ERRORS as e:
+            session.disconnect()
+            error = str(e) or type(e).__name__
+            if not went_down:
+                session.forget_token()  # the reboot ends the API session, so log in right away once it's back
+            went_down = True
+            delay = interval
+        now = time.monotonic()
+        if now >= deadline:
+            raise WaitTimeout(f"Timeout waiting for reboot (last error: {error})")
+        await asyncio.sleep(min(max(0.0, started + delay - now), deadline - now))
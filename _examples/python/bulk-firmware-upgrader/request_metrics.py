@@ -0,0 +1,251 @@
+"""
+Request Metrics
+Per-device, per-endpoint latency of every API request the sessions send:
+the TCP connect (when the request opened a connection), the time to the first
+byte of the response, the total time including the body, and the response
+size. Latencies go into HDR-style log-linear histograms - 64 sub-buckets per
+power of two, so every percentile is within about 1.6% - kept as sparse
+dicts, so recording one request costs a few microseconds and the metrics can
+stay on for every run.
+
+DeviceSession and AsyncDeviceSession record into the shared METRICS unless
+given another RequestMetrics, or None to record nothing. The metrics export
+as a Prometheus text file or as a JSON summary.
+"""
+
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+# Query parameters that select a different handler, kept in the endpoint name: GET /stats?type=system
+ENDPOINT_PARAMS = ('type', 'target')
+PHASES = ('connect', 'ttfb', 'total')
+QUANTILES = (0.5, 0.9, 0.99)
+SUB_BITS = 7  # 2**(SUB_BITS - 1) sub-buckets per power of two
+
+
+def bucket_of(value: int) -> int:
+    """Histogram bucket of a value in microseconds; exact below 2**SUB_BITS."""
+    if value < 1 << SUB_BITS:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BITS
+    return (1 << SUB_BITS) + ((shift - 1) << (SUB_BITS - 1)) + (value >> shift) - (1 << (SUB_BITS - 1))
+
+
+def bucket_range(bucket: int) -> Tuple[int, int]:
+    """The values of a bucket, as [low, high)."""
+    if bucket < 1 << SUB_BITS:
+        return bucket, bucket + 1
+    offset = bucket - (1 << SUB_BITS)
+    shift = (offset >> (SUB_BITS - 1)) + 1
+    top = (offset & ((1 << (SUB_BITS - 1)) - 1)) + (1 << (SUB_BITS - 1))
+    return top << shift, (top + 1) << shift
+
+
+class Histogram:
+    """Log-linear histogram of durations, recorded in seconds and kept in microseconds."""
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max = 0
+
+    def record(self, seconds: float):
+        value = int(seconds * 1e6)
+        bucket = bucket_of(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'Histogram'):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """The value at quantile q in seconds, the middle of its bucket, clamped to the recorded range."""
+        if not self.count:
+            return 0.0
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                low, high = bucket_range(bucket)
+                return min(max((low + high - 1) / 2, self.min), self.max) / 1e6
+        return self.max / 1e6
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count / 1e6 if self.count else 0.0
+
+    def summary(self) -> dict:
+        summary = {'count': self.count, 'mean': round(self.mean, 6), 'max': self.max / 1e6}
+        summary.update((f"p{round(q * 100)}", round(self.quantile(q), 6)) for q in QUANTILES)
+        return summary
+
+
+class EndpointMetrics:
+    """Requests of one device to one endpoint."""
+
+    __slots__ = ('connect', 'ttfb', 'total', 'bytes', 'errors', 'statuses')
+
+    def __init__(self):
+        self.connect = Histogram()
+        self.ttfb = Histogram()
+        self.total = Histogram()
+        self.bytes = 0
+        self.errors = 0
+        self.statuses: Dict[int, int] = {}
+
+    def merge(self, other: 'EndpointMetrics'):
+        for phase in PHASES:
+            getattr(self, phase).merge(getattr(other, phase))
+        self.bytes += other.bytes
+        self.errors += other.errors
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+
+    def summary(self) -> dict:
+        summary = {phase: getattr(self, phase).summary() for phase in PHASES}
+        summary.update(bytes=self.bytes, errors=self.errors, statuses={str(s): c for s, c in self.statuses.items()})
+        return summary
+
+
+def endpoint_name(method: str, url: str, params: Optional[dict] = None) -> str:
+    """The endpoint of a request, e.g. 'GET /stats?type=system', from a full URL or an API path."""
+    parts = urlsplit(url)
+    path = parts.path.split('/cgi.lua/apiv1', 1)[-1]
+    query = dict(parse_qsl(parts.query))
+    query.update(params or {})
+    selected = '&'.join(f"{key}={query[key]}" for key in ENDPOINT_PARAMS if key in query)
+    return f"{method.upper()} /{path.lstrip('/')}" + (f"?{selected}" if selected else '')
+
+
+class RequestMetrics:
+    """Latency histograms per (device, endpoint), shared by all sessions of a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints: Dict[Tuple[str, str], EndpointMetrics] = {}
+        # device -> [requests, seconds in requests], for attributing request time to upgrade phases
+        self.devices: Dict[str, List[float]] = {}
+
+    def observe(self, device: str, endpoint: str, connect: Optional[float], ttfb: Optional[float], total: float,
+                size: int = 0, status: Optional[int] = None):
+        """Record one request; a None status is a request that failed without a response."""
+        with self.lock:
+            metrics = self.endpoints.get((device, endpoint))
+            if metrics is None:
+                metrics = self.endpoints[(device, endpoint)] = EndpointMetrics()
+                self.devices.setdefault(device, [0, 0.0])
+            if connect is not None:
+                metrics.connect.record(connect)
+            if ttfb is not None:
+                metrics.ttfb.record(ttfb)
+            metrics.total.record(total)
+            metrics.bytes += size
+            if status is None:
+                metrics.errors += 1
+            else:
+                metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            totals = self.devices[device]
+            totals[0] += 1
+            totals[1] += total
+
+    def device_totals(self, device: str) -> Tuple[int, float]:
+        """(requests, seconds spent in them) of a device so far."""
+        with self.lock:
+            requests, seconds = self.devices.get(device, (0, 0.0))
+        return int(requests), seconds
+
+    def by_endpoint(self, devices: Optional[Iterable[str]] = None) -> Dict[str, EndpointMetrics]:
+        """The metrics of every endpoint, merged over all devices or over `devices`."""
+        devices = set(devices) if devices is not None else None
+        merged: Dict[str, EndpointMetrics] = {}
+        with self.lock:
+            for (device, endpoint), metrics in self.endpoints.items():
+                if devices is None or device in devices:
+                    merged.setdefault(endpoint, EndpointMetrics()).merge(metrics)
+        return dict(sorted(merged.items()))
+
+    def summary(self, per_device: bool = True) -> dict:
+        """JSON summary: per endpoint over the fleet, and per device and endpoint."""
+        summary = {'endpoints': {endpoint: metrics.summary() for endpoint, metrics in self.by_endpoint().items()}}
+        if per_device:
+            devices: Dict[str, dict] = {}
+            with self.lock:
+                for (device, endpoint), metrics in sorted(self.endpoints.items()):
+                    devices.setdefault(device, {})[endpoint] = metrics.summary()
+            summary['devices'] = devices
+        return summary
+
+    def prometheus(self) -> str:
+        """Prometheus text format: a summary per device, endpoint and phase, plus bytes and errors."""
+        lines = ['# HELP tachyon_api_request_seconds Device API request latency by phase.',
+                 '# TYPE tachyon_api_request_seconds summary']
+        counters = []
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            for (device, endpoint), metrics in items:
+                method, _, path = endpoint.partition(' ')
+                labels = f'device="{device}",method="{method}",endpoint="{escape(path)}"'
+                for phase in PHASES:
+                    histogram = getattr(metrics, phase)
+                    if not histogram.count:
+                        continue
+                    for q in QUANTILES:
+                        lines.append(f'tachyon_api_request_seconds{{{labels},phase="{phase}",quantile="{q}"}} '
+                                     f'{histogram.quantile(q):.6f}')
+                    lines.append(f'tachyon_api_request_seconds_sum{{{labels},phase="{phase}"}} {histogram.total / 1e6:.6f}')
+                    lines.append(f'tachyon_api_request_seconds_count{{{labels},phase="{phase}"}} {histogram.count}')
+                counters.append((labels, metrics))
+        lines += ['# HELP tachyon_api_response_bytes_total Bytes of device API response bodies.',
+                  '# TYPE tachyon_api_response_bytes_total counter']
+        lines += [f'tachyon_api_response_bytes_total{{{labels}}} {metrics.bytes}' for labels, metrics in counters]
+        lines += ['# HELP tachyon_api_request_errors_total Device API requests that got no response.',
+                  '# TYPE tachyon_api_request_errors_total counter']
+        lines += [f'tachyon_api_request_errors_total{{{labels}}} {metrics.errors}' for labels, metrics in counters]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Write the metrics to `path`: Prometheus text for .prom files, otherwise the JSON summary."""
+        data = self.prometheus() if path.endswith('.prom') else json.dumps(self.summary(), indent=1)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # node_exporter's textfile collector never sees a half-written file
+
+    def table(self, devices: Optional[Iterable[str]] = None) -> str:
+        """Per-endpoint latency table in milliseconds; Connect is the mean of the requests that opened a connection."""
+        lines = [f"{'Endpoint':<34}{'Count':>7}{'Connect':>9}{'TTFB p50':>10}{'TTFB p99':>10}"
+                 f"{'Total p50':>11}{'Total p99':>11}{'Max':>9}{'Avg size':>10}"]
+        for endpoint, metrics in self.by_endpoint(devices).items():
+            total = metrics.total
+            connect = f"{metrics.connect.mean * 1000:.1f}" if metrics.connect.count else '-'
+            lines.append(f"{endpoint:<34}{total.count:>7}{connect:>8} "
+                         f"{metrics.ttfb.quantile(0.5) * 1000:>9.1f} {metrics.ttfb.quantile(0.99) * 1000:>9.1f} "
+                         f"{total.quantile(0.5) * 1000:>10.1f} {total.quantile(0.99) * 1000:>10.1f} "
+                         f"{total.max / 1000:>8.1f} {metrics.bytes // max(total.count, 1):>9}")
+        return '\n'.join(lines)
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+METRICS = RequestMetrics()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Speedtest Scheduler
+Measures the capacity of every wireless link in the network, in both
+directions, without two tests ever overlapping on a device (the second would
+fail with "speedtest: already running, aborted").
+
+The links are the peers[] of /stats?type=wireless of each device, tested from
+that device with POST /speedtest on the radio the peer is connected to. Each
+device runs one test at a time, while many devices test in parallel; a peer
+that is in the device list as well is kept free of tests of its own meanwhile,
+and a link between two listed devices is only tested from one side. Results
+are read from GET /speedtest once its `last_changed` moves, polled by the
+shared WaitScheduler, which learns how long a test takes.
+
+Usage: python3 speedtest_scheduler.py -u root -p admin -if ips.txt -o speedtests.ndjson
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from async_client import AsyncDeviceSession
+from tachyon_client import CAPABILITIES, ApiError, AsyncDeviceClient
+from tachyon_session import AuthenticationError, TokenCache
+from wait_scheduler import WaitScheduler, WaitTimeout
+
+REQUEST_ERRORS = (ApiError, AuthenticationError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+
+def tested_from(ip: str, mode: Optional[str], peer_device: str, peer_mode: Optional[str]) -> bool:
+    """Whether a link between two listed devices is tested from `ip`: from the AP, else from the lower address."""
+    if (mode == 'master') != (peer_mode == 'master'):
+        return mode == 'master'
+    return ip < peer_device
+
+
+class SpeedTest:
+    """One direction of one link: a test from `device` to the peer with MAC `peer_mac`."""
+
+    __slots__ = ('device', 'peer_mac', 'radio', 'reverse', 'peer_device', 'status', 'mbps', 'error', 'finished',
+                 'attempts')
+
+    def __init__(self, device: str, peer_mac: str, radio: str, reverse: bool, peer_device: Optional[str] = None):
+        self.device = device
+        self.peer_mac = peer_mac
+        self.radio = radio
+        self.reverse = reverse
+        # The peer, if it is one of the devices tested as well
+        self.peer_device = peer_device
+        self.status = 'pending'
+        self.mbps: Optional[float] = None
+        self.error: Optional[str] = None
+        self.finished: Optional[int] = None
+        self.attempts = 0
+
+    @property
+    def devices(self) -> Set[str]:
+        return {self.device, self.peer_device} - {None}
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class SpeedtestSweep:
+    """Test every wireless link of many devices, one test per device at a time.
+
+    Runs on the event loop of `waits`, e.g. waits.spawn(sweep.run()).
+
+    Args:
+        ips: Devices whose links are tested, usually the APs.
+        username: Login username.
+        password: Login password.
+        waits: Scheduler polling GET /speedtest until a test is done.
+        directions: The `reverse` values to test each link with.
+        test_timeout: Seconds a test may take until its result is read.
+        max_in_flight: Maximum number of tests running at once.
+        retries: Times a test is tried again after it was aborted because
+            another one was running on the device.
+        on_result: Callback receiving every finished test.
+        token_cache: Optional TokenCache shared with other tools.
+    """
+
+    def __init__(self, ips: List[str], username: str, password: str, waits: WaitScheduler,
+                 directions=(False, True), test_timeout: float = 120, max_in_flight: int = 50, retries: int = 2,
+                 on_result: Optional[Callable[[SpeedTest], None]] = None, token_cache: Optional[TokenCache] = None,
+                 timeout: float = 10):
+        self.ips = list(dict.fromkeys(ips))
+        self.waits = waits
+        self.directions = directions
+        self.test_timeout = test_timeout
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.on_result = on_result or (lambda test: None)
+        self.token_cache = token_cache or TokenCache()
+        self.clients = {ip: AsyncDeviceClient(AsyncDeviceSession(ip, username, password, self.token_cache,
+                                                                 timeout=timeout)) for ip in self.ips}
+        self.wireless: Dict[str, dict] = {}
+        self.radio_supported: Dict[str, bool] = {}
+        self.errors: Dict[str, str] = {}
+        # last_changed of the latest result of each device, to tell the next one from it
+        self.last_changed: Dict[str, int] = {}
+        self.tests: List[SpeedTest] = []
+        self.busy: Set[str] = set()
+        self.idle: Optional[asyncio.Condition] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def discover(self, ip: str):
+        """Read the radios and peers of a device, and its latest speedtest result."""
+        client = self.clients[ip]
+        async with self.semaphore:
+            try:
+                if not await client.supports('GET', 'speedtest'):
+                    return  # e.g. a TNS-10x switch
+                # Without `radio` in the API, a test always runs on wlan0
+                self.radio_supported[ip] = await client.supports('POST', 'speedtest', 'radio')
+                wireless = (await client.stats('wireless')).raw.get('wireless') or {}
+                self.last_changed[ip] = (await client.speedtest()).get('last_changed', 0)
+                self.wireless[ip] = wireless
+            except REQUEST_ERRORS as e:
+                self.errors[ip] = str(e) or type(e).__name__
+
+    def plan(self) -> List[SpeedTest]:
+        """The tests of all links, each link from one side only."""
+        radio_macs = {}  # radio MAC -> (device, op_mode)
+        for ip, wireless in self.wireless.items():
+            for radio in (wireless.get('radios') or {}).values():
+                if radio.get('mac'):
+                    radio_macs[radio['mac'].upper()] = (ip, radio.get('op_mode'))
+        tests = []
+        for ip, wireless in self.wireless.items():
+            radios = wireless.get('radios') or {}
+            for peer in wireless.get('peers') or []:
+                peer_mac = (peer.get('mac') or '').upper()
+                radio = peer.get('radio_name') or 'wlan0'
+                if not peer_mac:
+                    continue
+                peer_device, peer_mode = radio_macs.get(peer_mac, (None, None))
+                mode = (radios.get(radio) or {}).get('op_mode')
+                if peer_device is not None and not tested_from(ip, mode, peer_device, peer_mode):
+                    continue
+                tests.extend(SpeedTest(ip, peer_mac, radio, reverse, peer_device) for reverse in self.directions)
+        return tests
+
+    def next_test(self, ip: str, pending: List[SpeedTest]) -> Optional[SpeedTest]:
+        """The first pending test of a device with none of its devices busy."""
+        if ip in self.busy:
+            return None
+        return next((test for test in pending if not test.devices & self.busy), None)
+
+    async def run_device(self, ip: str, pending: List[SpeedTest]):
+        client = self.clients[ip]
+        radio_supported = self.radio_supported[ip]
+        while pending:
+            async with self.semaphore:
+                async with self.idle:
+                    test = await self.idle.wait_for(lambda: self.next_test(ip, pending))
+                    pending.remove(test)
+                    self.busy |= test.devices
+                try:
+                    if test.radio != 'wlan0' and not radio_supported:
+                        test.status, test.error = 'skipped', f"speedtest on {test.radio} not supported"
+                    else:
+                        await self.run_test(client, test, test.radio if radio_supported else None)
+                finally:
+                    async with self.idle:
+                        self.busy -= test.devices
+                        self.idle.notify_all()
+            if test.status == 'busy' and test.attempts <= self.retries:
+                pending.append(test)  # another test was running, try again after the others
+                continue
+            self.on_result(test)
+
+    async def run_test(self, client: AsyncDeviceClient, test: SpeedTest, radio: Optional[str]):
+        ip = test.device
+        previous = self.last_changed.get(ip) or 0
+        test.attempts += 1
+        try:
+            await client.start_speedtest(test.peer_mac, test.reverse, radio)
+            future = self.waits.submit(client.speedtest, lambda result: (result.get('last_changed') or 0) > previous,
+                                       self.test_timeout, kind='speedtest',
+                                       description=f"speedtest to {test.peer_mac}")
+            result = await asyncio.wrap_future(future)
+        except (WaitTimeout,) + REQUEST_ERRORS as e:
+            test.status, test.error = 'failed', str(e) or type(e).__name__
+            return
+        self.last_changed[ip] = test.finished = result.get('last_changed')
+        error = result.get('error') or ''
+        if 'already running' in error or (result.get('peer_mac') or '').upper() != test.peer_mac \
+                or bool(result.get('reverse')) != test.reverse:
+            # Aborted for a test someone else started, or that one's result
+            test.status, test.error = 'busy', error or 'result of another speedtest'
+        elif result.get('status') == 'ok':
+            test.status, test.mbps, test.error = 'ok', result.get('mbps'), None
+        else:
+            test.status, test.error = 'error', error or str(result.get('status'))
+
+    async def run(self) -> List[SpeedTest]:
+        """Discover the links of all devices and test them; returns the tests."""
+        self.idle = asyncio.Condition()
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        try:
+            await asyncio.gather(*(self.discover(ip) for ip in self.ips))
+            self.tests = self.plan()
+            per_device: Dict[str, List[SpeedTest]] = {}
+            for test in self.tests:
+                per_device.setdefault(test.device, []).append(test)
+            await asyncio.gather(*(self.run_device(ip, tests) for ip, tests in per_device.items()))
+        finally:
+            await asyncio.gather(*(client.session.close() for client in self.clients.values()),
+                                 return_exceptions=True)
+        return self.tests
+
+    def summary(self) -> str:
+        """Mbps per link and direction."""
+        links: Dict[tuple, Dict[bool, SpeedTest]] = {}
+        for test in self.tests:
+            links.setdefault((test.device, test.peer_mac, test.radio), {})[test.reverse] = test
+        lines = [f"{'Device':<20}{'Peer':<19}{'Radio':<7}{'Forward':>9}{'Reverse':>9}  Details"]
+        for (ip, peer_mac, radio), directions in links.items():
+            columns = []
+            for reverse in (False, True):
+                test = directions.get(reverse)
+                columns.append(f"{test.mbps:>9.0f}" if test and test.mbps is not None else
+                               f"{test.status if test else '':>9}")
+            details = '; '.join(test.error for test in directions.values() if test.error)
+            lines.append(f"{ip:<20}{peer_mac:<19}{radio:<7}{''.join(columns)}  {details}")
+        for ip, error in self.errors.items():
+            lines.append(f"{ip:<20}{'':<19}{'':<7}{'':>18}  {error}")
+        ok = sum(test.status == 'ok' for test in self.tests)
+        lines.append(f"\n{len(links)} link(s), {ok} of {len(self.tests)} test(s) ok, {len(self.errors)} device(s) failed")
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speedtest every wireless link of many Tachyon devices')
+    parser.add_argument('-u', '--username', type=str, required=True, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, required=True, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to test from')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--direction', choices=('both', 'forward', 'reverse'), default='both',
+                        help='Directions to test each link in (default: both)')
+    parser.add_argument('--max-in-flight', type=int, default=50, help='Maximum tests running at once (default: 50)')
+    parser.add_argument('--test-timeout', type=float, default=120,
+                        help='Seconds a test may take until its result is read (default: 120)')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Retries of a test aborted because another one was running (default: 2)')
+    parser.add_argument('-o', '--output', type=str, help='Append the results as NDJSON to this file')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    if args.ip_file:
+        with open(args.ip_file) as f:
+            ips = [line.strip() for line in f if line.strip()]
+    else:
+        ips = args.ip
+
+    output = open(args.output, 'a') if args.output else None
+
+    def write_result(test: SpeedTest):
+        if output:
+            output.write(json.dumps(dict(test.to_dict(), ts=time.time()), separators=(',', ':')) + '\n')
+            output.flush()
+
+    directions = {'both': (False, True), 'forward': (False,), 'reverse': (True,)}[args.direction]
+    started = time.monotonic()
+    with WaitScheduler() as waits:
+        sweep = SpeedtestSweep(ips, args.username, args.password, waits, directions=directions,
+                               test_timeout=args.test_timeout, max_in_flight=args.max_in_flight,
+                               retries=args.retries, on_result=write_result, token_cache=TokenCache(args.token_cache))
+        try:
+            waits.spawn(sweep.run()).result()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            CAPABILITIES.save()
+            if output:
+                output.close()
+    print(sweep.summary())
+    print(f"Finished in {time.monotonic() - started:.0f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Fleet Stats Collector
+Polls /stats on many devices concurrently from one asyncio event loop. Every
+scrape is a single round trip using the comma-separated multi-type form
+(e.g. type=system,wireless,ethernet,network), with the type set for each
+model read from the matching swagger.yaml.
+
+Usage: python3 stats_collector.py -u root -p admin -if ips.txt --interval 30 -o stats.ndjson
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from async_client import AsyncDeviceSession
+from tachyon_client import CAPABILITIES, AsyncDeviceClient
+from tachyon_session import TokenCache
+
+
+class ScrapeStats:
+    """Scrape duration and success counters for one device."""
+
+    __slots__ = ('scrapes', 'successes', 'total_duration', 'last_duration', 'last_error', 'last_success')
+
+    def __init__(self):
+        self.scrapes = 0
+        self.successes = 0
+        self.total_duration = 0.0
+        self.last_duration = 0.0
+        self.last_error = None
+        self.last_success = None
+
+    @property
+    def success_ratio(self) -> float:
+        return self.successes / self.scrapes if self.scrapes else 0.0
+
+    @property
+    def mean_duration(self) -> float:
+        return self.total_duration / self.scrapes if self.scrapes else 0.0
+
+
+class StatsCollector:
+    """Scrape /stats from many devices on a fixed interval with bounded concurrency.
+
+    Args:
+        ips: Devices to poll.
+        username: Login username.
+        password: Login password.
+        interval: Seconds between scrapes of the same device.
+        jitter: Maximum random delay in seconds added to each scrape, so devices
+            are not all polled in the same instant.
+        timeout: Per-scrape timeout in seconds, including a re-login if needed.
+        max_in_flight: Maximum number of scrapes running at once.
+        on_sample: Callback receiving each scrape result as a dict.
+        token_cache: Optional TokenCache shared with other tools.
+    """
+
+    def __init__(self, ips: List[str], username: str, password: str, interval: float = 30, jitter: float = 5,
+                 timeout: float = 10, max_in_flight: int = 200, on_sample: Optional[Callable[[dict], None]] = None,
+                 token_cache: Optional[TokenCache] = None):
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.on_sample = on_sample or (lambda sample: None)
+        self.token_cache = token_cache or TokenCache()
+        self.sessions = {ip: AsyncDeviceSession(ip, username, password, self.token_cache, timeout=timeout)
+                         for ip in dict.fromkeys(ips)}
+        self.clients = {ip: AsyncDeviceClient(session) for ip, session in self.sessions.items()}
+        self.stats: Dict[str, ScrapeStats] = {ip: ScrapeStats() for ip in self.sessions}
+        self.semaphore = None
+
+    async def scrape(self, ip: str) -> dict:
+        """Fetch all stats types of one device in a single request."""
+        client = self.clients[ip]
+        stats = self.stats[ip]
+        # Until the model and firmware are known, from an earlier run or sweep, only system stats are
+        # requested; they carry both
+        types = client.api.stats_types if client.api else ['system']
+        sample = {'ip': ip, 'ts': time.time(), 'type': ','.join(types)}
+        started = time.monotonic()
+        async with self.semaphore:
+            try:
+                sample['stats'] = (await client.stats(*types, timeout=self.timeout)).raw
+                sample['ok'] = True
+            except Exception as e:
+                sample['ok'] = False
+                sample['error'] = str(e) or type(e).__name__
+        duration = time.monotonic() - started
+
+        stats.scrapes += 1
+        stats.total_duration += duration
+        stats.last_duration = duration
+        if sample['ok']:
+            stats.successes += 1
+            stats.last_success = sample['ts']
+        else:
+            stats.last_error = sample['error']
+        sample['duration_ms'] = round(duration * 1000, 1)
+        self.on_sample(sample)
+        return sample
+
+    async def poll_device(self, ip: str, sweeps: int):
+        """Scrape one device every `interval` seconds, `sweeps` times (0 = forever)."""
+        next_run = time.monotonic() + random.uniform(0, self.jitter)
+        count = 0
+        while not sweeps or count < sweeps:
+            await asyncio.sleep(max(0.0, next_run - time.monotonic()))
+            await self.scrape(ip)
+            count += 1
+            # Schedule from the previous slot so slow scrapes don't make the interval drift
+            next_run += self.interval
+            if next_run < time.monotonic():
+                next_run = time.monotonic()
+            next_run += random.uniform(0, self.jitter)
+
+    async def run(self, sweeps: int = 0):
+        """Poll all devices until `sweeps` scrapes per device are done (0 = forever)."""
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        try:
+            await asyncio.gather(*(self.poll_device(ip, sweeps) for ip in self.sessions))
+        finally:
+            await asyncio.gather(*(session.close() for session in self.sessions.values()),
+                                 return_exceptions=True)
+
+    def summary(self) -> str:
+        """Per-device scrape duration and success ratio."""
+        lines = [f"{'Device':<20}{'Scrapes':>8}{'Success':>9}{'Avg ms':>9}{'Last ms':>9}  Last error"]
+        for ip, stats in self.stats.items():
+            lines.append(f"{ip:<20}{stats.scrapes:>8}{stats.success_ratio:>8.0%} "
+                         f"{stats.mean_duration * 1000:>8.0f}{stats.last_duration * 1000:>9.0f}  "
+                         f"{stats.last_error or ''}")
+        total = sum(stats.scrapes for stats in self.stats.values())
+        ok = sum(stats.successes for stats in self.stats.values())
+        lines.append(f"\n{len(self.stats)} device(s), {total} scrape(s), {ok / total if total else 0:.1%} successful")
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect /stats from many Tachyon devices concurrently')
+    parser.add_argument('-u', '--username', type=str, required=True, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, required=True, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to poll')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between scrapes of each device (default: 30)')
+    parser.add_argument('--jitter', type=float, default=5, help='Maximum random delay added to each scrape in seconds (default: 5)')
+    parser.add_argument('--timeout', type=float, default=10, help='Scrape timeout in seconds (default: 10)')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='Maximum concurrent scrapes (default: 200)')
+    parser.add_argument('--sweeps', type=int, default=0, help='Number of scrapes per device, then exit (default: run forever)')
+    parser.add_argument('-o', '--output', type=str, help='Append samples as NDJSON to this file (default: stdout)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    if args.ip_file:
+        with open(args.ip_file) as f:
+            ips = [line.strip() for line in f if line.strip()]
+    else:
+        ips = args.ip
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+
+    def write_sample(sample: dict):
+        output.write(json.dumps(sample, separators=(',', ':')) + '\n')
+        output.flush()
+
+    collector = StatsCollector(ips, args.username, args.password, interval=args.interval, jitter=args.jitter,
+                               timeout=args.timeout, max_in_flight=args.max_in_flight, on_sample=write_sample,
+                               token_cache=TokenCache(args.token_cache))
+    try:
+        asyncio.run(collector.run(args.sweeps))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        CAPABILITIES.save()
+        print(collector.summary(), file=sys.stderr)
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
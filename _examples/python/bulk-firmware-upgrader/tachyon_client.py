@@ -0,0 +1,781 @@
+"""
+Tachyon Client
+Version-aware client for the device API, generated from the swagger.yaml specs
+in this repo. Each device is matched to the spec version of its family and
+firmware, and responses are decoded into models with __slots__ whose fields
+and decoders are compiled from that spec version's schemas and examples.
+
+Specs are only loaded when a device running that family and version is first
+seen. What each device supports is kept in a CapabilityRegistry by serial
+number, so routes and request fields a device lacks fail without a request,
+and devices are only identified again when their firmware changes. The same
+route definitions serve a DeviceSession (DeviceClient) and an
+AsyncDeviceSession (AsyncDeviceClient):
+
+    client = DeviceClient(pool.get(ip))
+    system = client.system()
+    print(system.model, system.version, client.capabilities)
+"""
+
+import abc
+import json as jsonlib
+import keyword
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from api_specs import family_for_model, load_spec, spec_for_firmware, spec_versions, stats_types
+
+# v1.10.3 does not report a firmware version in /stats?type=system
+LEGACY_VERSION = ('1.10.3', 0)
+# Before API v1.0.0 (firmware 1.10.x) only these routes exist
+LEGACY_ROUTES = {('/login', 'POST'), ('/login', 'DELETE'), ('/reboot', 'POST'), ('/stats', 'GET'),
+                 ('/update', 'GET'), ('/update', 'PUT'), ('/update', 'POST')}
+LEGACY_FIRMWARE = (1, 11, 0)
+
+# Objects keyed by names (radios by interface, ports by port name, ...) rather than by fixed fields
+MAP_FIELDS = ('radios', 'ports', 'zones', 'dhcp_status', 'dns', 'dns6', 'routes')
+# Models of the routes whose 200 response is more than a status message
+ROUTE_MODELS = {
+    ('/login', 'POST'): 'Login',
+    ('/update', 'GET'): 'UpdateStatus',
+    ('/config', 'POST'): 'ConfigResult',
+    ('/speedtest', 'GET'): 'Speedtest',
+    ('/aiming', 'GET'): 'Aiming',
+    ('/aiming', 'DELETE'): 'AimingStop',
+    ('/bridge_table', 'GET'): 'BridgeTable',
+}
+JSON_TYPES = {'string': str, 'integer': int, 'number': float, 'boolean': bool, 'array': list, 'object': dict}
+
+
+def parse_version(version_string: str) -> Optional[Tuple[str, int]]:
+    """Extract version and revision from a device or firmware version string.
+
+    Handles "1.12.3 rev 54999", "1.12.3-r54999" and firmware file names such as
+    tna-30x-1.11.1-r53981-20230426-tn-110-prs-squashfs-sysupgrade.bin.
+    Returns: ('1.12.3', 54999) or ('1.12.3', 0) if no revision
+    """
+    match = re.search(r'(\d+\.\d+\.\d+)(?:[-\s.]r(?:ev)?\s*(\d+))?', version_string or '')
+    if match:
+        return (match.group(1), int(match.group(2)) if match.group(2) else 0)
+    return None
+
+
+def version_key(parsed: Tuple[str, int]) -> Tuple[int, ...]:
+    """Sortable key for a parsed (version, revision) tuple."""
+    ver, rev = parsed
+    return tuple(int(part) for part in ver.split('.')) + (rev,)
+
+
+class ApiError(RuntimeError):
+    """Error response of the device API, or a route its API version doesn't have."""
+
+    def __init__(self, status: int, details: str, path: str = ''):
+        super().__init__(f"{status} {details}")
+        self.status = status
+        self.details = details
+        self.path = path
+
+
+class UnsupportedRoute(ApiError):
+    def __init__(self, method: str, path: str, api: 'ApiModels'):
+        super().__init__(404, f"{method} {path} is not supported by {api.family} API {api.version}", path)
+
+
+class UnsupportedField(ApiError):
+    def __init__(self, method: str, path: str, fields: List[str], api: 'ApiModels'):
+        super().__init__(400, f"{method} {path} does not take {', '.join(fields)} in {api.family} API {api.version}",
+                         path)
+
+
+class Model:
+    """Base of the generated response models.
+
+    Known fields are attributes (None if the response lacks them); the decoded
+    JSON object is kept as `raw`, so the response can be stored unchanged.
+    Fields the spec version doesn't declare, e.g. ones a newer firmware added,
+    are read from `raw` and are None when absent as well.
+    """
+
+    __slots__ = ('raw',)
+    fields: Tuple[str, ...] = ()
+    keys: Dict[str, str] = {}
+
+    def get(self, key: str, default=None):
+        attribute = self.keys.get(key)
+        value = getattr(self, attribute) if attribute else self.raw.get(key)
+        return default if value is None else value
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or name == 'raw':
+            raise AttributeError(name)
+        return self.raw.get(name)
+
+    def __getitem__(self, key: str):
+        attribute = self.keys.get(key)
+        if attribute:
+            return getattr(self, attribute)
+        return self.raw[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.raw
+
+    def to_dict(self) -> dict:
+        return self.raw
+
+    @classmethod
+    def wrap(cls, data: dict) -> 'Model':
+        obj = object.__new__(cls)
+        obj.raw = data
+        return obj
+
+    def __repr__(self):
+        values = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.fields
+                           if getattr(self, name) is not None)
+        return f"{type(self).__name__}({values})"
+
+
+class SystemStatsModel(Model):
+    __slots__ = ()
+
+    @property
+    def version_string(self) -> Optional[str]:
+        """Running firmware: bootbanks.active.version, fw_version on firmware without bootbanks."""
+        bootbanks = self.raw.get('bootbanks') or {}
+        return (bootbanks.get('active') or {}).get('version') or self.raw.get('fw_version')
+
+    @property
+    def version(self) -> Optional[Tuple[str, int]]:
+        """Running firmware as (version, revision); v1.10.3 reports none and is LEGACY_VERSION."""
+        version_string = self.version_string
+        return parse_version(version_string) if version_string else LEGACY_VERSION
+
+    @property
+    def backup_version(self) -> Optional[Tuple[str, int]]:
+        bootbanks = self.raw.get('bootbanks') or {}
+        return parse_version((bootbanks.get('backup') or {}).get('version'))
+
+
+class UpdateStatusModel(Model):
+    __slots__ = ()
+
+    def reached(self, state: str, done_statuses: Tuple[str, ...] = ('SUCCESS', 'COMPLETE')) -> bool:
+        """Whether the update task got to `state` with one of the done statuses."""
+        return self.raw.get('state') == state and self.raw.get('status') in done_statuses
+
+    @property
+    def failed(self) -> bool:
+        return self.raw.get('status') in ('FAIL', 'FAILED', 'ERROR')
+
+
+MODEL_BASES = {'SystemStats': SystemStatsModel, 'UpdateStatus': UpdateStatusModel}
+
+
+def _camel(name: str) -> str:
+    return ''.join(part[:1].upper() + part[1:] for part in re.split(r'[^0-9A-Za-z]+', name) if part)
+
+
+def _attribute(key: str) -> str:
+    return key + '_' if keyword.iskeyword(key) or key in ('raw', 'get', 'fields', 'keys', 'to_dict') else key
+
+
+class FieldShape:
+    """How one field is decoded: as is, as a model, or as a list or map of models."""
+
+    __slots__ = ('key', 'kind', 'type', 'model')
+
+    def __init__(self, key: str, kind: str, value_type: Optional[type] = None, model: Optional['ModelShape'] = None):
+        self.key = key
+        self.kind = kind  # 'value', 'model', 'list' or 'map'
+        self.type = value_type
+        self.model = model
+
+
+class ModelShape:
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name: str, fields: List[FieldShape]):
+        self.name = name
+        self.fields = fields
+
+
+def _is_record(keys) -> bool:
+    return bool(keys) and all(key.isidentifier() for key in keys)
+
+
+def describe(name: str, schemas: List[dict], samples: List[Any]) -> ModelShape:
+    """Work out the fields of a model from its JSON schemas and example values.
+
+    Most /stats schemas are just 'type: object', so the examples carry most of
+    the structure; properties from both are merged.
+    """
+    properties: Dict[str, Tuple[List[dict], List[Any]]] = {}
+    for schema in schemas:
+        for key, subschema in (schema.get('properties') or {}).items():
+            properties.setdefault(key, ([], []))[0].append(subschema or {})
+    for sample in samples:
+        if isinstance(sample, dict):
+            for key, value in sample.items():
+                properties.setdefault(key, ([], []))[1].append(value)
+
+    fields = []
+    for key, (subschemas, values) in properties.items():
+        if not key.isidentifier():
+            continue
+        child = _camel(key)
+        items = [item for value in values if isinstance(value, list) for item in value]
+        item_schemas = [subschema['items'] for subschema in subschemas if isinstance(subschema.get('items'), dict)]
+        objects = [value for value in values if isinstance(value, dict)]
+        object_schemas = [subschema for subschema in subschemas if subschema.get('properties')]
+        declared = next((JSON_TYPES.get(subschema.get('type')) for subschema in subschemas if subschema.get('type')),
+                        None)
+
+        if key in MAP_FIELDS and objects:
+            entries = [entry for value in objects for entry in value.values()]
+            if entries and all(isinstance(entry, dict) for entry in entries):
+                fields.append(FieldShape(key, 'map', dict, describe(child.rstrip('s'), [], entries)))
+                continue
+        if objects or object_schemas:
+            keys = {key for value in objects for key in value} | {key for schema in object_schemas
+                                                                  for key in schema['properties']}
+            if key not in MAP_FIELDS and _is_record(keys):
+                fields.append(FieldShape(key, 'model', dict, describe(name + child, object_schemas, objects)))
+                continue
+            fields.append(FieldShape(key, 'value', dict))
+            continue
+        record_items = [item for item in items if isinstance(item, dict)]
+        if (record_items or any(schema.get('properties') for schema in item_schemas)) and \
+                _is_record({key for item in record_items for key in item} |
+                           {key for schema in item_schemas for key in schema.get('properties') or {}}):
+            fields.append(FieldShape(key, 'list', list, describe(child.rstrip('s'), item_schemas, record_items)))
+            continue
+        sample_type = next((type(value) for value in values if value is not None), None)
+        fields.append(FieldShape(key, 'value', declared or sample_type))
+    return ModelShape(name, fields)
+
+
+def compile_model(shape: ModelShape, classes: Dict[str, type]) -> Tuple[type, Callable[[Any], Any]]:
+    """Create the __slots__ class of a model and its decoder.
+
+    Decoding only wraps the parsed JSON object; the generated field accessors
+    read `raw`, and nested models are decoded on first access and kept in a
+    slot, so a response costs little more than the json.loads that produced it.
+    """
+    name = shape.name
+    while name in classes:
+        name += '_'
+    attributes = [_attribute(field.key) for field in shape.fields]
+    annotations = {}
+    namespace: Dict[str, Any] = {'new': object.__new__}
+    lines = ['def decode(data):', '    if data.__class__ is not dict:', '        return data',
+             '    obj = new(cls)', '    obj.raw = data', '    return obj']
+    cached = []
+    for index, (field, attribute) in enumerate(zip(shape.fields, attributes)):
+        lines.append(f"def get_{index}(self):")
+        if field.kind == 'value':
+            lines.append(f"    return self.raw.get({field.key!r})")
+            annotations[attribute] = Optional[field.type] if field.type else Any
+            continue
+        child, decode_child = compile_model(field.model, classes)
+        namespace[f"decode_{index}"] = decode_child
+        cached.append(f"_{attribute}")
+        lines += ['    try:', f"        return self._{attribute}", '    except AttributeError:',
+                  f"        value = self.raw.get({field.key!r})"]
+        if field.kind == 'model':
+            lines.append(f"        value = decode_{index}(value)")
+            annotations[attribute] = Optional[child]
+        elif field.kind == 'list':
+            lines.append("        if value.__class__ is list:")
+            lines.append(f"            value = [decode_{index}(item) for item in value]")
+            annotations[attribute] = Optional[List[child]]
+        else:
+            lines.append("        if value.__class__ is dict:")
+            lines.append(f"            value = {{key: decode_{index}(item) for key, item in value.items()}}")
+            annotations[attribute] = Optional[Dict[str, child]]
+        lines += [f"        self._{attribute} = value", '        return value']
+
+    exec(compile('\n'.join(lines), f"<{name} decoder>", 'exec'), namespace)
+    body = {f"{attribute}": property(namespace[f"get_{index}"]) for index, attribute in enumerate(attributes)}
+    body.update({
+        '__slots__': tuple(cached), '__annotations__': annotations, '__module__': __name__,
+        'fields': tuple(attributes), 'keys': {field.key: attribute for field, attribute in zip(shape.fields, attributes)},
+    })
+    cls = type(name, (MODEL_BASES.get(name, Model),), body)
+    classes[name] = cls
+    namespace['cls'] = cls
+    return cls, namespace['decode']
+
+
+class ApiModels:
+    """Routes and compiled response models of one family and spec version."""
+
+    def __init__(self, family: str, version: str, legacy: bool = False):
+        self.family = family
+        self.version = version
+        self.legacy = legacy
+        spec = load_spec(family, version)
+        self.routes = set()
+        # Top-level request body fields of the routes that declare them
+        self.fields: Dict[Tuple[str, str], frozenset] = {}
+        schemas = (spec.get('components') or {}).get('schemas') or {}
+        shapes: Dict[str, Tuple[List[dict], List[Any]]] = {}
+        stats_samples: Dict[str, List[Any]] = {}
+        for path, operations in spec['paths'].items():
+            for method, operation in operations.items():
+                if not isinstance(operation, dict):
+                    continue
+                route = (path, method.upper())
+                if legacy and route not in LEGACY_ROUTES:
+                    continue
+                self.routes.add(route)
+                body = (((operation.get('requestBody') or {}).get('content') or {}).get('application/json') or {})
+                schema = body.get('schema') or {}
+                if '$ref' in schema:
+                    schema = schemas.get(schema['$ref'].rsplit('/', 1)[-1]) or {}
+                if schema.get('properties'):
+                    self.fields[route] = frozenset(schema['properties'])
+                responses = operation.get('responses') or {}
+                response = responses.get(200) or responses.get('200') or {}
+                content = (response.get('content') or {}).get('application/json') or {}
+                samples = [self.example_value(example) for example in (content.get('examples') or {}).values()]
+                if 'example' in content:
+                    samples.append(self.example_value({'value': content['example']}))
+                if route == ('/stats', 'GET'):
+                    for sample in samples:
+                        for stats_type, fragment in (sample or {}).items():
+                            stats_samples.setdefault(stats_type, []).append(fragment)
+                elif route == ('/config', 'GET'):
+                    shapes['TestStatus'] = ([], [sample for sample in samples
+                                                 if isinstance(sample, dict) and 'running' in sample])
+                elif route in ROUTE_MODELS:
+                    shapes[ROUTE_MODELS[route]] = ([content.get('schema') or {}], samples)
+
+        self.stats_types = stats_types(family, version)
+        self.classes: Dict[str, type] = {}
+        self.decoders: Dict[str, Callable[[Any], Any]] = {}
+        stats_fields = []
+        for stats_type in self.stats_types:
+            fragments = stats_samples.get(stats_type, [])
+            if stats_type == 'interfaces':
+                # TNS-10x interfaces stats are keyed by interface name
+                entries = [entry for fragment in fragments for entry in fragment.values() if isinstance(entry, dict)]
+                stats_fields.append(FieldShape(stats_type, 'map', dict, describe('Interface', [], entries)))
+            else:
+                stats_fields.append(FieldShape(stats_type, 'model', dict,
+                                               describe(_camel(stats_type) + 'Stats', [], fragments)))
+        for name, (schemas, samples) in shapes.items():
+            self.classes[name], self.decoders[name] = compile_model(describe(name, schemas, samples), self.classes)
+        self.classes['Stats'], self.decoders['Stats'] = compile_model(ModelShape('Stats', stats_fields), self.classes)
+
+    @staticmethod
+    def example_value(example: dict):
+        value = (example or {}).get('value')
+        if isinstance(value, str):
+            try:
+                return jsonlib.loads(value)
+            except ValueError:
+                return None
+        return value
+
+    @staticmethod
+    def route(method: str, path: str) -> Tuple[str, str]:
+        return '/' + path.lstrip('/').split('?')[0], method.upper()
+
+    def supports(self, method: str, path: str) -> bool:
+        return self.route(method, path) in self.routes
+
+    def accepts(self, method: str, path: str, field: str) -> bool:
+        """Whether the route exists and takes `field` in its request body."""
+        route = self.route(method, path)
+        return route in self.routes and (route not in self.fields or field in self.fields[route])
+
+    def decode(self, name: str, data):
+        decoder = self.decoders.get(name)
+        return decoder(data) if decoder else data
+
+    def decode_stats(self, data: dict):
+        return self.decoders['Stats'](data)
+
+
+@lru_cache(maxsize=None)
+def api_models(family: str, version: Optional[str] = None, legacy: bool = False) -> ApiModels:
+    """Compiled models of one spec version, built the first time a device of it is seen."""
+    return ApiModels(family, version or spec_versions(family)[-1], legacy)
+
+
+def system_firmware(system: dict) -> Optional[str]:
+    """Firmware a /stats?type=system reports, e.g. '1.12.2 rev 54920'; None before v1.11."""
+    bootbanks = system.get('bootbanks') or {}
+    return (bootbanks.get('active') or {}).get('version') or system.get('fw_version')
+
+
+class Capabilities:
+    """What one device supports, derived from the model and firmware in its /stats?type=system.
+
+    Only the device's identity and the spec version it maps to are kept; the
+    spec is parsed and its models compiled the first time `api` is used.
+    """
+
+    __slots__ = ('serial', 'model', 'firmware', 'family', 'version', 'legacy')
+    FIELDS = __slots__
+
+    def __init__(self, serial: str, model: str, firmware: Optional[str], family: str, version: str,
+                 legacy: bool = False):
+        self.serial = serial
+        self.model = model
+        self.firmware = firmware
+        self.family = family
+        self.version = version
+        self.legacy = legacy
+
+    @classmethod
+    def detect(cls, system: dict, serial: Optional[str] = None) -> Optional['Capabilities']:
+        """Capabilities of a device of a known model, else None."""
+        family = family_for_model(system.get('model'))
+        if not family:
+            return None
+        firmware = system_firmware(system)
+        parsed = parse_version(firmware) if firmware else LEGACY_VERSION
+        legacy = family == 'tna_30x' and parsed is not None and \
+            tuple(int(part) for part in parsed[0].split('.')) < LEGACY_FIRMWARE
+        return cls(serial or system.get('serial_no') or '', system.get('model'), firmware, family,
+                   spec_for_firmware(family, parsed[0] if parsed else None), legacy)
+
+    @property
+    def api(self) -> ApiModels:
+        return api_models(self.family, self.version, self.legacy)
+
+    def supports(self, method: str, path: str) -> bool:
+        return self.api.supports(method, path)
+
+    def accepts(self, method: str, path: str, field: str) -> bool:
+        return self.api.accepts(method, path, field)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Capabilities':
+        return cls(**{field: data.get(field) for field in cls.FIELDS})
+
+    def __repr__(self):
+        return f"Capabilities({self.model} {self.firmware}: {self.family} {self.version}{' legacy' if self.legacy else ''})"
+
+
+class CapabilityRegistry:
+    """Capabilities of each device by serial number, optionally persisted to disk.
+
+    Capabilities are detected from /stats?type=system, the request tools start
+    with anyway, and are kept until the device reports another model or
+    firmware. Devices are found by address, so a client knows what a device
+    supports before its first request. Entries loaded from disk are trusted
+    for routes they allow; a route they rule out re-identifies the device once
+    per process first, in case its firmware changed since.
+
+    Every /stats?type=system learned from is also handed to the `listeners`,
+    e.g. Inventory.record, as listener(ip, system, capabilities).
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path: Optional[str] = None
+        self.lock = threading.Lock()
+        self.devices: Dict[str, Capabilities] = {}
+        self.addresses: Dict[str, str] = {}
+        # Addresses whose capabilities were confirmed by a response in this process
+        self.confirmed = set()
+        self.dirty = False
+        self.listeners: List[Callable[[str, dict, Optional[Capabilities]], None]] = []
+        if path:
+            self.open(path)
+
+    def open(self, path: str):
+        """Keep the registry in `path`, loading what earlier runs stored there."""
+        self.path = path
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                data = jsonlib.load(f)
+            devices = {serial: Capabilities.from_dict(entry) for serial, entry in data['devices'].items()}
+            addresses = {ip: serial for ip, serial in data['addresses'].items() if serial in devices}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return
+        with self.lock:
+            self.devices.update(devices)
+            self.addresses.update(addresses)
+
+    def get(self, ip: str) -> Optional[Capabilities]:
+        serial = self.addresses.get(ip)
+        return self.devices.get(serial) if serial is not None else None
+
+    def is_confirmed(self, ip: str) -> bool:
+        return ip in self.confirmed
+
+    def add(self, ip: str, capabilities: Capabilities):
+        """Know a device from an earlier run, unless it is known already; it isn't confirmed by this."""
+        with self.lock:
+            self.devices.setdefault(capabilities.serial or ip, capabilities)
+            self.addresses.setdefault(ip, capabilities.serial or ip)
+
+    def learn(self, ip: str, system: dict) -> Optional[Capabilities]:
+        """Update a device from its /stats?type=system; returns None for models without a spec."""
+        capabilities = self.update(ip, system)
+        for listener in self.listeners:
+            listener(ip, system, capabilities)
+        return capabilities
+
+    def update(self, ip: str, system: dict) -> Optional[Capabilities]:
+        # Devices that don't report a serial are tracked by address
+        serial = system.get('serial_no') or ip
+        with self.lock:
+            current = self.devices.get(serial)
+            if current is None or current.model != system.get('model') or \
+                    current.firmware != system_firmware(system):
+                current = Capabilities.detect(system, serial)
+                if current is None:
+                    self.dirty |= self.addresses.pop(ip, None) is not None
+                    self.confirmed.discard(ip)
+                    return None
+                self.devices[serial] = current
+                self.dirty = True
+            if self.addresses.get(ip) != serial:
+                self.addresses[ip] = serial
+                self.dirty = True
+            self.confirmed.add(ip)
+            return current
+
+    def forget(self, ip: str):
+        """Drop what is known about the device at `ip`, e.g. after it answered 404 to a route it should have."""
+        with self.lock:
+            self.dirty |= self.addresses.pop(ip, None) is not None
+            self.confirmed.discard(ip)
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = {'devices': {serial: capabilities.to_dict() for serial, capabilities in self.devices.items()},
+                    'addresses': dict(self.addresses)}
+            self.dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            jsonlib.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+# Shared by all clients of a process; tools open it on a file to keep it between runs
+CAPABILITIES = CapabilityRegistry()
+
+
+class Call:
+    """One API call: the request to send and how to turn the response into a result."""
+
+    __slots__ = ('method', 'path', 'params', 'json', 'timeout', 'finish')
+
+    def __init__(self, method: str, path: str, params: Optional[dict] = None, json=None,
+                 timeout: Optional[float] = None, finish: Optional[Callable[[Any], Any]] = None):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.json = json
+        self.timeout = timeout
+        self.finish = finish
+
+
+class BaseClient(abc.ABC):
+    """Route definitions shared by DeviceClient and AsyncDeviceClient.
+
+    Every API method builds a Call and hands it to execute(), which sends it
+    synchronously or returns an awaitable, depending on the client.
+    """
+
+    def __init__(self, session, registry: CapabilityRegistry = CAPABILITIES):
+        self.session = session
+        self.ip = session.ip
+        self.registry = registry
+
+    @property
+    def capabilities(self) -> Optional[Capabilities]:
+        """What the device supports, known from the registry or after the first system() or stats() call."""
+        return self.registry.get(self.ip)
+
+    @property
+    def api(self) -> Optional[ApiModels]:
+        """Models of the device's spec version."""
+        capabilities = self.registry.get(self.ip)
+        return capabilities.api if capabilities else None
+
+    @abc.abstractmethod
+    def execute(self, call: Call):
+        """Send `call`, or return an awaitable that does."""
+
+    def needs_identify(self, call: Call) -> bool:
+        """Whether the device has to be identified before sending `call`.
+
+        Unknown devices are, except for stats which identify them on the way.
+        Known ones only are if their capabilities come from an earlier run and
+        rule the call out, as the firmware may have changed since.
+        """
+        capabilities = self.registry.get(self.ip)
+        if capabilities is None:
+            return call.path != 'stats'
+        return not self.registry.is_confirmed(self.ip) and self.unsupported(capabilities.api, call) is not None
+
+    @staticmethod
+    def unsupported(api: ApiModels, call: Call) -> Optional[ApiError]:
+        if not api.supports(call.method, call.path):
+            return UnsupportedRoute(call.method, '/' + call.path, api)
+        if isinstance(call.json, dict):
+            fields = [field for field in call.json if not api.accepts(call.method, call.path, field)]
+            if fields:
+                return UnsupportedField(call.method, '/' + call.path, fields, api)
+        return None
+
+    def check(self, call: Call):
+        api = self.api
+        error = self.unsupported(api, call) if api else None
+        if error:
+            raise error
+
+    def result(self, call: Call, status: int, body: bytes):
+        try:
+            data = jsonlib.loads(body) if body else {}
+        except ValueError:
+            raise ApiError(status, f"invalid JSON response ({status})", '/' + call.path)
+        if status != 200 or (isinstance(data, dict) and isinstance(data.get('error'), dict)):
+            error = data.get('error') if isinstance(data, dict) else None
+            details = error.get('details') if isinstance(error, dict) else None
+            if status == 404:
+                # The device doesn't have a route its capabilities said it has: identify it again
+                self.registry.forget(self.ip)
+            raise ApiError(status, details or str(status), '/' + call.path)
+        return call.finish(data) if call.finish else data
+
+    def decoded(self, name: str) -> Callable[[Any], Any]:
+        return lambda data: self.api.decode(name, data)
+
+    def learn(self, data: dict):
+        self.registry.learn(self.ip, data.get('system') or {})
+
+    # ----- routes -----
+
+    def system(self, timeout: Optional[float] = None):
+        """/stats?type=system as a SystemStats model; also picks the spec version of the device.
+
+        Devices of an unknown model get a SystemStats without declared fields.
+        """
+        def finish(data):
+            self.learn(data)
+            if self.api:
+                return self.api.decode_stats(data).system
+            return SystemStatsModel.wrap(data.get('system') or {})
+        return self.execute(Call('GET', 'stats', {'type': 'system'}, timeout=timeout, finish=finish))
+
+    def stats(self, *types: str, timeout: Optional[float] = None):
+        """Several stats types in one request, as a Stats model with one field per type (default: all)."""
+        if not types:
+            types = tuple(self.api.stats_types) if self.api else ('system',)
+
+        def finish(data):
+            if 'system' in data:
+                self.learn(data)
+            return self.api.decode_stats(data) if self.api else Model.wrap(data)
+        return self.execute(Call('GET', 'stats', {'type': ','.join(types)}, timeout=timeout, finish=finish))
+
+    def update_status(self):
+        return self.execute(Call('GET', 'update', finish=self.decoded('UpdateStatus')))
+
+    def start_download(self, firmware_url: str):
+        return self.execute(Call('PUT', 'update', json={'firmware_url': firmware_url}))
+
+    def start_flash(self, reset: bool = False, force: bool = False):
+        return self.execute(Call('POST', 'update', json={'reset': reset, 'force': force}))
+
+    def reboot(self):
+        return self.execute(Call('POST', 'reboot'))
+
+    def config(self):
+        """The running config as a plain dict, ready to be changed and posted back."""
+        return self.execute(Call('GET', 'config', finish=lambda data: data['config']))
+
+    def test_status(self, timeout: Optional[float] = None):
+        """GET /config?target=test, e.g. TestStatus(running=True, timeout=290)."""
+        return self.execute(Call('GET', 'config', {'target': 'test'}, timeout=timeout,
+                                 finish=self.decoded('TestStatus')))
+
+    def post_config(self, payload: dict):
+        """POST /config with a config or an action; raises ApiError if the device rejects it."""
+        return self.execute(Call('POST', 'config', json=payload, finish=self.decoded('ConfigResult')))
+
+    def speedtest(self):
+        return self.execute(Call('GET', 'speedtest', finish=self.decoded('Speedtest')))
+
+    def start_speedtest(self, peer_mac: Optional[str] = None, reverse: bool = False, radio: Optional[str] = None):
+        payload = {'reverse': reverse}
+        if peer_mac:
+            payload['peer_mac'] = peer_mac
+        if radio:
+            payload['radio'] = radio
+        return self.execute(Call('POST', 'speedtest', json=payload))
+
+    def aiming(self):
+        return self.execute(Call('GET', 'aiming', finish=self.decoded('Aiming')))
+
+    def start_aiming(self, duration: int):
+        return self.execute(Call('POST', 'aiming', json={'duration': duration}))
+
+    def stop_aiming(self):
+        return self.execute(Call('DELETE', 'aiming', finish=self.decoded('AimingStop')))
+
+    def bridge_table(self):
+        return self.execute(Call('GET', 'bridge_table', finish=self.decoded('BridgeTable')))
+
+    def poe_reset(self, port: str):
+        return self.execute(Call('POST', 'poe_reset', json={'port': port}))
+
+
+class DeviceClient(BaseClient):
+    """Typed API of one device over a DeviceSession.
+
+    Raises:
+        ApiError: For error responses; UnsupportedRoute and UnsupportedField for routes and request
+            fields the device's API version lacks.
+        requests.exceptions.RequestException: For connection problems.
+    """
+
+    def supports(self, method: str, path: str, *fields: str) -> bool:
+        """Whether the device has a route and takes `fields` in its request body; identifies it if needed."""
+        call = Call(method, path, json=dict.fromkeys(fields))
+        if self.needs_identify(call):
+            self.system()
+        api = self.api
+        return api is not None and self.unsupported(api, call) is None
+
+    def execute(self, call: Call):
+        if self.needs_identify(call):
+            self.system()
+        self.check(call)
+        response = self.session.request(call.method, call.path, params=call.params, json=call.json,
+                                        timeout=call.timeout)
+        return self.result(call, response.status_code, response.content)
+
+
+class AsyncDeviceClient(BaseClient):
+    """Typed API of one device over an AsyncDeviceSession; every route method returns an awaitable."""
+
+    async def supports(self, method: str, path: str, *fields: str) -> bool:
+        call = Call(method, path, json=dict.fromkeys(fields))
+        if self.needs_identify(call):
+            await self.system()
+        api = self.api
+        return api is not None and self.unsupported(api, call) is None
+
+    async def execute(self, call: Call):
+        if self.needs_identify(call):
+            await self.system()
+        self.check(call)
+        response = await self.session.request(call.method, call.path, params=call.params, json=call.json,
+                                              timeout=call.timeout)
+        return self.result(call, response.status, response.body)
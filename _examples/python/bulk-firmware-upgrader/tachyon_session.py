@@ -0,0 +1,329 @@
+"""
+Tachyon API Sessions
+Keep-alive connection pool and cached api_token per device. Requests that come
+back 401 re-login transparently and are retried once, and sessions log out with
+DELETE /login when they are closed. Every request is timed into the shared
+RequestMetrics: the TCP connect when it opened a connection, the time to the
+first byte and the total time.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+from request_metrics import METRICS, RequestMetrics, endpoint_name
+
+API_PATH = '/cgi.lua/apiv1'
+
+# Connect time of the last connection the current thread opened; requests run synchronously per thread
+connect_times = threading.local()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        connect_times.last = time.perf_counter() - started
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record how long their TCP connect took."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {**self.poolmanager.pool_classes_by_scheme,
+                                                   'http': TimedHTTPConnectionPool}
+
+
+class TimedSession(requests.Session):
+    """requests.Session that times every request into `metrics`; None records nothing.
+
+    Requests are recorded under `device`, or under the host of their URL.
+    """
+
+    def __init__(self, device: Optional[str] = None, metrics: Optional[RequestMetrics] = METRICS,
+                 pool_size: int = 10):
+        super().__init__()
+        self.device = device
+        self.metrics = metrics
+        self.mount('http://', TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        if self.metrics is None:
+            return super().request(method, url, *args, **kwargs)
+        device = self.device or urlsplit(url).hostname or ''
+        endpoint = endpoint_name(method, url, kwargs.get('params'))
+        connect_times.last = None
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            self.metrics.observe(device, endpoint, connect_times.last, None, time.perf_counter() - started)
+            raise
+        total = time.perf_counter() - started
+        connect = connect_times.last
+        # elapsed runs from sending the request until the headers were parsed, including a new connection
+        ttfb = max(response.elapsed.total_seconds() - (connect or 0), 0)
+        self.metrics.observe(device, endpoint, connect, ttfb, total, len(response.content), response.status_code)
+        return response
+
+
+class TokenCache:
+    """api_token cache keyed by user and device, optionally persisted to disk.
+
+    Tokens expire after `ttl` seconds; a token that expired on the device
+    earlier is caught by the 401 re-login in DeviceSession. Changes are
+    written to disk in batches, by a timer thread `flush_delay` seconds after
+    the first unsaved one, so a login storm neither rewrites the file per
+    login nor blocks an event loop that logs in; save() writes at once, and
+    runs at exit as well.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: int = 1800, flush_delay: float = 1):
+        self.path = path
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.tokens: Dict[str, dict] = {}
+        self.dirty = False
+        self.timer: Optional[threading.Timer] = None
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.tokens = json.load(f)
+            except (OSError, ValueError):
+                self.tokens = {}
+        if path:
+            atexit.register(self.save)
+
+    @property
+    def persistent(self) -> bool:
+        return bool(self.path)
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry and entry['expires'] > time.time():
+                return entry['token']
+            return None
+
+    def set(self, key: str, token: str):
+        with self.lock:
+            self.tokens[key] = {'token': token, 'expires': time.time() + self.ttl}
+            self.changed()
+
+    def discard(self, key: str):
+        with self.lock:
+            if self.tokens.pop(key, None):
+                self.changed()
+
+    def changed(self):
+        """Mark the tokens unsaved and schedule a write; called with the lock held."""
+        if not self.path:
+            return
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_delay, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def save(self):
+        """Write the tokens to disk now, if they changed since the last write."""
+        # write_lock keeps the writes in snapshot order; the lock is only held for the snapshot,
+        # so get() and set() don't wait for the disk
+        with self.write_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.path or not self.dirty:
+                    return
+                self.dirty = False
+                now = time.time()
+                live = {key: entry for key, entry in self.tokens.items() if entry['expires'] > now}
+            tmp_path = f"{self.path}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(live, f)
+            os.replace(tmp_path, self.path)
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class DeviceSession:
+    """Authenticated session with one device.
+
+    Holds a keep-alive connection pool and the device's api_token. The token
+    is taken from the TokenCache when possible, so login only happens when
+    there is no valid token or the device answers 401. Requests are recorded
+    in `metrics`; None records nothing.
+    """
+
+    def __init__(self, ip: str, username: str, password: str, token_cache: Optional[TokenCache] = None,
+                 timeout: int = 10, pool_size: int = 2, metrics: Optional[RequestMetrics] = METRICS):
+        self.ip = ip
+        self.username = username
+        self.password = password
+        self.token_cache = token_cache or TokenCache()
+        self.timeout = timeout
+        self.base_url = f"http://{ip}{API_PATH}"
+        self.cache_key = f"{username}@{ip}"
+        self.session = TimedSession(ip, metrics, pool_size=pool_size)
+        self.session.headers['Accept'] = 'application/json'
+        self.metrics = metrics
+        self.login_lock = threading.Lock()
+        self.login_count = 0
+
+    @property
+    def api_token(self) -> Optional[str]:
+        return self.token_cache.get(self.cache_key)
+
+    def send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """session.request, timed into the metrics."""
+        return self.session.request(method, url, **kwargs)
+
+    def login(self, stale_token: Optional[str] = None) -> str:
+        """Return a valid api_token, logging in only if needed.
+
+        Args:
+            stale_token: Token the device just rejected; a cached token equal to
+                it is not reused.
+
+        Raises:
+            AuthenticationError: If the device rejects the credentials.
+        """
+        with self.login_lock:
+            token = self.api_token
+            if token and token != stale_token:
+                return token  # cached, or another thread already logged in again
+            response = self.send('post', f"{self.base_url}/login", timeout=self.timeout,
+                                 json={'username': self.username, 'password': self.password})
+            self.login_count += 1
+            token = response.cookies.get('token')
+            if not token and response.status_code == 200:
+                try:
+                    token = response.json().get('token')
+                except ValueError:
+                    token = None
+            if response.status_code != 200 or not token:
+                raise AuthenticationError(f"Login to {self.ip} failed: {response.status_code} {response.text}")
+            self.token_cache.set(self.cache_key, token)
+            return token
+
+    def forget_token(self):
+        """Drop the cached token, e.g. after a reboot invalidated it."""
+        self.token_cache.discard(self.cache_key)
+
+    def request(self, method: str, path: str, params=None, json=None, timeout: Optional[int] = None,
+                retry_auth: bool = True) -> requests.Response:
+        """Send an authenticated request, re-logging in once on 401.
+
+        Args:
+            method: HTTP method.
+            path: Route below /cgi.lua/apiv1, e.g. 'stats'.
+            params: Optional query parameters.
+            json: Optional JSON request body.
+            timeout: Request timeout, defaults to the session timeout.
+            retry_auth: Whether a 401 response should trigger a re-login and retry.
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        token = self.login()
+        response = self.send(method, url, params=params, json=json, timeout=timeout or self.timeout,
+                             headers={'Cookie': f"api_token={token}"})
+        if response.status_code == 401 and retry_auth:
+            token = self.login(stale_token=token)
+            response = self.send(method, url, params=params, json=json, timeout=timeout or self.timeout,
+                                 headers={'Cookie': f"api_token={token}"})
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('get', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('post', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('put', path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('delete', path, **kwargs)
+
+    def logout(self):
+        """End the API session on the device with DELETE /login."""
+        token = self.api_token
+        if not token:
+            return
+        self.forget_token()
+        try:
+            self.send('delete', f"{self.base_url}/login", headers={'Cookie': f"api_token={token}"},
+                      timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            pass
+
+    def close(self, logout: Optional[bool] = None):
+        """Close the connection pool.
+
+        Args:
+            logout: Whether to log out first. Defaults to logging out unless the
+                token cache is persisted to disk for the next run.
+        """
+        if logout is None:
+            logout = not self.token_cache.persistent
+        if logout:
+            self.logout()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SessionPool:
+    """One DeviceSession per device, sharing credentials and a TokenCache."""
+
+    def __init__(self, username: str, password: str, token_cache: Optional[TokenCache] = None, **session_options):
+        self.username = username
+        self.password = password
+        self.token_cache = token_cache or TokenCache()
+        self.session_options = session_options
+        self.sessions: Dict[str, DeviceSession] = {}
+        self.lock = threading.Lock()
+
+    def get(self, ip: str) -> DeviceSession:
+        with self.lock:
+            if ip not in self.sessions:
+                self.sessions[ip] = DeviceSession(ip, self.username, self.password, self.token_cache,
+                                                  **self.session_options)
+            return self.sessions[ip]
+
+    def close(self, logout: Optional[bool] = None):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close(logout)
+        self.token_cache.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Network Topology
+Builds the tree of APs and stations from the radios and peers[] of
+/stats?type=wireless of each device, so a fleet upgrade can take it into
+account: stations are upgraded before the AP they are connected through, and
+the firmware downloads running through one AP radio at a time are limited.
+
+A wireless link is the pair (upstream radio MAC, downstream radio MAC): an AP
+reports it from its `master` radio with the MAC of each peer, a station from
+its own radio with the MAC of the AP as its peer, so both ends describe the
+same link. A radio MAC belongs to a device once that device reported the
+radio; a peer not refreshed (yet) is recognised by its `ipv4` instead. Wired
+hops between devices aren't reported by any device, so a tree ends at each
+device whose uplink is not wireless.
+
+Updates are incremental: the radios and links of a device are compared with
+the ones seen before, and only a change is indexed.
+
+Usage: python3 topology.py -u root -p admin -if ips.txt
+"""
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from async_client import AsyncDeviceSession
+from tachyon_client import CAPABILITIES, ApiError, AsyncDeviceClient
+from tachyon_session import AuthenticationError, TokenCache
+
+# (radio MAC, name, op_mode, ptp)
+Radio = Tuple[str, str, Optional[str], bool]
+# (upstream radio MAC, downstream radio MAC)
+Link = Tuple[str, str]
+# (peer MAC, ipv4, model, system_name)
+Peer = Tuple[str, Optional[str], Optional[str], Optional[str]]
+
+
+class DeviceRadios:
+    """The radios, links and peers of one device as last reported."""
+
+    __slots__ = ('radios', 'links', 'peers', 'refreshed', 'error')
+
+    def __init__(self):
+        self.radios: FrozenSet[Radio] = frozenset()
+        self.links: FrozenSet[Link] = frozenset()
+        self.peers: FrozenSet[Peer] = frozenset()
+        self.refreshed: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class Topology:
+    """Wireless links between devices, as a forest of APs and their stations.
+
+    A peer is known for as long as some device reports it:
+
+    >>> topology = Topology()
+    >>> wireless = {'radios': {'wlan0': {'mac': '78:5E:E8:00:00:01', 'op_mode': 'master'}},
+    ...             'peers': [{'mac': '78:5E:E8:00:00:02', 'ipv4': '10.0.0.2', 'radio_name': 'wlan0'}]}
+    >>> topology.update('10.0.0.1', wireless), topology.describe('78:5E:E8:00:00:02')
+    (True, '78:5E:E8:00:00:02 (10.0.0.2)')
+    >>> topology.update('10.0.0.1', dict(wireless, peers=[])), topology.describe('78:5E:E8:00:00:02')
+    (True, '78:5E:E8:00:00:02')
+    >>> topology.addresses
+    {}
+    """
+
+    def __init__(self):
+        self.devices: Dict[str, DeviceRadios] = {}
+        # Radio MAC -> (device, radio name, op_mode, ptp)
+        self.radios: Dict[str, Tuple[str, str, Optional[str], bool]] = {}
+        # Downstream radio MAC -> {upstream radio MAC: number of ends reporting the link}
+        self.upstream: Dict[str, Dict[str, int]] = {}
+        self.downstream: Dict[str, Set[str]] = {}
+        # Peer MAC -> (ipv4, model, system_name), as reported by the other end
+        self.peers: Dict[str, Tuple[Optional[str], Optional[str], Optional[str]]] = {}
+        self.peer_reports: Dict[str, int] = {}  # peer MAC -> number of peers[] entries reporting it
+        self.addresses: Dict[str, Dict[str, int]] = {}  # peer ipv4 -> {peer MAC: number of entries reporting it}
+
+    def update(self, ip: str, wireless: dict) -> bool:
+        """Index the `wireless` of a /stats?type=wireless of a device; returns whether it changed."""
+        radios = set()
+        own = {}  # radio name -> (MAC, op_mode)
+        for name, radio in (wireless.get('radios') or {}).items():
+            mac = (radio.get('mac') or '').upper()
+            if mac:
+                radios.add((mac, name, radio.get('op_mode'), bool(radio.get('ptp'))))
+                own[name] = (mac, radio.get('op_mode'))
+        links = set()
+        peers = set()
+        for peer in wireless.get('peers') or ():
+            mac = (peer.get('mac') or '').upper()
+            radio = own.get(peer.get('radio_name') or 'wlan0')
+            if not mac or radio is None:
+                continue
+            radio_mac, op_mode = radio
+            links.add((radio_mac, mac) if op_mode == 'master' else (mac, radio_mac))
+            peers.add((mac, peer.get('ipv4'), peer.get('model'), peer.get('system_name')))
+        device = self.devices.get(ip)
+        if device is None:
+            device = self.devices[ip] = DeviceRadios()
+        radios, links, peers = frozenset(radios), frozenset(links), frozenset(peers)
+        if (radios, links, peers) == (device.radios, device.links, device.peers):
+            return False
+        self.index(ip, device, radios, links, peers)
+        return True
+
+    def index(self, ip: str, device: DeviceRadios, radios: FrozenSet[Radio], links: FrozenSet[Link],
+              peers: FrozenSet[Peer]):
+        for mac, *_ in device.radios - radios:
+            if self.radios.get(mac, (None,))[0] == ip:
+                del self.radios[mac]
+        for mac, name, op_mode, ptp in radios:
+            self.radios[mac] = (ip, name, op_mode, ptp)
+        for up, down in device.links - links:
+            ends = self.upstream[down]
+            ends[up] -= 1
+            if not ends[up]:
+                del ends[up]
+                self.downstream[up].discard(down)
+                if not self.downstream[up]:
+                    del self.downstream[up]
+            if not ends:
+                del self.upstream[down]
+        for up, down in links - device.links:
+            ends = self.upstream.setdefault(down, {})
+            ends[up] = ends.get(up, 0) + 1
+            self.downstream.setdefault(up, set()).add(down)
+        for mac, ipv4, model, system_name in device.peers - peers:
+            self.peer_reports[mac] -= 1
+            if not self.peer_reports[mac]:
+                del self.peer_reports[mac]
+                del self.peers[mac]
+            elif self.peers[mac] == (ipv4, model, system_name):
+                self.peers[mac] = self.reported(mac, ip, peers)
+            if ipv4:
+                macs = self.addresses[ipv4]
+                macs[mac] -= 1
+                if not macs[mac]:
+                    del macs[mac]
+                    if not macs:
+                        del self.addresses[ipv4]
+        for mac, ipv4, model, system_name in peers - device.peers:
+            self.peers[mac] = (ipv4, model, system_name)
+            self.peer_reports[mac] = self.peer_reports.get(mac, 0) + 1
+            if ipv4:
+                macs = self.addresses.setdefault(ipv4, {})
+                macs[mac] = macs.get(mac, 0) + 1
+        device.radios, device.links, device.peers = radios, links, peers
+
+    def reported(self, mac: str, ip: str, peers: FrozenSet[Peer]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        """What another entry still reporting a peer says about it, with `peers` as the new entries of `ip`."""
+        for other_ip, other in self.devices.items():
+            for other_mac, ipv4, model, system_name in peers if other_ip == ip else other.peers:
+                if other_mac == mac:
+                    return ipv4, model, system_name
+        raise KeyError(mac)
+
+    def remove(self, ip: str):
+        """Drop a device and the links it reported."""
+        device = self.devices.pop(ip, None)
+        if device is not None:
+            self.index(ip, device, frozenset(), frozenset(), frozenset())
+
+    def device_of(self, mac: str) -> Optional[str]:
+        """The device a radio MAC belongs to, if it is one of the devices."""
+        radio = self.radios.get(mac)
+        if radio is not None:
+            return radio[0]
+        ipv4 = self.peers.get(mac, (None,))[0]
+        return ipv4 if ipv4 in self.devices else None
+
+    def macs_of(self, ip: str) -> List[str]:
+        device = self.devices.get(ip)
+        if device is not None and device.radios:
+            return sorted(mac for mac, *_ in device.radios)
+        # Not refreshed: the MACs its APs know it by
+        return sorted(mac for mac in self.addresses.get(ip, ()) if self.peers[mac][0] == ip and mac in self.upstream)
+
+    def uplink(self, ip: str) -> Optional[str]:
+        """MAC of the AP radio a device is connected through, None for the root of a tree."""
+        for mac in self.macs_of(ip):
+            ends = self.upstream.get(mac)
+            if ends:
+                # Both ends first, so a station that moved isn't kept on the AP it left
+                return max(ends, key=lambda up: (ends[up], up))
+        return None
+
+    def parent(self, ip: str) -> Optional[str]:
+        """The device a device is connected through, if it is one of the devices."""
+        uplink = self.uplink(ip)
+        return self.device_of(uplink) if uplink is not None else None
+
+    def path(self, ip: str) -> List[str]:
+        """MACs of the AP radios between a device and the root of its tree, nearest first."""
+        path = []
+        seen = {ip}
+        while True:
+            uplink = self.uplink(ip)
+            if uplink is None or uplink in path:
+                return path
+            path.append(uplink)
+            ip = self.device_of(uplink)
+            if ip is None or ip in seen:
+                return path
+            seen.add(ip)
+
+    def depth(self, ip: str) -> int:
+        return len(self.path(ip))
+
+    def children(self, ip: str) -> List[str]:
+        """The devices connected through one of a device's radios."""
+        children = []
+        for mac in self.macs_of(ip):
+            for down in self.downstream.get(mac, ()):
+                child = self.device_of(down)
+                if child is not None and child != ip and self.uplink(child) == mac:
+                    children.append(child)
+        return sorted(set(children))
+
+    def descendants(self, ip: str) -> Set[str]:
+        found: Set[str] = set()
+        stack = [ip]
+        while stack:
+            for child in self.children(stack.pop()):
+                if child not in found and child != ip:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def upgrade_order(self, ips: List[str]) -> List[str]:
+        """The devices ordered leaves first: deepest in the tree first, otherwise in the given order."""
+        ips = list(dict.fromkeys(ips))
+        depths = {ip: self.depth(ip) for ip in ips}
+        return sorted(ips, key=lambda ip: -depths[ip])
+
+    def describe(self, mac: str) -> str:
+        radio = self.radios.get(mac)
+        if radio is not None:
+            return f"{radio[0]} {radio[1]}"
+        ipv4, model, system_name = self.peers.get(mac, (None, None, None))
+        details = ', '.join(str(value) for value in (ipv4, model, system_name and f"'{system_name}'") if value)
+        return f"{mac}{f' ({details})' if details else ''}"
+
+    def tree(self) -> str:
+        """The forest as indented text, one AP radio or station per line."""
+        lines = []
+
+        def add(mac: str, indent: int, seen: Set[str]):
+            for down in sorted(self.downstream.get(mac, ())):
+                if down in seen:
+                    continue
+                radio = self.radios.get(down)
+                child = self.device_of(down)
+                lines.append(f"{'  ' * indent}└ {self.describe(down)}"
+                             f"{f' = {child}' if child and radio is None else ''}")
+                for own in self.macs_of(child) if child else ():
+                    if own != down and self.radios.get(own, (None, None, None))[2] == 'master':
+                        lines.append(f"{'  ' * (indent + 1)}{self.describe(own)} master"
+                                     f"{' ptp' if self.radios[own][3] else ''}")
+                        add(own, indent + 2, seen | {down, own})
+
+        for ip in sorted(self.devices):
+            if self.uplink(ip) is not None:
+                continue
+            lines.append(ip)
+            for mac, name, op_mode, ptp in sorted(self.devices[ip].radios):
+                if op_mode == 'master':
+                    lines.append(f"  {name} {mac} master{' ptp' if ptp else ''}")
+                    add(mac, 2, {mac})
+        return '\n'.join(lines)
+
+
+class LinkSlots:
+    """Limit the firmware downloads running through each AP radio.
+
+    A device takes a slot on every AP radio between it and the root of its
+    tree, so a station behind a PtP backhaul counts on the backhaul as well.
+    acquire() returns a future that is done once the device has its slots;
+    a released slot goes to the longest waiting device it lets fit.
+    Slots are taken for the path known at acquire() and released for the same.
+
+    Args:
+        topology: Topology the paths are taken from.
+        per_link: Maximum downloads per AP radio.
+    """
+
+    def __init__(self, topology: Topology, per_link: int):
+        self.topology = topology
+        self.per_link = max(1, per_link)
+        self.lock = threading.Lock()
+        self.active: Dict[str, int] = {}  # AP radio MAC -> downloads through it
+        self.held: Dict[str, List[str]] = {}
+        self.waiting: List[Tuple[str, List[str], Future]] = []
+
+    def fits(self, path: List[str]) -> bool:
+        return all(self.active.get(mac, 0) < self.per_link for mac in path)
+
+    def take(self, ip: str, path: List[str]):
+        for mac in path:
+            self.active[mac] = self.active.get(mac, 0) + 1
+        self.held[ip] = path
+
+    def acquire(self, ip: str) -> Future:
+        future = Future()
+        path = self.topology.path(ip)
+        with self.lock:
+            if ip in self.held:
+                future.set_result(self.held[ip])
+            elif self.fits(path):
+                self.take(ip, path)
+                future.set_result(path)
+            else:
+                self.waiting.append((ip, path, future))
+        return future
+
+    def release(self, ip: str):
+        """Give back the slots of a device, or stop it waiting for them."""
+        granted = []
+        with self.lock:
+            path = self.held.pop(ip, None)
+            if path is None:
+                self.waiting = [entry for entry in self.waiting if entry[0] != ip]
+                return
+            for mac in path:
+                self.active[mac] -= 1
+            for entry in list(self.waiting):
+                waiting_ip, waiting_path, future = entry
+                if self.fits(waiting_path):
+                    self.waiting.remove(entry)
+                    self.take(waiting_ip, waiting_path)
+                    granted.append((future, waiting_path))
+        for future, waiting_path in granted:
+            future.set_result(waiting_path)
+
+
+class TopologyRefresher:
+    """Read /stats?type=wireless of many devices concurrently into a Topology.
+
+    Args:
+        topology: Topology to update.
+        username: Login username.
+        password: Login password.
+        timeout: Per-request timeout in seconds.
+        max_in_flight: Maximum number of devices refreshed at once.
+        token_cache: Optional TokenCache shared with other tools.
+    """
+
+    def __init__(self, topology: Topology, username: str, password: str, timeout: float = 10,
+                 max_in_flight: int = 200, token_cache: Optional[TokenCache] = None):
+        self.topology = topology
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.token_cache = token_cache or TokenCache()
+        self.clients: Dict[str, AsyncDeviceClient] = {}
+        self.changed = 0
+
+    def client(self, ip: str) -> AsyncDeviceClient:
+        client = self.clients.get(ip)
+        if client is None:
+            session = AsyncDeviceSession(ip, self.username, self.password, self.token_cache, timeout=self.timeout)
+            client = self.clients[ip] = AsyncDeviceClient(session)
+        return client
+
+    async def refresh_device(self, ip: str, semaphore: asyncio.Semaphore):
+        client = self.client(ip)
+        async with semaphore:
+            try:
+                if client.api is None:
+                    await client.system(timeout=self.timeout)
+                if client.api and 'wireless' in client.api.stats_types:
+                    wireless = (await client.stats('wireless', timeout=self.timeout)).raw.get('wireless') or {}
+                else:
+                    wireless = {}  # e.g. a TNS-10x switch
+            except (ApiError, AuthenticationError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.topology.devices.setdefault(ip, DeviceRadios()).error = str(e) or type(e).__name__
+                return
+        # A device that didn't answer keeps the links it reported before
+        self.changed += self.topology.update(ip, wireless)
+        device = self.topology.devices[ip]
+        device.refreshed = time.time()
+        device.error = None
+
+    async def refresh(self, ips: List[str]):
+        """Refresh the radios and peers of all devices once."""
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.changed = 0
+        await asyncio.gather(*(self.refresh_device(ip, semaphore) for ip in dict.fromkeys(ips)))
+
+    async def close(self):
+        await asyncio.gather(*(client.session.close() for client in self.clients.values()), return_exceptions=True)
+
+    async def run(self, ips: List[str]) -> Topology:
+        try:
+            await self.refresh(ips)
+        finally:
+            await self.close()
+        return self.topology
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the tree of APs and stations of many Tachyon devices')
+    parser.add_argument('-u', '--username', type=str, required=True, help='Username for authentication')
+    parser.add_argument('-p', '--password', type=str, required=True, help='Password for authentication')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--ip', nargs='+', help='IP address of device(s) to include')
+    group.add_argument('-if', '--ip_file', type=str, help='File containing list of IP addresses, one per line')
+    parser.add_argument('--order', action='store_true', help='Print the upgrade order instead of the tree')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout in seconds (default: 10)')
+    parser.add_argument('--max-in-flight', type=int, default=200, help='Maximum devices refreshed at once (default: 200)')
+    parser.add_argument('--token-cache', type=str, help='File used to keep API tokens between runs')
+    parser.add_argument('--capability-cache', type=str,
+                        help='File used to keep the model and firmware of each device between runs')
+    args = parser.parse_args()
+    if args.capability_cache:
+        CAPABILITIES.open(args.capability_cache)
+
+    if args.ip_file:
+        with open(args.ip_file) as f:
+            ips = [line.strip() for line in f if line.strip()]
+    else:
+        ips = args.ip
+
+    refresher = TopologyRefresher(Topology(), args.username, args.password, timeout=args.timeout,
+                                  max_in_flight=args.max_in_flight, token_cache=TokenCache(args.token_cache))
+    started = time.monotonic()
+    topology = asyncio.run(refresher.run(ips))
+    CAPABILITIES.save()
+    failed = [ip for ip in dict.fromkeys(ips) if topology.devices[ip].error]
+    print(f"Read {len(ips) - len(failed)} of {len(ips)} device(s) in {time.monotonic() - started:.1f}s: "
+          f"{len(topology.radios)} radio(s), {len(topology.upstream)} wireless link(s)", file=sys.stderr)
+    for ip in failed:
+        print(f"[{ip}] ✗ {topology.devices[ip].error}", file=sys.stderr)
+    if args.order:
+        for ip in topology.upgrade_order(ips):
+            parent = topology.parent(ip)
+            print(f"{ip:<20}depth {topology.depth(ip)}{f'  behind {parent}' if parent else ''}")
+    else:
+        print(topology.tree())
+
+
+if __name__ == "__main__":
+    main()
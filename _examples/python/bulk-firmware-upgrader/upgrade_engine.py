@@ -0,0 +1,701 @@
+"""
+Fleet Upgrade Engine
+Runs every device upgrade as its own state machine and drives many of them in
+parallel, bounded by a global concurrency cap and a per-subnet cap, in
+canary/wave order. While a device waits for its firmware download or flash,
+a shared WaitScheduler polls it and no thread is held for it; the same goes
+for the reboot, which is watched by wait_rebooted() on the scheduler's loop.
+With a Topology, stations are upgraded before the AP they are connected
+through, and the downloads through each AP radio can be limited. With an
+Inventory, devices it recently saw on the new firmware are skipped without a
+request. With an UpgradeJournal, an interrupted rollout resumes each device
+from the phase its GET /update reports.
+
+The upgrade can also be split in two: Mode.STAGE downloads and flashes the
+firmware to the backup bootbank, which doesn't affect the running device, and
+Mode.ACTIVATE later only reboots the devices that have it staged.
+
+Every device also keeps a profile: the wall time of each phase, and how much
+of it went into API requests, from the shared RequestMetrics.
+"""
+
+import ipaddress
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from inventory import Inventory
+from reboot_watcher import wait_rebooted
+from request_metrics import METRICS, RequestMetrics
+from tachyon_client import CAPABILITIES, LEGACY_VERSION, ApiError, DeviceClient, parse_version, version_key
+from tachyon_session import AuthenticationError, DeviceSession, SessionPool, TokenCache
+from topology import LinkSlots, Topology, TopologyRefresher
+from upgrade_journal import UpgradeJournal
+from wait_scheduler import SCHEDULER, WaitFailed, WaitScheduler, WaitTimeout
+
+
+class Mode(Enum):
+    UPGRADE = 'upgrade'  # download, flash, reboot and verify
+    STAGE = 'stage'  # download and flash to the backup bootbank, without a reboot
+    ACTIVATE = 'activate'  # reboot into the staged firmware and verify
+
+
+class State(Enum):
+    PENDING = 'PENDING'
+    LOGIN = 'LOGIN'
+    VERSION_CHECK = 'VERSION_CHECK'
+    DOWNLOAD = 'DOWNLOAD'
+    WAIT_DOWNLOAD = 'WAIT_DOWNLOAD'
+    FLASH = 'FLASH'
+    WAIT_FLASH = 'WAIT_FLASH'
+    REBOOT = 'REBOOT'
+    WAIT_REBOOT = 'WAIT_REBOOT'
+    VERIFY = 'VERIFY'
+    VERIFY_STAGED = 'VERIFY_STAGED'
+    DONE = 'DONE'
+    STAGED = 'STAGED'
+    SKIPPED = 'SKIPPED'
+    FAILED = 'FAILED'
+    NOT_STARTED = 'NOT_STARTED'
+
+
+TERMINAL_STATES = (State.DONE, State.STAGED, State.SKIPPED, State.FAILED, State.NOT_STARTED)
+# States before the device is changed, passed over when looking for where an earlier run got to
+PREAMBLE_STATES = (State.PENDING.value, State.LOGIN.value, State.VERSION_CHECK.value)
+# Phase of the upgrade profile each working state counts toward
+PROFILE_PHASES = {
+    State.LOGIN: 'login',
+    State.VERSION_CHECK: 'check',
+    State.DOWNLOAD: 'download',
+    State.WAIT_DOWNLOAD: 'download',
+    State.FLASH: 'flash',
+    State.WAIT_FLASH: 'flash',
+    State.REBOOT: 'reboot',
+    State.WAIT_REBOOT: 'reboot',
+    State.VERIFY: 'verify',
+    State.VERIFY_STAGED: 'verify',
+}
+PHASE_NAMES = ('login', 'check', 'download', 'flash', 'reboot', 'verify')
+
+_print_lock = threading.Lock()
+
+
+def log(ip: str, message: str):
+    """Print a message prefixed with the device IP, one line at a time."""
+    with _print_lock:
+        print(f"[{ip}] {message}", flush=True)
+
+
+def phase_cell(totals: Optional[list]) -> str:
+    """'wall/in-request' seconds of a phase for the profile table."""
+    if totals is None:
+        return f"{'-':>13}"
+    return f"{totals[0]:>7.1f}/{totals[2]:<5.1f}"
+
+
+def subnet_of(ip: str, prefix: int) -> str:
+    """Return the subnet a device belongs to, used for per-subnet caps."""
+    try:
+        return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+    except ValueError:
+        return ip  # hostname - treat it as its own subnet
+
+
+def plan_waves(ips: List[str], canary: int = 1, wave_size: int = 0) -> List[List[str]]:
+    """Split the device list into rollout waves.
+
+    Args:
+        ips: All devices to upgrade, in rollout order.
+        canary: Number of devices in the first (canary) wave, 0 to disable.
+        wave_size: Number of devices per following wave, 0 for a single wave.
+
+    Returns:
+        List of waves, each a list of device IPs.
+    """
+    ips = list(dict.fromkeys(ip for ip in ips if ip))  # de-dup, keep order
+    waves = []
+    if canary > 0 and len(ips) > canary:
+        waves.append(ips[:canary])
+        ips = ips[canary:]
+    if wave_size > 0:
+        waves.extend(ips[i:i + wave_size] for i in range(0, len(ips), wave_size))
+    elif ips:
+        waves.append(ips)
+    return waves
+
+
+class DeviceUpgrade:
+    """Upgrade state machine for a single device.
+
+    login -> version check -> PUT /update -> wait download -> POST /update ->
+    wait flashing -> POST /reboot -> wait for reboot -> login + verify.
+    Every failure ends in the FAILED state instead of aborting the fleet run.
+    With `download_slots`, the download only starts once the device has a
+    slot on every AP radio it downloads through.
+
+    With a `journal`, every state change is recorded in it. If an earlier run
+    got the device downloading or flashing the same firmware, the version
+    check continues from what GET /update reports instead of downloading
+    again; a device an earlier run rebooted into the new firmware is DONE.
+
+    In Mode.STAGE the machine stops after flashing, once /stats?type=system
+    shows the new firmware in the backup bootbank: the device is STAGED. In
+    Mode.ACTIVATE it goes from the version check straight to the reboot, and
+    fails a device that doesn't have the new firmware staged.
+
+    advance() runs the machine until it is done or has to wait for the
+    device, and returns the future to wait for; run() does so until done.
+
+    `phases` maps each phase of PROFILE_PHASES to [wall seconds, requests,
+    seconds in requests], the requests taken from the session's metrics.
+    """
+
+    def __init__(self, session: DeviceSession, firmware_url: str,
+                 force: bool = False, download_timeout: int = 300, flash_timeout: int = 300,
+                 reboot_timeout: int = 300, probe_interval: float = 1, scheduler: Optional[WaitScheduler] = None,
+                 download_slots: Optional[LinkSlots] = None, journal: Optional[UpgradeJournal] = None,
+                 mode: Mode = Mode.UPGRADE):
+        self.ip = session.ip
+        self.session = session
+        self.client = DeviceClient(session)
+        self.scheduler = scheduler or SCHEDULER
+        self.waiting: Optional[Future] = None
+        self.firmware_url = firmware_url
+        self.mode = mode
+        self.force = force
+        self.download_timeout = download_timeout
+        self.flash_timeout = flash_timeout
+        self.reboot_timeout = reboot_timeout
+        self.probe_interval = probe_interval
+        self.download_slots = download_slots
+        self.has_download_slot = False
+        self.journal = journal
+        # Where an earlier run of the same firmware left the device
+        self.resume_from = journal.state(self.ip, firmware_url, PREAMBLE_STATES) if journal else None
+        self.state = State.PENDING
+        self.error = None
+        self.current_version = None
+        self.backup_version = None
+        self.new_version = None
+        # /stats?type=system read by the reboot watcher
+        self.rebooted = None
+        self.started_at = None
+        self.finished_at = None
+        self.metrics: Optional[RequestMetrics] = session.metrics
+        self.phases: Dict[str, list] = {}
+        # (time.monotonic(), requests, seconds in requests) at the last state change
+        self.phase_mark: Optional[Tuple[float, int, float]] = None
+        self.handlers = {
+            State.LOGIN: self.do_login,
+            State.VERSION_CHECK: self.do_version_check,
+            State.DOWNLOAD: self.do_download,
+            State.WAIT_DOWNLOAD: self.do_wait_download,
+            State.FLASH: self.do_flash,
+            State.WAIT_FLASH: self.do_wait_flash,
+            State.REBOOT: self.do_reboot,
+            State.WAIT_REBOOT: self.do_wait_reboot,
+            State.VERIFY: self.do_verify,
+            State.VERIFY_STAGED: self.do_verify_staged,
+        }
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def fail(self, message: str) -> State:
+        self.error = message
+        log(self.ip, f"✗ {message}")
+        return State.FAILED
+
+    def run(self) -> State:
+        """Drive the state machine until the device reaches a terminal state."""
+        waiting = self.advance()
+        while waiting is not None:
+            wait([waiting])
+            waiting = self.advance()
+        return self.state
+
+    def advance(self) -> Optional[Future]:
+        """Run the state machine until it is done, or until it waits for the returned future."""
+        if self.started_at is None:
+            self.started_at = time.time()
+            self.set_state(State.LOGIN)
+        try:
+            while self.state not in TERMINAL_STATES:
+                self.set_state(self.handlers[self.state]())
+                if self.waiting is not None and not self.waiting.done():
+                    return self.waiting
+        except Exception as e:
+            self.set_state(self.fail(f"Unexpected error in state {self.state.value}: {e}"))
+        self.release_download_slot()
+        self.finished_at = time.time()
+        return None
+
+    def set_state(self, state: State):
+        if state != self.state and self.journal is not None:
+            version = {State.DONE: self.current_version, State.STAGED: self.backup_version}.get(state)
+            self.journal.record(self.ip, state.value, self.firmware_url,
+                                error=self.error if state == State.FAILED else None,
+                                version=' rev '.join(map(str, version)) if version else None)
+        self.profile_state()
+        self.state = state
+
+    def profile_state(self):
+        """Count the time since the last state change, and the requests sent in it, toward the current state's phase."""
+        requests_sent, request_time = self.metrics.device_totals(self.ip) if self.metrics is not None else (0, 0.0)
+        now = time.monotonic()
+        phase = PROFILE_PHASES.get(self.state)
+        if phase is not None and self.phase_mark is not None:
+            marked_at, marked_requests, marked_time = self.phase_mark
+            totals = self.phases.setdefault(phase, [0.0, 0, 0.0])
+            totals[0] += now - marked_at
+            totals[1] += requests_sent - marked_requests
+            totals[2] += request_time - marked_time
+        self.phase_mark = (now, requests_sent, request_time)
+
+    def do_login(self) -> State:
+        try:
+            self.session.login()
+        except (AuthenticationError, requests.exceptions.RequestException) as e:
+            return self.fail(f"Login failed: {e}")
+        log(self.ip, "✓ Authentication successful")
+        return State.VERSION_CHECK
+
+    def do_version_check(self) -> State:
+        try:
+            system = self.client.system()
+            self.current_version = system.version
+        except (ApiError, requests.exceptions.RequestException, ValueError) as e:
+            return self.fail(f"Failed to fetch firmware version: {e}")
+        self.backup_version = system.backup_version
+        self.new_version = parse_version(self.firmware_url.split('/')[-1])
+        if self.resume_from in (State.WAIT_REBOOT.value, State.VERIFY.value) and self.current_version and \
+                self.current_version == self.new_version:
+            log(self.ip, f"✓ Updated firmware version: {self.current_version[0]} rev {self.current_version[1]} "
+                         f"(rebooted by an earlier run)")
+            return State.DONE
+        if self.force:
+            return self.staging_state(system)
+        if not self.current_version or not self.new_version:
+            return self.fail("Could not compare versions, use --force to upgrade anyway")
+        if self.current_version == self.new_version or (
+                self.current_version == LEGACY_VERSION and self.new_version[0] == LEGACY_VERSION[0]):
+            log(self.ip, f"Device already has firmware version '{self.current_version[0]} rev {self.current_version[1]}'")
+            return State.SKIPPED
+        if version_key(self.new_version) < version_key(self.current_version):
+            log(self.ip, "⚠ New firmware is older than current - skipping (use --force to downgrade)")
+            return State.SKIPPED
+        return self.staging_state(system)
+
+    def staging_state(self, system) -> State:
+        """The state after the version check, given the mode and the device's bootbanks."""
+        if self.mode == Mode.UPGRADE:
+            return self.resume_state()
+        if 'bootbanks' not in system.raw:
+            return self.fail("Device does not report its bootbanks, so staging cannot be verified - "
+                             "upgrade it without --stage/--activate")
+        if self.is_staged():
+            if self.mode == Mode.STAGE:
+                log(self.ip, f"✓ Firmware already staged in the backup bootbank: "
+                             f"{self.backup_version[0]} rev {self.backup_version[1]}")
+                return State.STAGED
+            log(self.ip, f"Activating staged firmware {self.backup_version[0]} rev {self.backup_version[1]}")
+            return State.REBOOT
+        if self.mode == Mode.ACTIVATE:
+            return self.fail(f"Firmware {self.new_version} is not staged (backup bootbank has {self.backup_version}), "
+                             f"stage it first with --stage")
+        return self.resume_state()
+
+    def is_staged(self) -> bool:
+        """Whether the new firmware is flashed to the backup bootbank and waiting for a reboot.
+
+        The backup bootbank alone can't tell: after an upgrade it holds the firmware the device ran before.
+        """
+        if self.new_version is None or self.backup_version != self.new_version:
+            return False
+        try:
+            task = self.client.update_status()
+        except (ApiError, requests.exceptions.RequestException, ValueError):
+            return False
+        return task.reached('FIRMWARE_FLASHING', ('COMPLETE',))
+
+    def after_flash(self) -> State:
+        return State.VERIFY_STAGED if self.mode == Mode.STAGE else State.REBOOT
+
+    def resume_state(self) -> State:
+        """The state to go on from, given where an earlier run left the device and what GET /update says."""
+        if self.resume_from not in (State.WAIT_DOWNLOAD.value, State.FLASH.value, State.WAIT_FLASH.value,
+                                    State.REBOOT.value, State.WAIT_REBOOT.value, State.VERIFY.value):
+            return State.DOWNLOAD
+        try:
+            task = self.client.update_status()
+        except (ApiError, requests.exceptions.RequestException, ValueError):
+            return State.DOWNLOAD
+        state, status = task.get('state'), task.get('status')
+        if state == 'FIRMWARE_DOWNLOAD' and task.get('url') == self.firmware_url:
+            if status == 'SUCCESS':
+                log(self.ip, "Firmware already downloaded by an earlier run")
+                return State.FLASH
+            if status == 'IN_PROGRESS':
+                log(self.ip, "Firmware download of an earlier run still in progress")
+                return State.WAIT_DOWNLOAD
+        # The task doesn't name the image being flashed: it is the one the earlier run downloaded
+        if state == 'FIRMWARE_FLASHING' and self.resume_from != State.WAIT_DOWNLOAD.value:
+            if status == 'COMPLETE':
+                log(self.ip, "Firmware already flashed by an earlier run")
+                return self.after_flash()
+            if status == 'IN_PROGRESS':
+                log(self.ip, "Firmware flashing of an earlier run still in progress")
+                return State.WAIT_FLASH
+        return State.DOWNLOAD
+
+    def release_download_slot(self):
+        self.has_download_slot = False
+        if self.download_slots is not None:
+            self.download_slots.release(self.ip)
+
+    def do_download(self) -> State:
+        if self.download_slots is not None and not self.has_download_slot:
+            if self.waiting is None:
+                self.waiting = self.download_slots.acquire(self.ip)
+                if not self.waiting.done():
+                    log(self.ip, "Waiting for a download slot on its uplink")
+                return State.DOWNLOAD
+            self.waiting = None
+            self.has_download_slot = True
+        try:
+            self.client.start_download(self.firmware_url)
+        except (ApiError, requests.exceptions.RequestException) as e:
+            self.release_download_slot()
+            return self.fail(f"Failed to send firmware URL: {e}")
+        log(self.ip, f"Firmware {self.firmware_url} started downloading")
+        return State.WAIT_DOWNLOAD
+
+    def wait_update(self, expected_state: str, done_statuses: Tuple[str, ...], timeout: int, kind: str) -> Future:
+        """Have the scheduler poll GET /update until the task reaches expected_state with a done status."""
+        def check(task) -> bool:
+            if task.reached(expected_state, done_statuses):
+                return True
+            if task.failed:
+                raise WaitFailed(f"{task.state} failed: {task.get('error', task.status)}")
+            return False
+
+        client = self.scheduler.client(self.session)
+        return self.scheduler.submit(client.update_status, check, timeout, kind=kind, description=expected_state)
+
+    def wait_result(self) -> Optional[str]:
+        """Outcome of the finished wait: None on success, otherwise an error message."""
+        waiting, self.waiting = self.waiting, None
+        try:
+            waiting.result()
+        except (WaitFailed, WaitTimeout) as e:
+            return str(e)
+        return None
+
+    def do_wait_download(self) -> State:
+        if self.waiting is None:
+            self.waiting = self.wait_update('FIRMWARE_DOWNLOAD', ('SUCCESS',), self.download_timeout, 'download')
+            return State.WAIT_DOWNLOAD
+        error = self.wait_result()
+        self.release_download_slot()
+        if error:
+            return self.fail(error)
+        log(self.ip, "✓ Firmware downloaded")
+        return State.FLASH
+
+    def do_flash(self) -> State:
+        try:
+            self.client.start_flash(reset=False, force=False)
+        except (ApiError, requests.exceptions.RequestException) as e:
+            return self.fail(f"Failed to start flashing: {e}")
+        log(self.ip, "Firmware flashing started")
+        return State.WAIT_FLASH
+
+    def do_wait_flash(self) -> State:
+        if self.waiting is None:
+            self.waiting = self.wait_update('FIRMWARE_FLASHING', ('COMPLETE',), self.flash_timeout, 'flash')
+            return State.WAIT_FLASH
+        error = self.wait_result()
+        if error:
+            return self.fail(error)
+        log(self.ip, "✓ Firmware flashed")
+        return self.after_flash()
+
+    def do_reboot(self) -> State:
+        try:
+            self.client.reboot()
+        except (ApiError, requests.exceptions.RequestException) as e:
+            return self.fail(f"Failed to reboot: {e}")
+        log(self.ip, "Device started rebooting")
+        # The reboot ends the API session; the reboot watcher logs in again once the device is back
+        return State.WAIT_REBOOT
+
+    def do_wait_reboot(self) -> State:
+        if self.waiting is None:
+            client = self.scheduler.client(self.session)
+            self.waiting = self.scheduler.spawn(wait_rebooted(client, self.reboot_timeout, self.probe_interval))
+            return State.WAIT_REBOOT
+        waiting = self.waiting
+        error = self.wait_result()
+        if error:
+            return self.fail(f"Device did not come back after reboot: {error}")
+        self.rebooted = waiting.result()
+        log(self.ip, "✓ Reboot finished")
+        return State.VERIFY
+
+    def do_verify(self) -> State:
+        try:
+            # The reboot watcher read the system stats with the login it made after the reboot
+            system = self.rebooted if self.rebooted is not None else self.client.system()
+        except (AuthenticationError, ApiError, requests.exceptions.RequestException, ValueError) as e:
+            return self.fail(f"Failed to verify firmware version: {e}")
+        version = system.version
+        if version is None:
+            return self.fail(f"Failed to verify firmware version: could not parse firmware version "
+                             f"'{system.version_string}'")
+        if self.new_version and not self.force and version != self.new_version:
+            return self.fail(f"Version mismatch after reboot: expected {self.new_version}, got {version}")
+        self.current_version = version
+        log(self.ip, f"✓ Updated firmware version: {version[0]} rev {version[1]}")
+        return State.DONE
+
+    def do_verify_staged(self) -> State:
+        try:
+            self.backup_version = self.client.system().backup_version
+        except (ApiError, requests.exceptions.RequestException, ValueError) as e:
+            return self.fail(f"Failed to verify the backup bootbank: {e}")
+        if self.backup_version is None or (self.new_version and self.backup_version != self.new_version):
+            return self.fail(f"Backup bootbank mismatch after flashing: expected {self.new_version}, "
+                             f"got {self.backup_version}")
+        log(self.ip, f"✓ Firmware staged in the backup bootbank: {self.backup_version[0]} rev {self.backup_version[1]}")
+        return State.STAGED
+
+
+class FleetUpgrader:
+    """Run device upgrades in waves with global and per-subnet concurrency caps.
+
+    Each wave runs up to `concurrency` devices at once, with at most
+    `per_subnet` of them in the same subnet. A wave has to finish before the
+    next one starts; the rollout halts if the canary wave has any failure or a
+    later wave has more than `max_failures` failures. Devices only hold a
+    worker thread while they send requests, not while they wait.
+
+    With a `topology`, devices are rolled out deepest in the tree first, and a
+    device only starts once the devices connected through it are done, so no
+    station loses its AP halfway through its own upgrade. `per_link` then
+    limits the firmware downloads running through each AP radio.
+
+    With a `journal` file, every device's state changes are appended to it,
+    and a rollout run again with the same firmware resumes from it.
+
+    With an `inventory`, a device whose entry was seen within `inventory_ttl`
+    seconds on the new firmware is SKIPPED without logging into it.
+
+    With `mode` Mode.STAGE, the whole fleet downloads and flashes the firmware
+    under the same caps, without a reboot; a later run with Mode.ACTIVATE only
+    reboots the STAGED devices, so the outage is the reboot alone.
+
+    The requests of all devices are recorded in `metrics`, which profile()
+    breaks down per upgrade phase.
+    """
+
+    def __init__(self, ips: List[str], username: str, password: str, firmware_url: str,
+                 force: bool = False, concurrency: int = 10, per_subnet: int = 0, subnet_prefix: int = 24,
+                 canary: int = 1, wave_size: int = 0, max_failures: int = 0, token_cache: Optional[str] = None,
+                 capability_cache: Optional[str] = None, scheduler: Optional[WaitScheduler] = None,
+                 topology: Optional[Topology] = None, per_link: int = 0, inventory: Optional[Inventory] = None,
+                 inventory_ttl: float = 3600, journal: Optional[str] = None, mode: Mode = Mode.UPGRADE,
+                 metrics: Optional[RequestMetrics] = METRICS, **device_options):
+        self.pool = SessionPool(username, password, TokenCache(token_cache), metrics=metrics)
+        self.metrics = metrics
+        self.scheduler = scheduler or SCHEDULER
+        if capability_cache:
+            CAPABILITIES.open(capability_cache)
+        self.firmware_url = firmware_url
+        self.mode = mode
+        self.force = force
+        self.concurrency = max(1, concurrency)
+        self.per_subnet = per_subnet
+        self.subnet_prefix = subnet_prefix
+        self.canary = canary
+        self.wave_size = wave_size
+        self.max_failures = max_failures
+        self.device_options = device_options
+        self.ips = ips
+        self.waves = plan_waves(ips, canary, wave_size)
+        self.devices: Dict[str, DeviceUpgrade] = {}
+        self.topology: Optional[Topology] = None
+        self.download_slots: Optional[LinkSlots] = None
+        if topology is not None:
+            self.use_topology(topology, per_link)
+        self.inventory = inventory
+        self.inventory_ttl = inventory_ttl
+        self.journal = UpgradeJournal(journal) if journal else None
+        if inventory is not None:
+            inventory.attach(CAPABILITIES)
+
+    def use_topology(self, topology: Topology, per_link: int = 0):
+        """Order the rollout by `topology`, leaves first, and limit downloads per AP radio to `per_link`."""
+        self.topology = topology
+        self.download_slots = LinkSlots(topology, per_link) if per_link > 0 else None
+        self.waves = plan_waves(topology.upgrade_order(self.ips), self.canary, self.wave_size)
+
+    def discover_topology(self, per_link: int = 0, max_in_flight: int = 200) -> Topology:
+        """Read the wireless links of all devices and use them as the topology."""
+        refresher = TopologyRefresher(Topology(), self.pool.username, self.pool.password,
+                                      max_in_flight=max_in_flight, token_cache=self.pool.token_cache)
+        topology = self.scheduler.spawn(refresher.run(self.ips)).result()
+        self.use_topology(topology, per_link)
+        return topology
+
+    def make_device(self, ip: str) -> DeviceUpgrade:
+        return DeviceUpgrade(self.pool.get(ip), self.firmware_url, force=self.force, scheduler=self.scheduler,
+                             download_slots=self.download_slots, journal=self.journal, mode=self.mode,
+                             **self.device_options)
+
+    def skip_known(self, device: DeviceUpgrade) -> bool:
+        """Skip a device the inventory recently saw on the new firmware; returns whether it was."""
+        if self.inventory is None or self.force:
+            return False
+        entry = self.inventory.lookup(device.ip, self.inventory_ttl)
+        new_version = parse_version(self.firmware_url.split('/')[-1])
+        if entry is None or new_version is None or entry.version != new_version:
+            return False
+        device.state = State.SKIPPED
+        device.current_version = entry.version
+        device.started_at = device.finished_at = time.time()
+        log(device.ip, f"Device had firmware version '{new_version[0]} rev {new_version[1]}' "
+                       f"{entry.age:.0f}s ago (inventory)")
+        return True
+
+    def stations_below(self, ips: List[str]) -> Dict[str, List[str]]:
+        """The devices being upgraded that are connected through each device of `ips`."""
+        if self.topology is None:
+            return {}
+        below = {}
+        for ip in ips:
+            stations = [station for station in self.topology.descendants(ip) if station in self.devices]
+            if stations:
+                below[ip] = stations
+        return below
+
+    def run_wave(self, ips: List[str]) -> List[DeviceUpgrade]:
+        """Upgrade one wave, starting devices as global and subnet slots free up."""
+        pending = []
+        for ip in ips:
+            device = self.devices[ip] = self.make_device(ip)
+            if not self.skip_known(device):
+                pending.append(device)
+        below = self.stations_below(ips)
+        active_per_subnet: Dict[str, int] = {}
+        stepping = {}  # advance() running on a worker thread
+        waiting = {}  # waits on the scheduler
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while pending or stepping or waiting:
+                for device in list(pending):
+                    if len(stepping) + len(waiting) >= self.concurrency:
+                        break
+                    subnet = subnet_of(device.ip, self.subnet_prefix)
+                    if self.per_subnet and active_per_subnet.get(subnet, 0) >= self.per_subnet:
+                        continue
+                    # A loop in the reported links would block for good: then start it anyway
+                    if stepping or waiting or device is not pending[0]:
+                        if any(self.devices[station].state not in TERMINAL_STATES
+                               for station in below.get(device.ip, ())):
+                            continue
+                    pending.remove(device)
+                    active_per_subnet[subnet] = active_per_subnet.get(subnet, 0) + 1
+                    stepping[executor.submit(device.advance)] = (device, subnet)
+
+                done, _ = wait(list(stepping) + list(waiting), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in waiting:
+                        device, subnet = waiting.pop(future)
+                        stepping[executor.submit(device.advance)] = (device, subnet)
+                        continue
+                    device, subnet = stepping.pop(future)
+                    next_wait = future.result()
+                    if next_wait is not None:
+                        waiting[next_wait] = (device, subnet)
+                    else:
+                        active_per_subnet[subnet] -= 1
+
+        return [self.devices[ip] for ip in ips]
+
+    def run(self) -> bool:
+        """Run all waves. Returns True if no device failed."""
+        try:
+            self.run_waves()
+        finally:
+            self.scheduler.stop()
+            self.pool.close()
+            CAPABILITIES.save()
+            if self.journal is not None:
+                self.journal.close()
+        return not any(device.state == State.FAILED for device in self.devices.values())
+
+    def run_waves(self):
+        for number, wave in enumerate(self.waves, 1):
+            is_canary = number == 1 and self.canary > 0 and len(self.waves) > 1
+            label = "canary wave" if is_canary else f"wave {number}/{len(self.waves)}"
+            print(f"\n=== Starting {label}: {len(wave)} device(s) ===", flush=True)
+            results = self.run_wave(wave)
+            failures = sum(1 for device in results if device.state == State.FAILED)
+            if failures and (is_canary or failures > self.max_failures):
+                print(f"\n✗ {failures} device(s) failed in {label} - halting rollout", flush=True)
+                for later_wave in self.waves[number:]:
+                    for ip in later_wave:
+                        device = self.make_device(ip)
+                        device.state = State.NOT_STARTED
+                        self.devices[ip] = device
+                break
+
+    def summary(self) -> str:
+        """Return a per-device result table."""
+        lines = [f"{'Device':<20}{'Result':<14}{'Time':>8}  Details"]
+        for device in self.devices.values():
+            if device.state == State.FAILED:
+                details = device.error
+            elif device.state == State.STAGED and device.backup_version:
+                details = f"staged {device.backup_version[0]} rev {device.backup_version[1]}"
+            elif device.current_version:
+                details = f"{device.current_version[0]} rev {device.current_version[1]}"
+            else:
+                details = ''
+            lines.append(f"{device.ip:<20}{device.state.value:<14}{device.elapsed:>7.0f}s  {details}")
+        return '\n'.join(lines)
+
+    def profile(self) -> str:
+        """Return the per-phase breakdown of each upgrade, and the latency of each API endpoint.
+
+        Each phase shows its wall time and, after the slash, the part of it spent in API requests.
+        """
+        lines = [f"{'Device':<20}" + ''.join(f"{phase:>13}" for phase in PHASE_NAMES) + f"{'Requests':>10}"]
+        fleet: Dict[str, list] = {}
+        for device in self.devices.values():
+            if not device.phases:
+                continue
+            cells = []
+            for phase in PHASE_NAMES:
+                totals = device.phases.get(phase)
+                cells.append(phase_cell(totals))
+                if totals is not None:
+                    merged = fleet.setdefault(phase, [0.0, 0, 0.0])
+                    for i, value in enumerate(totals):
+                        merged[i] += value
+            requests_sent = sum(totals[1] for totals in device.phases.values())
+            lines.append(f"{device.ip:<20}" + ''.join(cells) + f"{requests_sent:>10}")
+        if fleet:
+            lines.append(f"{'Total':<20}" + ''.join(phase_cell(fleet.get(phase)) for phase in PHASE_NAMES) +
+                         f"{sum(totals[1] for totals in fleet.values()):>10}")
+        if self.metrics is not None:
+            lines.append('')
+            lines.append(self.metrics.table(self.devices))
+        return '\n'.join(lines)
@@ -0,0 +1,99 @@
+"""
+Upgrade Journal
+Append-only NDJSON log of the state transitions of device upgrades, so an
+interrupted rollout can be resumed instead of started over: a device the
+journal saw downloading or flashing the same firmware is picked up in the
+phase its GET /update reports, rather than downloading the firmware again.
+
+Every record is written through to the file at once, so the journal survives
+the tool crashing or being interrupted; fsync() runs in batches, every
+`batch` records or `interval` seconds, to bound what a power loss can take.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class UpgradeJournal:
+    """Upgrade state transitions per device, appended to `path` and read back on the next run.
+
+    Args:
+        path: NDJSON file, created if missing.
+        batch: Records written between two fsync() calls at most.
+        interval: Seconds between two fsync() calls at most, while records are written.
+    """
+
+    def __init__(self, path: str, batch: int = 50, interval: float = 1.0):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Records of each device, from earlier runs and this one
+        self.records: Dict[str, List[dict]] = {}
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+        torn = False
+        if os.path.exists(path):
+            torn = self.load()
+        self.file = open(path, 'a')
+        if torn:
+            self.file.write('\n')  # so the first new record starts on a line of its own
+
+    def load(self) -> bool:
+        """Read the records of earlier runs; returns whether the last line was cut off."""
+        line = '\n'
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self.records.setdefault(record['ip'], []).append(record)
+                except (ValueError, KeyError, TypeError):
+                    continue  # e.g. the line being written when the machine went down
+        return not line.endswith('\n')
+
+    def record(self, ip: str, state: str, firmware_url: str, **details):
+        """Append a device's new state; `details` such as the error are stored with it."""
+        record = {'ts': round(time.time(), 3), 'ip': ip, 'state': state, 'firmware_url': firmware_url}
+        record.update((key, value) for key, value in details.items() if value is not None)
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file.closed:
+                return  # a device still finishing after the rollout was interrupted
+            self.file.write(line)
+            self.file.flush()
+            self.records.setdefault(ip, []).append(record)
+            self.unsynced += 1
+            if self.unsynced >= self.batch or time.monotonic() - self.synced_at >= self.interval:
+                self.sync_locked()
+
+    def sync_locked(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced and not self.file.closed:
+                self.sync_locked()
+
+    def state(self, ip: str, firmware_url: str, skip: Iterable[str] = ()) -> Optional[str]:
+        """The last state of a device upgrading to `firmware_url`, passing over the states in `skip`.
+
+        None if the device's last record, after the skipped ones, is for another firmware.
+        """
+        skip = set(skip)
+        for record in reversed(self.records.get(ip, ())):
+            if record.get('state') in skip:
+                continue
+            return record.get('state') if record.get('firmware_url') == firmware_url else None
+        return None
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                if self.unsynced:
+                    self.sync_locked()
+                self.file.close()
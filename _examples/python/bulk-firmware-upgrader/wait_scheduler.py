@@ -0,0 +1,340 @@
+"""
+Wait Scheduler
+Waits for many devices to reach a state - a firmware download to finish, a
+config test to end - from one event loop in a background thread, instead of a
+thread sleeping in a poll loop per device.
+
+Each wait polls one route of one device until a condition holds. Pending waits
+sit in a heap ordered by their next poll; one coroutine sleeps until the
+earliest is due and sends its poll, so thousands of waits need no threads and
+callers simply get a concurrent.futures.Future. Poll intervals adapt per wait:
+
+- a `remaining` time in the response puts the next poll where it runs out;
+- waits of the same kind learn from each other how long they take, measured
+  by `last_changed` where the device reports it. Waits are not polled before
+  that time and polled often for a while after it; the first
+  download to finish moves up the polls of the others, so it tells the rest
+  of the fleet when to look;
+- otherwise a response that didn't change, `last_changed` included, grows the
+  interval (up to max_interval), while a change resets it.
+
+    with WaitScheduler() as scheduler:
+        client = scheduler.client(session)
+        done = scheduler.submit(client.update_status, lambda task: task.status == 'SUCCESS', timeout=300)
+        task = done.result()
+"""
+
+import asyncio
+import heapq
+import itertools
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from async_client import AsyncDeviceSession
+from tachyon_client import AsyncDeviceClient
+
+# Response fields that change on every poll without the state changing
+VOLATILE_FIELDS = ('remaining', 'timeout', 'last_updated', 'epoch_time', 'uptime')
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+class WaitFailed(Exception):
+    """Raised by a wait's condition when the state it waits for can no longer be reached."""
+
+
+def remaining_hint(result) -> Optional[float]:
+    """Seconds until the state is expected to change: the `remaining` field of aiming and similar responses."""
+    return result.get('remaining') if hasattr(result, 'get') else None
+
+
+def changed_at(result) -> Optional[float]:
+    """Device time of the last state change, from `last_changed` in /update and /speedtest."""
+    value = result.get('last_changed') if hasattr(result, 'get') else None
+    return value if isinstance(value, (int, float)) else None
+
+
+def signature(result):
+    """What a response says about the state, without the fields that change on every poll."""
+    raw = getattr(result, 'raw', result)
+    if isinstance(raw, dict):
+        return repr(sorted((key, value) for key, value in raw.items() if key not in VOLATILE_FIELDS))
+    return repr(raw)
+
+
+class Wait:
+    """One pending wait: poll until `check` accepts the response, or `deadline` passes."""
+
+    __slots__ = ('poll', 'check', 'hint', 'kind', 'description', 'future', 'started', 'deadline', 'interval',
+                 'due', 'signature', 'first_changed', 'polls', 'error')
+
+    def __init__(self, poll: Callable[[], Awaitable], check: Callable[[Any], bool],
+                 hint: Callable[[Any], Optional[float]], kind: str, description: str, timeout: float,
+                 interval: float):
+        self.poll = poll
+        self.check = check
+        self.hint = hint
+        self.kind = kind
+        self.description = description
+        self.future: Future = Future()
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.interval = interval
+        # Next poll, None while one is in flight
+        self.due: Optional[float] = None
+        self.signature = None
+        self.first_changed: Optional[float] = None
+        self.polls = 0
+        self.error: Optional[str] = None
+
+
+class WaitScheduler:
+    """Poll many waits from one event loop, each at its own adaptive interval.
+
+    Args:
+        min_interval: Shortest time in seconds between two polls of a wait.
+        max_interval: Longest time in seconds between two polls of a wait.
+        backoff: Factor the interval grows by each time a poll finds no change.
+        max_in_flight: Maximum number of polls sent at once.
+    """
+
+    def __init__(self, min_interval: float = 2, max_interval: float = 15, backoff: float = 1.5,
+                 max_in_flight: int = 100):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_in_flight = max_in_flight
+        self.heap: List[tuple] = []
+        self.counter = itertools.count()
+        self.waits: Set[Wait] = set()
+        # How long the last waits of each kind took, in seconds
+        self.durations: Dict[str, Deque[float]] = {}
+        self.clients: Dict[str, AsyncDeviceClient] = {}
+        self.polls = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self.runner: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self.thread = threading.Thread(target=self.serve, args=(ready,), name='wait-scheduler', daemon=True)
+            self.thread.start()
+        ready.wait()
+
+    def serve(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.runner = self.loop.create_task(self.run())
+        ready.set()
+        try:
+            self.loop.run_until_complete(self.runner)
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """Cancel the waits still pending and close the device connections."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if not thread:
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def client(self, session) -> AsyncDeviceClient:
+        """Client polling the device of a DeviceSession from the scheduler's loop; the two share the api_token."""
+        with self.lock:
+            client = self.clients.get(session.ip)
+            if client is None:
+                client = AsyncDeviceClient(AsyncDeviceSession(session.ip, session.username, session.password,
+                                                              session.token_cache, timeout=session.timeout,
+                                                              metrics=session.metrics))
+                self.clients[session.ip] = client
+            return client
+
+    def submit(self, poll: Callable[[], Awaitable], check: Callable[[Any], bool], timeout: float,
+               kind: str = '', description: str = '',
+               hint: Callable[[Any], Optional[float]] = remaining_hint) -> Future:
+        """Wait until `check(await poll())` is true.
+
+        Args:
+            poll: Coroutine function sending the poll, e.g. a route method of client().
+            check: Whether a response is the state waited for; may raise
+                WaitFailed to end the wait early.
+            timeout: Seconds after which the future fails with WaitTimeout.
+            kind: Waits of the same kind share what was learned about how long
+                they take, e.g. 'download'.
+            description: What is waited for, used in the timeout message.
+            hint: Seconds a response says the state will stay as it is.
+
+        Returns:
+            Future resolving to the response that satisfied `check`.
+        """
+        self.start()
+        wait = Wait(poll, check, hint, kind, description or kind, timeout, self.min_interval)
+        self.loop.call_soon_threadsafe(self.add, wait)
+        return wait.future
+
+    def spawn(self, coroutine: Awaitable) -> Future:
+        """Run a coroutine that waits in a way of its own, e.g. wait_rebooted(), on the scheduler's loop."""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def expected(self, kind: str) -> Optional[float]:
+        """Typical duration in seconds of the waits of a kind, None until one has finished."""
+        durations = self.durations.get(kind)
+        return statistics.median(durations) if durations else None
+
+    def add(self, wait: Wait):
+        self.waits.add(wait)
+        expected = self.expected(wait.kind)
+        self.schedule(wait, expected if expected is not None else self.min_interval)
+
+    def learn(self, wait: Wait, result):
+        """Record how long a finished wait took and move up the polls of the others of its kind."""
+        finished = changed_at(result)
+        if wait.first_changed is not None and finished is not None and finished > wait.first_changed:
+            duration = finished - wait.first_changed
+        else:
+            duration = time.monotonic() - wait.started
+        previous = self.expected(wait.kind)
+        self.durations.setdefault(wait.kind, deque(maxlen=50)).append(duration)
+        expected = self.expected(wait.kind)
+        if previous is not None and expected >= previous:
+            return  # no poll is due earlier than before
+        now = time.monotonic()
+        for other in self.waits:
+            if other.kind == wait.kind and other.due is not None and other.started + expected < other.due:
+                self.schedule(other, max(0.0, other.started + expected - now))
+
+    def resolve(self, wait: Wait, result=None, error: Optional[BaseException] = None):
+        self.waits.discard(wait)
+        try:
+            if error is not None:
+                wait.future.set_exception(error)
+            else:
+                wait.future.set_result(result)
+        except InvalidStateError:
+            pass  # cancelled by the caller meanwhile
+
+    def schedule(self, wait: Wait, delay: float):
+        due = wait.due = min(time.monotonic() + delay, wait.deadline)
+        heapq.heappush(self.heap, (due, next(self.counter), wait))
+        if self.heap[0][2] is wait:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due, _, wait = heapq.heappop(self.heap)
+            if due != wait.due:
+                continue  # rescheduled since
+            wait.due = None
+            if wait.future.cancelled():
+                self.waits.discard(wait)
+                continue
+            await self.semaphore.acquire()
+            self.loop.create_task(self.send(wait))
+
+    async def send(self, wait: Wait):
+        try:
+            await self.poll(wait)
+        finally:
+            self.semaphore.release()
+
+    async def poll(self, wait: Wait):
+        wait.polls += 1
+        self.polls += 1
+        try:
+            result = await wait.poll()
+        except Exception as e:
+            wait.error = str(e) or type(e).__name__
+            result = None
+        else:
+            try:
+                if wait.check(result):
+                    self.resolve(wait, result)
+                    self.learn(wait, result)
+                    return
+            except Exception as e:
+                self.resolve(wait, error=e)
+                return
+
+        if time.monotonic() >= wait.deadline:
+            message = f"Timeout waiting for {wait.description}"
+            self.resolve(wait, error=WaitTimeout(f"{message} (last error: {wait.error})" if wait.error else message))
+            return
+        changed, remaining = False, None
+        if result is not None:
+            if wait.first_changed is None:
+                wait.first_changed = changed_at(result)
+            state = signature(result)
+            changed, wait.signature = state != wait.signature, state
+            remaining = wait.hint(result)
+        self.schedule(wait, self.next_delay(wait, changed, remaining))
+
+    def next_delay(self, wait: Wait, changed: bool, remaining) -> float:
+        """Seconds until the next poll of a wait that isn't over."""
+        if isinstance(remaining, (int, float)) and remaining > self.min_interval:
+            return min(remaining, self.max_interval)
+        expected = self.expected(wait.kind)
+        if expected is not None:
+            elapsed = time.monotonic() - wait.started
+            if elapsed < expected:
+                return expected - elapsed
+            if elapsed < expected * 1.5:
+                return max(self.min_interval, expected / 20)  # due about now
+        if changed:
+            wait.interval = self.min_interval
+        else:
+            wait.interval = min(self.max_interval, wait.interval * self.backoff)
+        return wait.interval
+
+    async def shutdown(self):
+        for task in asyncio.all_tasks():
+            if task is not asyncio.current_task() and task is not self.runner:
+                task.cancel()
+        for wait in self.waits:
+            wait.future.cancel()
+        self.waits.clear()
+        self.heap.clear()
+        # The sessions share their api_token with the threaded ones, which log out if needed
+        await asyncio.gather(*(client.session.close(logout=False) for client in self.clients.values()),
+                             return_exceptions=True)
+        self.clients.clear()
+        self.runner.cancel()  # last, as it ends the loop
+
+
+# Shared by the tools of a process; it starts with the first wait
+SCHEDULER = WaitScheduler()
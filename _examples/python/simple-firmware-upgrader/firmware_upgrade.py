@@ -5,13 +5,41 @@ Upgrades device firmware only if the provided firmware is newer than the current
 """
 
 import argparse
+import json
 import re
 import requests
 import time
 import sys
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 from packaging import version
 
+API_PATH = '/cgi.lua/apiv1'
+
+
+class TimedSession(requests.Session):
+    """requests.Session that records how long each request took, per endpoint."""
+
+    def __init__(self):
+        super().__init__()
+        self.endpoints: Dict[str, List[float]] = {}  # e.g. 'GET /stats?type=system' -> seconds of each request
+        self.request_count = 0
+        self.request_time = 0.0
+
+    def request(self, method, url, *args, **kwargs):
+        params = kwargs.get('params') or {}
+        endpoint = f"{method.upper()} {urlsplit(url).path.replace(API_PATH, '', 1) or '/'}"
+        if 'type' in params:
+            endpoint += f"?type={params['type']}"
+        started = time.perf_counter()
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.endpoints.setdefault(endpoint, []).append(elapsed)
+            self.request_count += 1
+            self.request_time += elapsed
+
 
 class FirmwareUpgrader:
     def __init__(self, ip_address: str, username: str, password: str, firmware_url: str, force: bool = False):
@@ -20,9 +48,13 @@ class FirmwareUpgrader:
         self.password = password
         self.firmware_url = firmware_url
         self.force = force
-        self.base_url = f"http://{ip_address}/cgi.lua/apiv1"
+        self.base_url = f"http://{ip_address}{API_PATH}"
         self.api_token = None
-        self.session = requests.Session()
+        self.session = TimedSession()
+        # Phase -> (wall seconds, requests, seconds in requests), for --profile
+        self.phases: Dict[str, Tuple[float, int, float]] = {}
+        self.phase: Optional[str] = None
+        self.phase_mark: Optional[Tuple[float, int, float]] = None
 
     def extract_version_from_url(self, url: str) -> Optional[Tuple[str, int]]:
         """Extract version and revision from firmware filename in URL.
@@ -298,7 +330,7 @@ class FirmwareUpgrader:
 
         while time.time() - start_time < timeout:
             try:
-                response = requests.get(
+                response = self.session.get(
                     f"http://{self.ip_address}",
                     timeout=5
                 )
@@ -356,17 +388,60 @@ class FirmwareUpgrader:
 
         return False
 
+    def enter_phase(self, phase: Optional[str]):
+        """End the running phase, adding up its wall time and requests, and start `phase` (None: none)."""
+        now = time.perf_counter()
+        if self.phase is not None:
+            started, count, request_time = self.phase_mark
+            wall, phase_count, phase_request_time = self.phases.get(self.phase, (0.0, 0, 0.0))
+            self.phases[self.phase] = (wall + now - started, phase_count + self.session.request_count - count,
+                                       phase_request_time + self.session.request_time - request_time)
+        self.phase = phase
+        self.phase_mark = (now, self.session.request_count, self.session.request_time)
+
+    def profile(self) -> str:
+        """How long each phase took and how much of it was spent in requests, then the time of each endpoint."""
+        lines = [f"{'Phase':<12}{'Wall s':>9}{'Requests':>10}{'In requests s':>15}"]
+        for phase, (wall, count, request_time) in self.phases.items():
+            lines.append(f"{phase:<12}{wall:>9.2f}{count:>10}{request_time:>15.2f}")
+        lines.append(f"\n{'Endpoint':<28}{'Count':>7}{'Avg ms':>9}{'Max ms':>9}")
+        for endpoint, times in sorted(self.session.endpoints.items()):
+            average = sum(times) / len(times)
+            lines.append(f"{endpoint:<28}{len(times):>7}{average * 1000:>9.1f}{max(times) * 1000:>9.1f}")
+        return '\n'.join(lines)
+
+    def write_metrics(self, path: str):
+        """Write the phases and per-endpoint request times as JSON."""
+        data = {
+            'device': self.ip_address,
+            'phases': {phase: {'wall_s': round(wall, 3), 'requests': count, 'request_s': round(request_time, 3)}
+                       for phase, (wall, count, request_time) in self.phases.items()},
+            'endpoints': {endpoint: {'count': len(times), 'avg_s': round(sum(times) / len(times), 4),
+                                     'max_s': round(max(times), 4)}
+                          for endpoint, times in sorted(self.session.endpoints.items())},
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+
     def upgrade(self) -> bool:
-        """Execute the full firmware upgrade process."""
+        """Execute the full firmware upgrade process, timing each phase of it."""
+        try:
+            return self.run_upgrade()
+        finally:
+            self.enter_phase(None)
+
+    def run_upgrade(self) -> bool:
         print("\n" + "="*60)
         print("FIRMWARE UPGRADE PROCESS")
         print("="*60 + "\n")
 
         # Step 1: Login
+        self.enter_phase('login')
         if not self.login():
             return False
 
         # Step 2: Get current firmware
+        self.enter_phase('check')
         current_version_string = self.get_current_firmware()
         if not current_version_string:
             return False
@@ -412,6 +487,7 @@ class FirmwareUpgrader:
                 return True
 
         # Step 6: Send firmware URL
+        self.enter_phase('download')
         if not self.put_firmware_url():
             return False
 
@@ -420,6 +496,7 @@ class FirmwareUpgrader:
             return False
 
         # Step 8: Start flashing
+        self.enter_phase('flash')
         if not self.start_flashing():
             return False
 
@@ -428,6 +505,7 @@ class FirmwareUpgrader:
             return False
 
         # Step 10: Reboot device
+        self.enter_phase('reboot')
         if not self.reboot_device():
             return False
 
@@ -436,6 +514,7 @@ class FirmwareUpgrader:
             return False
 
         # Step 12: Verify upgrade
+        self.enter_phase('verify')
         if new_ver and new_rev is not None:
             # We know the expected version, verify it matches
             expected_version_string = f"{new_ver}-r{new_rev}"
@@ -468,6 +547,10 @@ def main():
     parser.add_argument('--url', required=True, help='Firmware download URL')
     parser.add_argument('--force', action='store_true',
                         help='Force upgrade even if new firmware is older or same version')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print how long each phase of the upgrade took, and the time of each API endpoint')
+    parser.add_argument('--metrics', type=str,
+                        help='Write the phase and request times to this JSON file')
 
     args = parser.parse_args()
 
@@ -481,13 +564,19 @@ def main():
 
     try:
         success = upgrader.upgrade()
-        sys.exit(0 if success else 1)
     except KeyboardInterrupt:
         print("\n\n✗ Upgrade interrupted by user")
-        sys.exit(1)
+        success = False
     except Exception as e:
         print(f"\n✗ Unexpected error: {e}")
-        sys.exit(1)
+        success = False
+
+    if args.profile:
+        print("\n" + upgrader.profile())
+    if args.metrics:
+        upgrader.write_metrics(args.metrics)
+        print(f"Request metrics written to {args.metrics}")
+    sys.exit(0 if success else 1)
 
 
 if __name__ == "__main__":
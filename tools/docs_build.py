@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Docs Site Build
+Builds the API docs of this repo (tna_30x/, tna_305/ and tns_10x/) into a
+static site that loads fast. Every version directory carries its own copy of
+the swagger-ui dist/; the build stores each distinct file once, under a
+content-hashed name in assets/, so a browser that opened one version page has
+the assets of all of them cached. Each swagger.yaml is converted to minified
+JSON at build time, so the page doesn't parse YAML, and keys.html, which is
+static markup, no longer loads the swagger-ui scripts it doesn't use. Text
+files get precompressed .gz variants, and .br ones when brotli is installed.
+
+Usage: python3 tools/docs_build.py --out site
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+try:
+    import brotli  # pip install brotli
+except ImportError:
+    brotli = None
+
+SPEC_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+FAMILIES = ('tna_30x', 'tna_305', 'tns_10x')
+
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+ASSET_DIR = 'assets'
+COMPRESSED_TYPES = ('.html', '.js', '.css', '.json', '.yaml', '.map', '.svg', '.txt')
+# dist/ references in the pages: <link href="dist/..."> and <script src="dist/...">
+DIST_REF_RE = re.compile(r'''(href|src)="dist/([^"]+)"''')
+SOURCE_MAP_RE = re.compile(r'(sourceMappingURL=)([^\s*]+\.map)')
+SCRIPT_TAG_RE = re.compile(r'''\s*<script src="dist/[^"]+"[^>]*>\s*</script>''')
+HEADERS = '''/assets/*
+  Cache-Control: public, max-age=31536000, immutable
+/*
+  Cache-Control: public, max-age=600
+'''
+
+
+def spec_versions(family: str, root: str = SPEC_ROOT) -> List[str]:
+    """The version directories of a family that hold a swagger.yaml, oldest first."""
+    directory = os.path.join(root, family)
+    if not os.path.isdir(directory):
+        return []
+    versions = [name for name in os.listdir(directory)
+                if os.path.isfile(os.path.join(directory, name, 'swagger.yaml'))]
+    return sorted(versions, key=lambda version: tuple(int(part) for part in re.findall(r'\d+', version)))
+
+
+def load_spec(data: bytes) -> dict:
+    return yaml.load(data, Loader=YamlLoader)
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def hashed_name(name: str, data: bytes) -> str:
+    """swagger-ui-bundle.js -> swagger-ui-bundle.3ef3c6270b.js; maps keep their .js.map/.css.map ending."""
+    base = os.path.basename(name)
+    stem, dot, extension = base.partition('.')
+    return f"{stem}.{content_hash(data)}{dot}{extension}"
+
+
+def json_default(value):
+    # YAML turns unquoted dates into date objects
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class SiteBuilder:
+    """Build the docs site into `out`.
+
+    Args:
+        out: Output directory.
+        root: Repo root holding the family directories.
+        source_maps: Also publish the .map files, linked from the scripts and styles.
+        level: gzip level of the precompressed variants.
+    """
+
+    def __init__(self, out: str, root: str = SPEC_ROOT, source_maps: bool = True, level: int = 9):
+        self.out = out
+        self.root = root
+        self.source_maps = source_maps
+        self.level = level
+        # (source dist/ directory, path in it) -> asset file name
+        self.assets: Dict[Tuple[str, str], str] = {}
+        self.written = 0
+        self.skipped = 0
+        # dist/ references to files that don't exist -> pages with them
+        self.missing: Dict[str, List[str]] = {}
+
+    # ----- output -----
+
+    def write(self, path: str, data: bytes, immutable: bool = False):
+        """Write a file and its precompressed variants; an existing content-hashed file is left alone."""
+        target = os.path.join(self.out, path)
+        if immutable and os.path.exists(target):
+            self.skipped += 1
+            return
+        if os.path.exists(target):
+            with open(target, 'rb') as f:
+                if f.read() == data:
+                    self.skipped += 1
+                    return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+        self.written += 1
+        if not path.endswith(COMPRESSED_TYPES):
+            return
+        variants = [('.gz', gzip.compress(data, self.level, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(data):
+                with open(target + suffix, 'wb') as f:
+                    f.write(compressed)
+            elif os.path.exists(target + suffix):
+                os.remove(target + suffix)
+
+    def transfer_size(self, path: str) -> int:
+        """Bytes a browser downloads for a file, using the smallest variant."""
+        target = os.path.join(self.out, path)
+        sizes = [os.path.getsize(target + suffix) for suffix in ('', '.gz', '.br') if os.path.exists(target + suffix)]
+        return min(sizes) if sizes else 0
+
+    # ----- assets -----
+
+    def add_dist(self, dist: str):
+        """Store the files of one dist/ directory as content-hashed assets."""
+        files = []
+        for directory, _, names in os.walk(dist):
+            for name in names:
+                files.append(os.path.relpath(os.path.join(directory, name), dist).replace(os.sep, '/'))
+        # Maps first, so the scripts and styles can point at their hashed names
+        for relative in sorted(files, key=lambda name: not name.endswith('.map')):
+            with open(os.path.join(dist, relative), 'rb') as f:
+                data = f.read()
+            if relative.endswith('.map'):
+                if not self.source_maps:
+                    continue
+            elif relative.endswith(('.js', '.css')):
+                data = self.link_source_map(dist, relative, data)
+            if relative == 'swagger-initializer.js':
+                # The spec is served as JSON next to each page
+                data = data.replace(b'url: "swagger.yaml"', b'url: "swagger.json"')
+            name = hashed_name(relative, data)
+            self.assets[(dist, relative)] = name
+            self.write(f"{ASSET_DIR}/{name}", data, immutable=True)
+
+    def link_source_map(self, dist: str, relative: str, data: bytes) -> bytes:
+        """Point a script's or style's sourceMappingURL at the hashed map, or drop it without maps."""
+        def replace(match):
+            source = os.path.normpath(os.path.join(os.path.dirname(relative), match.group(2))).replace(os.sep, '/')
+            name = self.assets.get((dist, source))
+            return f"{match.group(1)}{name}" if name else ''
+        text = data.decode('utf-8')
+        if self.source_maps:
+            return SOURCE_MAP_RE.sub(replace, text).encode()
+        return re.sub(r'//# sourceMappingURL=\S+|/\*# sourceMappingURL=[^*]+\*/', '', text).encode()
+
+    # ----- pages -----
+
+    def link_assets(self, html: str, dist: str, page: str) -> str:
+        """Point a page's dist/ references at the shared assets; references to missing files are dropped."""
+        def replace(match):
+            name = self.assets.get((dist, match.group(2)))
+            return f'{match.group(1)}="../../{ASSET_DIR}/{name}"' if name else f'{match.group(1)}=""'
+        missing = [ref for _, ref in DIST_REF_RE.findall(html) if (dist, ref) not in self.assets]
+        for ref in missing:
+            self.missing.setdefault(ref, []).append(page)
+            html = re.sub(r'\s*<(link|script)[^>]*"dist/' + re.escape(ref) + r'"[^>]*>(\s*</script>)?', '', html)
+        return DIST_REF_RE.sub(replace, html)
+
+    def build_version(self, family: str, version: str) -> List[str]:
+        """Build one version directory; returns the pages written."""
+        source = os.path.join(self.root, family, version)
+        dist = os.path.join(source, 'dist')
+        if os.path.isdir(dist):
+            self.add_dist(dist)
+        prefix = f"{family}/{version}"
+        pages = []
+
+        with open(os.path.join(source, 'swagger.yaml'), 'rb') as f:
+            yaml_data = f.read()
+        self.write(f"{prefix}/swagger.yaml", yaml_data)
+        spec = load_spec(yaml_data)
+        self.write(f"{prefix}/swagger.json",
+                   json.dumps(spec, separators=(',', ':'), ensure_ascii=False, default=json_default).encode())
+
+        for page in ('index.html', 'keys.html'):
+            path = os.path.join(source, page)
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as f:
+                html = f.read()
+            if page == 'keys.html':
+                # The key listing is static markup; its inline script only opens and closes sections
+                html = SCRIPT_TAG_RE.sub('', html)
+            html = self.link_assets(html, dist, f"{prefix}/{page}")
+            self.write(f"{prefix}/{page}", html.encode('utf-8'))
+            pages.append(f"{prefix}/{page}")
+        return pages
+
+    def build_index(self, versions: Dict[str, List[str]]):
+        rows = []
+        for family, family_versions in versions.items():
+            links = ' '.join(f'<a href="{family}/{version}/">{version}</a> '
+                             f'(<a href="{family}/{version}/keys.html">keys</a>)'
+                             for version in reversed(family_versions))
+            rows.append(f"<li><b>{family}</b>: {links}</li>")
+        html = ('<!DOCTYPE html>\n<html lang="en"><head><meta charset="UTF-8"><title>Tachyon Networks API</title>'
+                '</head>\n<body><h1>Tachyon Networks API</h1>\n<ul>\n' + '\n'.join(rows) + '\n</ul></body></html>\n')
+        self.write('index.html', html.encode())
+
+    def build(self, families: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """Build every version of `families` (default: all); returns the pages of each version."""
+        pages = {}
+        versions = {}
+        for family in families or FAMILIES:
+            versions[family] = spec_versions(family, self.root)
+            for version in versions[family]:
+                pages[f"{family}/{version}"] = self.build_version(family, version)
+        self.build_index(versions)
+        self.write('_headers', HEADERS.encode())
+        self.write('.nojekyll', b'')
+        return pages
+
+    def page_assets(self, page: str) -> List[str]:
+        """The assets a built page loads."""
+        with open(os.path.join(self.out, page), encoding='utf-8') as f:
+            html = f.read()
+        return sorted(set(re.findall(rf'"\.\./\.\./({ASSET_DIR}/[^"]+)"', html)))
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the API docs into a static site with shared assets')
+    parser.add_argument('--out', type=str, default='site', help='Output directory (default: site)')
+    parser.add_argument('--root', type=str, default=SPEC_ROOT, help='Repo root holding the spec directories')
+    parser.add_argument('--family', choices=FAMILIES, action='append', help='Only build this family (repeatable)')
+    parser.add_argument('--no-source-maps', action='store_true', help='Leave the .map files out')
+    parser.add_argument('--clean', action='store_true', help='Remove the output directory first')
+    args = parser.parse_args()
+
+    if args.clean and os.path.isdir(args.out):
+        shutil.rmtree(args.out)
+    builder = SiteBuilder(args.out, args.root, source_maps=not args.no_source_maps)
+    started = time.monotonic()
+    pages = builder.build(args.family)
+    for ref, missing_pages in builder.missing.items():
+        print(f"⚠ dist/{ref} does not exist; dropped from {len(missing_pages)} page(s), e.g. {missing_pages[0]}",
+              file=sys.stderr)
+    if brotli is None:
+        print("brotli is not installed: only .gz variants were written (pip install brotli)", file=sys.stderr)
+
+    dists = {dist for dist, _ in builder.assets}
+    source_size = sum(directory_size(dist) for dist in dists)
+    asset_size = sum(os.path.getsize(os.path.join(args.out, ASSET_DIR, name)) for name in set(builder.assets.values()))
+    print(f"Built {sum(map(len, pages.values()))} page(s) of {len(pages)} version(s) in "
+          f"{time.monotonic() - started:.1f}s: {builder.written} file(s) written, {builder.skipped} unchanged")
+    print(f"{len(dists)} dist/ directories of {source_size / 1e6:.1f} MB stored as {len(set(builder.assets.values()))} "
+          f"asset(s) of {asset_size / 1e6:.1f} MB")
+
+    print(f"\n{'Page':<32}{'First load':>12}{'Cached assets':>15}")
+    for version_pages in pages.values():
+        for page in version_pages:
+            spec = f"{os.path.dirname(page)}/swagger.json" if page.endswith('index.html') else None
+            own = builder.transfer_size(page) + (builder.transfer_size(spec) if spec else 0)
+            assets = sum(builder.transfer_size(asset) for asset in builder.page_assets(page))
+            print(f"{page:<32}{(own + assets) / 1e3:>10.0f}kB{own / 1e3:>13.0f}kB")
+
+
+if __name__ == "__main__":
+    main()